@@ -2,14 +2,26 @@ import streamlit as st
 import os
 import tempfile
 import time
-from src.graph import graph
-from src.nodes import rag_system
+from langchain_core.messages import AIMessageChunk
+from src.graph import get_graph, stream_graph
+from langchain_core.messages import AIMessage, HumanMessage
+from src.nodes import context_packer, cached_answer
+from src.components import components
+from src.metrics import graph_metrics
+from src.outbound import outbound_stats
+from src.llm import llm_registry
 from dotenv import load_dotenv
 
 
 
 load_dotenv()
 
+# Compiled once per process, after .env is loaded so CHECKPOINT_* settings apply
+graph = get_graph()
+
+# Prometheus /metrics and /metrics.json on METRICS_PORT, if set (once per process)
+graph_metrics.start()
+
 # Hardcoded credentials (for demonstration)
 USERS = {
     "aniketh": os.getenv("pass"),
@@ -46,9 +58,15 @@ def login_page():
                     st.error("Invalid username or password")
 
 def logout():
+    rag_system = components.get("rag_system")
     files = rag_system.get_uploaded_pdfs()
-    for file in files:
-        rag_system.delete_pdf(file)
+    if files:
+        rag_system.delete_pdfs(files)
+    if rag_system.initialized:
+        # Interrupted uploads can't be resumed once logged out, so free their stored chunks too
+        rag_system.discard_pending_ingests()
+    if "thread_id" in st.session_state:
+        graph.checkpointer.delete_thread(st.session_state.thread_id)
     st.session_state.clear()
     st.rerun()
 
@@ -58,8 +76,20 @@ if "logged_in" not in st.session_state:
 
 if not st.session_state.logged_in:
     login_page()
+    # Load the models and open Qdrant in the background while the user logs in
+    components.warm_up()
+    if components.ready:
+        st.caption("✅ Models loaded")
+    else:
+        st.caption("⏳ Loading models in the background...")
 else:
     # --- Main Application Code ---
+    components.warm_up()
+    if not components.ready:
+        with st.spinner("Loading models and document store..."):
+            components.wait()
+    rag_system, semantic_router = components.get("rag_system"), components.get("semantic_router")
+    weather_api, answer_cache = components.get("weather_api"), components.get("answer_cache")
     
     # Sidebar for Setup
     with st.sidebar:
@@ -100,11 +130,20 @@ else:
                     tmp_file.write(uploaded_file.getvalue())
                     tmp_path = tmp_file.name
                 
-                # Ingest
-                result = rag_system.ingest_pdf(tmp_path, filename)
+                # Ingest, one window of pages at a time
+                progress = st.progress(0.0, text="Parsing pages...")
+
+                def on_progress(pages_done, total_pages, chunks):
+                    progress.progress(pages_done / total_pages, text=f"{pages_done}/{total_pages} pages, {chunks} chunks stored")
+
+                result = rag_system.ingest_pdf(tmp_path, filename, on_progress=on_progress)
                 os.remove(tmp_path)
+                st.write(result)
                 
-                status.update(label="✅ Upload Complete!", state="complete", expanded=False)
+                if result.startswith("Error"):
+                    status.update(label="❌ Upload Interrupted", state="error", expanded=True)
+                else:
+                    status.update(label="✅ Upload Complete!", state="complete", expanded=False)
                 
                 # Increment key to reset uploader on rerun
                 st.session_state.uploader_key += 1
@@ -128,14 +167,65 @@ else:
                         st.rerun()
         else:
             st.info("No documents uploaded.", icon="ℹ️")
+
+        # Interrupted uploads resume when the same file is uploaded again, or can be discarded
+        unfinished = rag_system.ingest_checkpoints.pending() if rag_system.initialized else {}
+        if unfinished:
+            st.caption(f"Unfinished Uploads ({len(unfinished)}):")
+            for content_hash, entry in unfinished.items():
+                col1, col2 = st.columns([0.85, 0.15])
+                with col1:
+                    st.markdown(f"⏸️ **{entry['filename']}** ({entry['pages_done']}/{entry['total_pages'] or '?'} pages)")
+                with col2:
+                    if st.button("✖️", key=f"btn_discard_{content_hash}", help=f"Discard {entry['filename']}"):
+                        rag_system.discard_ingest(content_hash)
+                        st.toast(f"Discarded {entry['filename']}", icon="✖️")
+                        time.sleep(0.5)
+                        st.rerun()
         
         st.divider()
         
         # Settings Section
         with st.expander("🛠️ Advanced Settings"):
+            if semantic_router is not None:
+                router_stats = semantic_router.stats()
+                routed = router_stats["fast_path"] + router_stats["fallback"]
+                st.caption(f"⚡ Local router fast path: {router_stats['fast_path']}/{routed} ({router_stats['fast_path_rate']:.0%})")
+            cache_stats = weather_api.cache.stats()
+            st.caption(f"🌡️ Weather cache: {cache_stats['hits']} hits, {cache_stats['stale_hits']} stale, {cache_stats['misses']} misses ({cache_stats['hit_rate']:.0%})")
+            pool_stats = llm_registry.stats()
+            st.caption(f"🔌 LLM pool: {pool_stats['connections_opened']} connections opened, {pool_stats['connections_reused']} reused")
+            if rag_system.embedding_cache is not None:
+                embed_stats = rag_system.embedding_cache.stats()
+                st.caption(f"🧮 Embedding cache: {embed_stats['hits']} hits, {embed_stats['misses']} misses ({embed_stats['hit_rate']:.0%}), {embed_stats['size']} stored")
+            if rag_system.initialized:
+                query_stats = rag_system.embeddings.cache.stats()
+                result_stats = rag_system.result_cache.stats()
+                st.caption(f"🔎 Retrieval cache: {query_stats['hit_rate']:.0%} query embeddings, {result_stats['hit_rate']:.0%} results reused")
+            ingest_stats = rag_system.last_ingest_stats
+            if ingest_stats:
+                st.caption(f"📥 Last ingest: {ingest_stats['pages_per_sec']:.1f} pages/s, {ingest_stats['chunks_per_sec']:.1f} chunks/s")
+            packer_stats = context_packer.stats()
+            if packer_stats["turns"]:
+                st.caption(f"✂️ Context packing: {packer_stats['tokens_saved']} tokens saved over {packer_stats['turns']} turns ({packer_stats['saved_rate']:.0%})")
+            if answer_cache is not None:
+                answer_stats = answer_cache.stats()
+                per_route = ", ".join(f"{r} {v['hit_rate']:.0%}" for r, v in sorted(answer_stats["routes"].items()))
+                st.caption(f"💬 Answer cache: {answer_stats['hits']}/{answer_stats['lookups']} hits ({per_route or 'no lookups'}), threshold {answer_stats['threshold']:.2f}")
+            startup = components.status()
+            if startup["warm_seconds"] is not None:
+                st.caption(f"🚀 Cold start: {startup['warm_seconds']:.1f}s (budget {startup['budget']:.0f}s)")
+            checkpoint_stats = graph.checkpointer.stats()
+            st.caption(f"💾 Checkpoints: {checkpoint_stats['threads']} threads, {checkpoint_stats['bytes'] / 1024:.0f} KB, {checkpoint_stats['evictions']} evicted")
+            for name, out_stats in outbound_stats().items():
+                st.caption(f"🚦 {name}: {out_stats['coalesced']} coalesced, {out_stats['throttled']} queued (max depth {out_stats['max_queue_depth']}, mean wait {out_stats['mean_wait_seconds']:.1f}s), {out_stats['retries']} retries on 429")
+            if graph_metrics.port is not None:
+                st.caption(f"📈 Metrics: http://127.0.0.1:{graph_metrics.port}/metrics")
             if st.button("🧼 Clear Chat History", use_container_width=True):
                 st.session_state.messages = []
                 if "thread_id" in st.session_state:
+                    # The old thread is unreachable once replaced, so free its checkpoint now
+                    graph.checkpointer.delete_thread(st.session_state.thread_id)
                     import uuid
                     st.session_state.thread_id = str(uuid.uuid4())
                 st.toast("Conversation history cleared!", icon="🧹")
@@ -179,41 +269,96 @@ else:
                 inputs = {"question": prompt}
                 
                 final_answer = ""
+                streamed_text = ""
+                last_render = 0.0
+                route, cities, cacheable = None, [], False
+                
+                # A near-identical earlier question under the same route answers without any LLM call.
+                # The cache is shared by every session, so only turns that don't depend on this
+                # conversation's history are served from it or stored in it.
+                first_turn = not graph.get_state(config).values.get("messages")
+                hit = cached_answer(prompt) if first_turn else None
+                if hit is not None:
+                    route, final_answer, similarity = hit
+                    status.write(f"⚡ **Cached {route.upper()} answer** (similarity {similarity:.2f})")
+                    # Keep the turn in the conversation history as if the graph had answered it
+                    graph.update_state(config, {"question": prompt, "source": route, "answer": final_answer,
+                                                "messages": [HumanMessage(content=prompt), AIMessage(content=final_answer)]},
+                                       as_node="summarize")
                 
-                for output in graph.stream(inputs, config):
-                    for key, value in output.items():
+                # "messages" carries LLM tokens as they are generated, "updates" the node outputs
+                stream = stream_graph(graph, inputs, config, stream_mode=["updates", "messages"]) if hit is None else ()
+                for mode, chunk in stream:
+                    if mode == "messages":
+                        token, metadata = chunk
+                        if metadata.get("langgraph_node") != "generate" or not isinstance(token, AIMessageChunk):
+                            continue
+                        if not streamed_text:
+                            status.update(label="✨ Generating Answer...", state="running", expanded=False)
+                        streamed_text += token.content
+                        # Throttle re-renders so long answers don't redraw the markdown per token
+                        now = time.monotonic()
+                        if now - last_render > 0.05:
+                            message_placeholder.markdown(streamed_text + "▌")
+                            last_render = now
+                        continue
+
+                    for key, value in chunk.items():
                         if key == "router":
+                            route = value.get('source')
+                            cities = value.get("cities") or []
                             decision = value.get('source', 'Unknown').upper()
                             status.write(f"🔀 **Decision**: {decision}")
+                            if value.get("cities"):
+                                status.write(f"📍 **Cities**: {', '.join(value['cities'])}")
                             if decision == "WEATHER":
                                 status.update(label="🌤️ Fetching Weather Data...", state="running")
+                            elif decision == "BUSY":
+                                status.update(label="🚦 Rate limit reached", state="error")
                             else:
                                 status.update(label="📚 Retrieving Documents...", state="running")
                                 
                         elif key == "weather":
+                            cities = value.get("cities") or cities
+                            cacheable = bool(cities) and "Error" not in value.get("context", "")
                             status.write("✅ **Weather Data Fetched**")
                             with st.expander("View Data"):
                                 st.json(value)
                         elif key == "rag":
                             status.write("✅ **Documents Retrieved**")
+                            packing = value.get("context_stats") or {}
+                            cacheable = bool(packing)  # Nothing to cache before documents are uploaded
+                            if packing:
+                                status.write(f"✂️ **Context**: {packing['chunks_in']} chunks packed into {packing['passages']} passages, {packing['packed_tokens']} tokens ({packing['tokens_saved']} saved)")
                             # Truncate for display
                             context = value.get("context", "")
                             with st.expander("View Context"):
                                 st.text(context[:500] + "..." if len(context) > 500 else context)
                         elif key == "generate":
-                            status.update(label="✨ Generating Answer...", state="running")
                             final_answer = value.get("answer", "")
                 
+                if hit is None and cacheable and first_turn and answer_cache is not None:
+                    answer_cache.store(prompt, route, final_answer, cities)
+                
+                # Where this turn spent its time, per node
+                if hit is None:
+                    breakdown = []
+                    for node, record in graph_metrics.last_turn(st.session_state.thread_id).items():
+                        line = f"{node} {record.get('seconds', 0):.2f}s"
+                        if record.get("llm_calls"):
+                            line += f" ({record.get('prompt_tokens', 0)}→{record.get('completion_tokens', 0)} tokens)"
+                        if record.get("retrieved_chunks"):
+                            line += f" ({record['retrieved_chunks']} chunks)"
+                        if record.get("weather_cache_hits"):
+                            line += " (cached)"
+                        breakdown.append(line)
+                    if breakdown:
+                        status.write("⏱️ **Timing**: " + " · ".join(breakdown))
+                
                 status.update(label="✅ **Complete**", state="complete", expanded=False)
             
-            # Display final answer with typewriter effect (simulated streaming for visual)
-            import time
-            message_placeholder.markdown("")
-            streamed_text = ""
-            for char in final_answer:
-                streamed_text += char
-                message_placeholder.markdown(streamed_text + "▌")
-                time.sleep(0.005) # adjustable speed
+            # The checkpointed answer is authoritative; tokens were only a preview
+            final_answer = final_answer or streamed_text
             message_placeholder.markdown(final_answer)
             
             st.session_state.messages.append({"role": "assistant", "content": final_answer})
@@ -0,0 +1,56 @@
+"""Measures the cold start: importing the app modules, then warming every component.
+
+Run it in a fresh process (that is what it measures). Exits non-zero when the
+import or the warm-up exceeds its budget, so it can gate a deploy.
+
+    uv run python -m benchmarks.cold_start --import-budget 5 --warm-budget 30
+"""
+import argparse
+import json
+import sys
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--import-budget", type=float, default=5.0, help="Seconds allowed to import src.graph")
+    parser.add_argument("--warm-budget", type=float, default=None, help="Seconds allowed to warm up (COLD_START_BUDGET)")
+    parser.add_argument("--output", help="Write the results as JSON to this path")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    import src.graph  # noqa: F401  (what app.py imports before rendering the login page)
+    from src.components import components
+    import_seconds = time.perf_counter() - started
+
+    if args.warm_budget is not None:
+        components.budget = args.warm_budget
+    components.warm_up(background=False)
+    status = components.status()
+
+    results = {
+        "import_seconds": import_seconds,
+        "import_budget": args.import_budget,
+        "warm_seconds": status["warm_seconds"],
+        "warm_budget": status["budget"],
+        "timings": status["timings"],
+        "error": status["error"],
+        "rag_initialized": components.get("rag_system").initialized,
+    }
+    print(f"import: {import_seconds:.2f}s (budget {args.import_budget:.0f}s)")
+    for name, seconds in status["timings"].items():
+        print(f"  {name}: {seconds:.2f}s")
+    print(f"warm-up: {status['warm_seconds']:.2f}s (budget {status['budget']:.0f}s)")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if not results["rag_initialized"]:
+        print("RAG system failed to initialize; see the log above")
+    if import_seconds > args.import_budget or not status["within_budget"] or status["error"] \
+            or not results["rag_initialized"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""RAM and search latency/recall per Qdrant collection profile.
+
+Always reports the estimated resident memory per million 384-dim chunks for
+each profile in src/collection_profiles.py. With --url it also loads random
+unit vectors into one collection per profile on that Qdrant server and
+measures search latency and recall@k against exact (brute-force) search.
+Local mode ignores quantization and HNSW settings, so it is not measured.
+
+    uv run python -m benchmarks.collection_profiles --url http://localhost:6333 --points 100000
+"""
+import argparse
+import json
+import time
+import statistics
+import numpy as np
+from qdrant_client import QdrantClient
+from qdrant_client.models import PointStruct, SearchParams
+from src.collection_profiles import PROFILES, get_profile, collection_config, search_params, estimate_ram_bytes
+from src.embeddings import EMBEDDING_DIM
+from benchmarks.retrieval import percentile
+
+
+def wait_until_indexed(client, collection_name: str, timeout: float = 600):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        info = client.get_collection(collection_name)
+        if info.status == "green" and (info.indexed_vectors_count or 0) >= (info.points_count or 0):
+            return
+        time.sleep(1)
+
+
+def measure(client, profile: dict, vectors: np.ndarray, queries: np.ndarray, k: int) -> dict:
+    collection_name = f"profile_bench_{profile['name']}"
+    if client.collection_exists(collection_name):
+        client.delete_collection(collection_name)
+    client.create_collection(collection_name, **collection_config(profile, vectors.shape[1]))
+    for start in range(0, len(vectors), 1024):
+        batch = vectors[start:start + 1024]
+        client.upsert(collection_name, points=[
+            PointStruct(id=start + i, vector=vector.tolist()) for i, vector in enumerate(batch)
+        ])
+    wait_until_indexed(client, collection_name)
+
+    params = search_params(profile)
+    latencies, found = [], 0
+    for query in queries:
+        exact = client.query_points(collection_name, query=query.tolist(), limit=k,
+                                    search_params=SearchParams(exact=True)).points
+        started = time.perf_counter()
+        hits = client.query_points(collection_name, query=query.tolist(), limit=k, search_params=params).points
+        latencies.append((time.perf_counter() - started) * 1000)
+        found += len({hit.id for hit in hits} & {hit.id for hit in exact})
+    client.delete_collection(collection_name)
+    return {
+        f"recall@{k}": found / (k * len(queries)),
+        "p50_ms": statistics.median(latencies),
+        "p95_ms": percentile(latencies, 95),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Qdrant server to measure latency and recall on")
+    parser.add_argument("--points", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--output", help="Write the results as JSON to this path")
+    args = parser.parse_args()
+
+    client = QdrantClient(url=args.url) if args.url else None
+    rng = np.random.default_rng(0)
+    if client is not None:
+        vectors = rng.standard_normal((args.points, EMBEDDING_DIM)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        queries = vectors[rng.choice(args.points, args.queries, replace=False)]
+        queries = queries + 0.1 * rng.standard_normal(queries.shape).astype(np.float32)
+
+    results = {"dim": EMBEDDING_DIM, "profiles": {}}
+    for name in PROFILES:
+        profile = get_profile(name)
+        row = {"ram_mb_per_million_chunks": estimate_ram_bytes(profile, 1_000_000, EMBEDDING_DIM) / 2 ** 20}
+        if client is not None:
+            row.update(measure(client, profile, vectors, queries, args.k))
+        results["profiles"][name] = row
+        line = f"{name:>8}: {row['ram_mb_per_million_chunks']:.0f} MB/1M chunks"
+        if client is not None:
+            line += f"  recall@{args.k}={row[f'recall@{args.k}']:.3f}  p50={row['p50_ms']:.2f}ms  p95={row['p95_ms']:.2f}ms"
+        print(line)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""Offline end-to-end benchmark of the compiled graph.
+
+Runs the graph from src/graph.py with FakeChatModel in place of Groq and a
+local OpenWeatherMap stub, so it needs no network or API keys. Ingests a
+synthetic catalogue PDF, then drives N concurrent conversations of mixed
+weather and document questions, and reports:
+
+- ingest throughput (pages/s, chunks/s),
+- p50/p95/p99 latency of each node and of whole turns,
+- turns per second across all conversations,
+- resident memory before and after each phase.
+
+Write the results with --output and compare two runs with --baseline;
+--max-regression makes the run fail when p95 latency or throughput regress
+by more than that percentage, so it can gate CI.
+
+    uv run python -m benchmarks.e2e --conversations 16 --turns 6 --output e2e.json
+    uv run python -m benchmarks.e2e --baseline e2e.json --max-regression 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from benchmarks.fakes import FakeChatModel, offline_graph, offline_rag, write_pdf
+from benchmarks.retrieval import HashingEmbeddings, build_corpus, percentile
+
+CITIES = ["Tokyo", "Paris", "New York", "Mumbai", "Cairo", "Lima", "Oslo", "Sydney", "Toronto", "Nairobi"]
+WEATHER_TEMPLATES = ["What's the weather in {city}?", "Is it raining in {city} right now?",
+                     "Temperature in {city} and in {other}?"]
+RAG_TEMPLATES = ["Which part is {code}?", "When should part {code} be replaced?", "What series uses {code}?"]
+
+
+def rss_mb() -> float:
+    """Current resident set size (Linux), falling back to the peak elsewhere."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024  # bytes on macOS, KiB on Linux
+
+
+def latency_summary(seconds: list[float]) -> dict:
+    if not seconds:
+        return {"count": 0}
+    ms = [s * 1000 for s in seconds]
+    return {"count": len(ms), "mean_ms": sum(ms) / len(ms), "p50_ms": percentile(ms, 50),
+            "p95_ms": percentile(ms, 95), "p99_ms": percentile(ms, 99), "max_ms": max(ms)}
+
+
+def build_scripts(conversations: int, turns: int, codes: list[str], weather_share: float, seed: int = 0):
+    """One list of questions per conversation, mixing weather and document questions."""
+    rng = random.Random(seed)
+    scripts = []
+    for _ in range(conversations):
+        script = []
+        for _ in range(turns):
+            if rng.random() < weather_share:
+                city, other = rng.sample(CITIES, 2)
+                script.append(rng.choice(WEATHER_TEMPLATES).format(city=city, other=other))
+            else:
+                script.append(rng.choice(RAG_TEMPLATES).format(code=rng.choice(codes)))
+        scripts.append(script)
+    return scripts
+
+
+def ingest_catalogue(rag, workdir: str, pages: int, chunks_per_page: int = 8) -> dict:
+    """Ingests a synthetic catalogue PDF through RAGSystem.ingest_pdf and returns its stats and part codes."""
+    corpus = build_corpus(pages * chunks_per_page)
+    texts = [" ".join(doc.page_content for _, doc in corpus[n:n + chunks_per_page])
+             for n in range(0, len(corpus), chunks_per_page)]
+    pdf = write_pdf(os.path.join(workdir, "catalogue.pdf"), texts)
+    message = rag.ingest_pdf(pdf, "catalogue.pdf")
+    if rag.last_ingest_stats is None:
+        raise RuntimeError(message)
+    stats = {key: rag.last_ingest_stats[key] for key in
+             ("pages", "chunks", "seconds", "pages_per_sec", "chunks_per_sec", "embed_seconds", "upsert_seconds")}
+    return {"stats": stats, "codes": [code for code, _ in corpus]}
+
+
+async def converse(graph, thread_id: str, script: list[str], timings: dict):
+    config = {"configurable": {"thread_id": thread_id}}
+    for question in script:
+        started = last = time.perf_counter()
+        # "updates" yields once per finished node, so the gap since the previous chunk is that node's time
+        async for update in graph.astream({"question": question}, config, stream_mode="updates"):
+            now = time.perf_counter()
+            for node in update:
+                timings["nodes"].setdefault(node, []).append(now - last)
+            last = now
+        timings["turns"].append(time.perf_counter() - started)
+
+
+async def run_conversations(graph, scripts: list[list[str]]) -> dict:
+    timings = {"nodes": {}, "turns": []}
+    started = time.perf_counter()
+    await asyncio.gather(*(converse(graph, f"bench-{n}", script, timings) for n, script in enumerate(scripts)))
+    timings["seconds"] = time.perf_counter() - started
+    return timings
+
+
+def compare(results: dict, baseline: dict) -> dict:
+    """Percentage change of the headline metrics; positive means worse."""
+    def change(new, old, higher_is_better=False):
+        if not old:
+            return None
+        delta = (new - old) / old * 100
+        return -delta if higher_is_better else delta
+
+    return {
+        "turn_p50": change(results["latency"]["turn"]["p50_ms"], baseline["latency"]["turn"]["p50_ms"]),
+        "turn_p95": change(results["latency"]["turn"]["p95_ms"], baseline["latency"]["turn"]["p95_ms"]),
+        "turn_p99": change(results["latency"]["turn"]["p99_ms"], baseline["latency"]["turn"]["p99_ms"]),
+        "throughput": change(results["throughput"]["turns_per_sec"], baseline["throughput"]["turns_per_sec"],
+                             higher_is_better=True),
+        "ingest": change(results["ingest"]["pages_per_sec"], baseline["ingest"]["pages_per_sec"],
+                         higher_is_better=True),
+    }
+
+
+def run(args) -> dict:
+    # Everything in-process and in memory: no checkpoint file, no model download, no network
+    os.environ["CHECKPOINT_DB_PATH"] = ""
+    memory = {"start_mb": rss_mb()}
+    from src.checkpoint import SQLiteCheckpointer
+    from src.graph import build_graph
+    from src.metrics import GraphMetrics
+    from src.router import SemanticRouter
+
+    if args.model:
+        from langchain_huggingface import HuggingFaceEmbeddings
+        from src.rag import EMBEDDING_MODEL
+        embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL, encode_kwargs={"normalize_embeddings": True})
+    else:
+        embeddings = HashingEmbeddings()
+    rag = offline_rag(embeddings)
+    with tempfile.TemporaryDirectory() as workdir:
+        ingest = ingest_catalogue(rag, workdir, args.pages)
+    memory["after_ingest_mb"] = rss_mb()
+    print(f"Ingested {ingest['stats']['pages']} pages ({ingest['stats']['chunks']} chunks) "
+          f"at {ingest['stats']['pages_per_sec']:.1f} pages/s")
+
+    llm = FakeChatModel(latency=args.llm_latency, token_latency=args.token_latency, answer_tokens=args.answer_tokens)
+    checkpointer = SQLiteCheckpointer()
+    metrics = GraphMetrics(enabled=not args.no_metrics)
+    graph = build_graph(fused_routing=args.fused_routing, async_nodes=not args.sync_nodes,
+                        checkpointer=checkpointer, metrics=metrics)
+    scripts = build_scripts(args.conversations, args.turns, ingest["codes"], args.weather_share, args.seed)
+    router = SemanticRouter(embeddings) if args.semantic_router else None
+
+    with offline_graph(llm, rag, router, args.weather_latency, args.weather_cache_ttl) as (stub, weather_api):
+        timings = asyncio.run(run_conversations(graph, scripts))
+    memory["after_run_mb"] = rss_mb()
+    memory["peak_mb"] = peak_rss_mb()
+
+    turns = len(timings["turns"])
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "ingest": ingest["stats"],
+        "latency": {"turn": latency_summary(timings["turns"]),
+                    "nodes": {node: latency_summary(values) for node, values in sorted(timings["nodes"].items())}},
+        "throughput": {"turns": turns, "seconds": timings["seconds"],
+                       "turns_per_sec": turns / timings["seconds"] if timings["seconds"] else 0.0},
+        "memory": memory,
+        "weather": {"stub_requests": stub.requests, "cache": weather_api.cache.stats()},
+        "checkpointer": checkpointer.stats(),
+        "metrics": metrics.to_json(),  # Tokens and events per node, as the app's instrumentation saw them
+    }
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=8, help="Concurrent conversations")
+    parser.add_argument("--turns", type=int, default=6, help="Questions per conversation")
+    parser.add_argument("--pages", type=int, default=50, help="Pages in the ingested catalogue PDF")
+    parser.add_argument("--weather-share", type=float, default=0.5, help="Fraction of weather questions")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Fake LLM seconds to first token")
+    parser.add_argument("--token-latency", type=float, default=0.002, help="Fake LLM seconds per token")
+    parser.add_argument("--answer-tokens", type=int, default=40)
+    parser.add_argument("--weather-latency", type=float, default=0.03, help="Weather stub response delay")
+    parser.add_argument("--weather-cache-ttl", type=float, default=0, help="0 sends every lookup to the stub")
+    parser.add_argument("--sync-nodes", action="store_true", help="Use the sync node variants (ASYNC_GRAPH off)")
+    parser.add_argument("--fused-routing", action="store_true")
+    parser.add_argument("--semantic-router", action="store_true", help="Enable the local router fast path")
+    parser.add_argument("--model", action="store_true", help="Use the real sentence-transformers model")
+    parser.add_argument("--no-metrics", action="store_true", help="Disable node instrumentation (to measure its overhead)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results as JSON to this path")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=None,
+                        help="Exit non-zero if turn p95 or throughput is worse than the baseline by this percent")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+
+    results = run(args)
+    turn = results["latency"]["turn"]
+    print(f"{results['throughput']['turns']} turns in {results['throughput']['seconds']:.2f}s "
+          f"({results['throughput']['turns_per_sec']:.1f} turns/s)")
+    print(f"{'stage':<12}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, stats in [*results["latency"]["nodes"].items(), ("turn", turn)]:
+        print(f"{name:<12}{stats['count']:>7}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}")
+    memory = results["memory"]
+    print(f"RSS: {memory['start_mb']:.0f} MB at start, {memory['after_ingest_mb']:.0f} MB after ingest, "
+          f"{memory['after_run_mb']:.0f} MB after the run (peak {memory['peak_mb']:.0f} MB)")
+
+    regressed = False
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            results["comparison"] = compare(results, json.load(f))
+        for metric, delta in results["comparison"].items():
+            if delta is not None:
+                print(f"{metric}: {delta:+.1f}% vs baseline ({'worse' if delta > 0 else 'better'})")
+        if args.max_regression is not None:
+            regressed = any((results["comparison"][metric] or 0) > args.max_regression
+                            for metric in ("turn_p95", "throughput"))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if regressed:
+        print(f"Regressed by more than {args.max_regression:.0f}% against {args.baseline}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""Offline stand-ins for Groq and OpenWeatherMap, shared by the benchmarks and eval.py --fake-llm.
+
+FakeChatModel answers deterministically after a configurable delay (time to
+first token plus a per-token delay), including structured outputs for the
+router and city extraction. FakeJudgeModel grades by reference term overlap.
+WeatherStub serves OpenWeatherMap-shaped JSON from a local HTTP server, so
+WeatherAPI runs its real sync and async clients. offline_graph() wires them
+into the graph's components.
+"""
+import os
+import re
+import json
+import time
+import asyncio
+import threading
+import zlib
+from contextlib import contextmanager
+from unittest.mock import patch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import RunnableLambda
+from src.lexical import tokenize
+
+CITY_PATTERN = re.compile(r"\b(?:in|for|at)\s+((?:[A-Z][\w'-]+)(?:\s+[A-Z][\w'-]+)*)")
+WEATHER_WORDS = ("weather", "temperature", "forecast", "rain", "humid", "wind")
+
+
+def extract_cities(text: str) -> list[str]:
+    """City names following "in"/"for"/"at", e.g. "weather in New York and in Paris"."""
+    return CITY_PATTERN.findall(text)
+
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic chat model with Groq-like latency, for offline benchmarks."""
+
+    latency: float = 0.05  # Seconds before the first token
+    token_latency: float = 0.0  # Seconds per generated token
+    answer_tokens: int = 40
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-benchmark"
+
+    def _answer(self, messages) -> str:
+        """Echoes the start of the prompt's context, padded to answer_tokens words."""
+        system = str(messages[0].content)
+        context = system.split("Context:\n", 1)[1] if "Context:\n" in system else str(messages[-1].content)
+        words = context.split()[:self.answer_tokens]
+        return " ".join(words + [f"w{n}" for n in range(self.answer_tokens - len(words))])
+
+    def _delay(self, text: str) -> float:
+        return self.latency + self.token_latency * len(text.split())
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        text = self._answer(messages)
+        time.sleep(self._delay(text))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        text = self._answer(messages)
+        await asyncio.sleep(self._delay(text))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        for token in self._answer(messages).split(" "):
+            time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token + " "))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        for token in self._answer(messages).split(" "):
+            await asyncio.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token + " "))
+
+    def _structured(self, schema, messages):
+        """Fills the router / extraction schemas from keywords in the question."""
+        question = str(messages[-1].content)
+        cities = extract_cities(question)
+        weather = bool(cities) or any(word in question.lower() for word in WEATHER_WORDS)
+        fields = {}
+        if "source" in schema.model_fields:
+            fields["source"] = "weather" if weather else "rag"
+            if "cities" in schema.model_fields:
+                fields["cities"] = cities if weather else []
+        elif "cities" in schema.model_fields:
+            fields["cities"] = cities or ["London"]  # City extraction only runs for weather questions
+        return schema(**fields)
+
+    def with_structured_output(self, schema, **kwargs):
+        def invoke(messages):
+            time.sleep(self.latency)
+            return self._structured(schema, messages)
+
+        async def ainvoke(messages):
+            await asyncio.sleep(self.latency)
+            return self._structured(schema, messages)
+
+        return RunnableLambda(invoke, afunc=ainvoke)
+
+
+JUDGE_ITEM = re.compile(r"Item (\d+)\nQuestion: .*?\nReference: (.*?)\nPrediction: (.*?)(?=\n\nItem \d+\n|\Z)", re.S)
+
+
+class FakeJudgeModel(FakeChatModel):
+    """Grades each item of a judge prompt by the share of reference terms found in the prediction."""
+
+    def _answer(self, messages) -> str:
+        lines = []
+        for number, reference, prediction in JUDGE_ITEM.findall(str(messages[-1].content)):
+            expected, found = set(tokenize(reference)), set(tokenize(prediction))
+            score = len(expected & found) / len(expected) if expected else 1.0
+            lines.append(f"{number}. Score: {score:.2f} Reason: {len(expected & found)}/{len(expected)} reference terms")
+        return "\n".join(lines)
+
+
+class WeatherStub:
+    """Local OpenWeatherMap /data/2.5/weather endpoint with a fixed response delay.
+
+    Readings are derived from the city name, so runs are reproducible. Use it
+    as a context manager; `url` is what OPENWEATHERMAP_URL should be set to.
+    """
+
+    def __init__(self, latency: float = 0.03, host: str = "127.0.0.1", port: int = 0):
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                city = parse_qs(urlparse(self.path).query).get("q", ["London"])[0]
+                with stub._lock:
+                    stub.requests += 1
+                time.sleep(stub.latency)
+                body = json.dumps(stub.reading(city)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Keep benchmark output readable
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @staticmethod
+    def reading(city: str) -> dict:
+        seed = zlib.crc32(city.lower().encode())
+        temp = round(-5 + seed % 400 / 10, 1)
+        return {
+            "name": city,
+            "weather": [{"description": ["clear sky", "light rain", "overcast clouds", "mist"][seed % 4]}],
+            "main": {"temp": temp, "feels_like": round(temp - 1.5, 1), "humidity": 30 + seed % 60},
+            "wind": {"speed": round(seed % 120 / 10, 1)},
+        }
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/data/2.5/weather"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="weather-stub", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def write_pdf(path: str, pages: list[str]) -> str:
+    """Writes a minimal PDF with one line of Helvetica text per page."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        text = text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+    out, offsets = b"%PDF-1.4\n", []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("latin-1")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    with open(path, "wb") as f:
+        f.write(out)
+    return path
+
+
+def offline_rag(embeddings=None):
+    """Empty in-memory RAGSystem with deterministic hashing embeddings unless others are given."""
+    from qdrant_client import QdrantClient
+    from benchmarks.retrieval import HashingEmbeddings
+    from src.lexical import BM25Index
+    from src.manifest import DocumentManifest, IngestCheckpoints
+    from src.rag import RAGSystem
+    return RAGSystem(client=QdrantClient(":memory:"), embeddings=embeddings or HashingEmbeddings(),
+                     manifest=DocumentManifest(), lexical_index=BM25Index(), ingest_checkpoints=IngestCheckpoints())
+
+
+@contextmanager
+def offline_graph(llm, rag_system, semantic_router=None, weather_latency: float = 0.03, weather_cache_ttl: float = 0):
+    """Runs the graph's nodes against llm, rag_system and a WeatherStub; yields (stub, weather_api).
+
+    A weather_cache_ttl of 0 sends every lookup to the stub.
+    """
+    from src import nodes
+    from src.components import components
+    from src.outbound import OutboundProvider
+    from src.weather import WeatherAPI, WeatherCache
+    with WeatherStub(latency=weather_latency) as stub, \
+            patch.dict(os.environ, {"OPENWEATHERMAP_URL": stub.url,
+                                    "OPENWEATHERMAP_API_KEY": os.getenv("OPENWEATHERMAP_API_KEY") or "offline"}):
+        # The stub has no quota, so only coalescing applies (no rate limit)
+        weather_api = WeatherAPI(cache=WeatherCache(ttl=weather_cache_ttl, stale_ttl=0),
+                                 provider=OutboundProvider("openweathermap"))
+        with patch.object(nodes, "get_llm", lambda model=None: llm), \
+                patch.object(nodes, "get_async_llm", lambda model=None: llm), \
+                components.override(weather_api=weather_api, rag_system=rag_system, semantic_router=semantic_router,
+                                    answer_cache=None):
+            yield stub, weather_api
@@ -0,0 +1,134 @@
+"""Latency/recall comparison of dense, BM25 and hybrid (RRF) retrieval.
+
+Builds a synthetic parts catalogue in an in-memory Qdrant collection and asks
+for exact part numbers, the case dense-only search tends to miss, and natural
+-language questions whose common words stress the BM25 postings walk. Runs
+offline with deterministic hashing embeddings by default; pass --model to use
+the real all-MiniLM-L6-v2 embeddings instead.
+
+    uv run python -m benchmarks.retrieval --chunks 100000 --queries 200
+"""
+import argparse
+import hashlib
+import json
+import random
+import statistics
+import time
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from qdrant_client import QdrantClient
+from src.lexical import BM25Index, tokenize
+from src.manifest import DocumentManifest
+from src.rag import RAGSystem, EMBEDDING_DIM, EMBEDDING_MODEL
+
+COMPONENTS = ["gasket", "impeller", "seal kit", "bearing", "filter", "valve", "coupling", "sensor"]
+SERIES = ["AquaMax", "HydroPro", "FlowLine", "TerraPump", "NovaJet"]
+
+
+class HashingEmbeddings(Embeddings):
+    """Deterministic bag-of-words embeddings: each token hashed onto one of `dim` axes."""
+
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+
+    def embed_query(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in tokenize(text):
+            vector[int(hashlib.md5(token.encode()).hexdigest(), 16) % self.dim] += 1.0
+        return (vector / (np.linalg.norm(vector) + 1e-12)).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+def build_corpus(chunks: int, seed: int = 0):
+    rng = random.Random(seed)
+    docs = []
+    for n in range(chunks):
+        code = f"{rng.choice('ABCDEFGH')}{rng.choice('KLMNPRST')}-{n:05d}"
+        text = (f"Part {code} is the {rng.choice(COMPONENTS)} for the {rng.choice(SERIES)} series. "
+                f"Replace it during the {rng.choice(['annual', 'quarterly', 'monthly'])} service.")
+        docs.append((code, Document(page_content=text, metadata={"source_file": "catalogue.pdf", "content_hash": "bench"})))
+    return docs
+
+
+def natural_query(text: str) -> str:
+    """Rephrases a catalogue line as a question about its component, series and service interval."""
+    component, rest = text.split(" is the ", 1)[1].split(" for the ", 1)
+    series, interval = rest.split(" series. Replace it during the ", 1)
+    return (f"What is the part number of the {component} for the {series} series "
+            f"that is replaced during the {interval.removesuffix(' service.')} service?")
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--model", action="store_true", help="Use the real sentence-transformers model")
+    parser.add_argument("--output", help="Write the results as JSON to this path")
+    args = parser.parse_args()
+
+    if args.model:
+        from langchain_huggingface import HuggingFaceEmbeddings
+        embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL, encode_kwargs={"normalize_embeddings": True})
+    else:
+        embeddings = HashingEmbeddings()
+
+    rag = RAGSystem(client=QdrantClient(":memory:"), embeddings=embeddings,
+                    manifest=DocumentManifest(), lexical_index=BM25Index())
+    corpus = build_corpus(args.chunks)
+    started = time.perf_counter()
+    stats = rag.ingest_pipeline.upsert_documents((doc for _, doc in corpus), on_batch=rag._index_points)
+    print(f"Indexed {stats['chunks']} chunks in {time.perf_counter() - started:.1f}s")
+
+    point_ids = dict(zip((code for code, _ in corpus), stats["point_ids"]))
+    # Every chunk with the same component, series and interval answers the natural question
+    answers, questions = {}, {}
+    for (code, doc), point_id in zip(corpus, stats["point_ids"]):
+        questions[code] = natural_query(doc.page_content)
+        answers.setdefault(questions[code], set()).add(point_id)
+    sample = random.Random(1).sample(list(point_ids), min(args.queries, len(point_ids)))
+    kinds = {
+        "part_number": (lambda code: f"Which component is part {code}?", lambda code, ids: point_ids[code] in ids),
+        # Precision, as each question has many equally good answers
+        "natural": (questions.get, lambda code, ids: sum(i in answers[questions[code]] for i in ids) / args.k),
+    }
+    modes = {
+        "dense": lambda q: [doc.metadata["_id"] for doc in rag.retriever.invoke(q, k=args.k)],
+        "sparse": lambda q: [point_id for point_id, _ in rag.lexical_index.search(q, args.k)],
+        "hybrid": lambda q: [doc.metadata["_id"] for doc in rag._hybrid_search(q, args.k)],
+    }
+
+    results = {"chunks": args.chunks, "queries": len(sample), "k": args.k, "modes": {}}
+    for mode, search in modes.items():
+        results["modes"][mode] = {}
+        for kind, (ask, score) in kinds.items():
+            latencies, found = [], 0
+            for code in sample:
+                query = ask(code)
+                started = time.perf_counter()
+                ids = search(query)
+                latencies.append((time.perf_counter() - started) * 1000)
+                found += score(code, ids)
+            metric = f"recall@{args.k}" if kind == "part_number" else f"precision@{args.k}"
+            row = results["modes"][mode][kind] = {
+                metric: found / len(sample),
+                "p50_ms": statistics.median(latencies),
+                "p95_ms": percentile(latencies, 95),
+            }
+            print(f"{mode:>6} {kind:>11}: {metric}={row[metric]:.2f}  p50={row['p50_ms']:.2f}ms  p95={row['p95_ms']:.2f}ms")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
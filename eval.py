@@ -1,19 +1,34 @@
+"""Evaluates the agent: on LangSmith (default) or locally from a dataset file (--local).
+
+    uv run python eval.py
+    uv run python eval.py --local --dataset eval_dataset.jsonl --concurrency 16
+    uv run python eval.py --local --fake-llm   # offline: fake LLM, judge and weather API
+"""
 import os
 import uuid
-from langsmith import Client, evaluate
+import sys
+import argparse
+import json
 from langchain_groq import ChatGroq
-from src.graph import graph
+from src.graph import get_graph
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Initialize Client
-client = Client()
+JUDGE_MODEL = "llama-3.3-70b-versatile"
+
+# The LangSmith client contacts the API when created, so only the LangSmith run creates it
+client = None
 
 def create_dataset():
     """Creates or Retrieves the evaluation dataset."""
     dataset_name = "Weather_RAG_Eval_Dataset"
     
+    global client
+    from langsmith import Client
+    if client is None:
+        client = Client()
+    
     if client.has_dataset(dataset_name=dataset_name):
         return client.read_dataset(dataset_name=dataset_name)
 
@@ -42,17 +57,18 @@ def target(inputs: dict) -> dict:
     
     # Invoke graph
     # Inputs from dataset match AgentState keys (question)
-    result = graph.invoke(inputs, config)
+    result = get_graph().invoke(inputs, config)
     
     # Return the generated answer
     return {"answer": result.get("answer", "No answer produced")}
 
 def run_evaluation():
+    from langsmith import evaluate
     dataset_name = "Weather_RAG_Eval_Dataset"
     create_dataset()
     
     # Initialize Judge LLM
-    eval_llm = ChatGroq(model="llama-3.3-70b-versatile", temperature=0)
+    eval_llm = ChatGroq(model=JUDGE_MODEL, temperature=0)
 
     # Custom Evaluator without langchain.evaluation dependency
     def correctness_eval(run, example):
@@ -92,8 +108,61 @@ def run_evaluation():
         metadata={"version": "1.0.0", "llm": "llama-3.3-70b"}
     )
 
+def run_local_evaluation(args):
+    """Runs the dataset file through a fresh graph with concurrent examples and cached, batched judging."""
+    from src.checkpoint import SQLiteCheckpointer
+    from src.evaluation import EvaluationRunner, JudgeCache, load_dataset
+    from src.graph import build_graph
+
+    examples = load_dataset(args.dataset)[:args.limit]
+    # Examples are independent threads, deleted once answered; keep them out of the app's checkpoint file
+    local_graph = build_graph(async_nodes=True, checkpointer=SQLiteCheckpointer())
+    cache = JudgeCache(args.judge_cache) if args.judge_cache is not None else JudgeCache.from_env()
+
+    if args.fake_llm:
+        from benchmarks.fakes import FakeChatModel, FakeJudgeModel, offline_graph, offline_rag
+        runner = EvaluationRunner(local_graph, FakeJudgeModel(latency=args.fake_latency), cache, args.concurrency,
+                                  args.judge_batch_size, judge_model="fake-judge")
+        with offline_graph(FakeChatModel(latency=args.fake_latency), offline_rag(), weather_latency=args.fake_latency):
+            report = runner.run(examples)
+    else:
+        runner = EvaluationRunner(local_graph, ChatGroq(model=JUDGE_MODEL, temperature=0), cache, args.concurrency,
+                                  args.judge_batch_size, judge_model=JUDGE_MODEL)
+        report = runner.run(examples)
+
+    summary = report["summary"]
+    for result in report["results"]:
+        if result["score"] is None or result["score"] < args.show_below:
+            score = "ungraded" if result["score"] is None else f"{result['score']:.2f}"
+            print(f"[{score}] {result['question']}\n    -> {result['prediction'][:200]}\n    {result['comment']}")
+    print(f"{summary['examples']} examples in {summary['seconds']:.1f}s ({summary['examples_per_sec']:.1f}/s), "
+          f"mean score {summary['mean_score']:.2f}, {summary['errors']} errors, {summary['ungraded']} ungraded")
+    print(f"Judge: {summary['judge_calls']} calls, {summary['judge_cache']['hits']} cached verdicts reused")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return report
+
 if __name__ == "__main__":
-    if not os.getenv("LANGCHAIN_API_KEY"):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--local", action="store_true", help="Evaluate locally from --dataset instead of LangSmith")
+    parser.add_argument("--dataset", default="eval_dataset.jsonl", help="JSONL/JSON examples with question and answer")
+    parser.add_argument("--limit", type=int, default=None, help="Only the first N examples")
+    parser.add_argument("--concurrency", type=int, default=8, help="Examples (and judge calls) in flight at once")
+    parser.add_argument("--judge-batch-size", type=int, default=8, help="Predictions graded per judge call")
+    parser.add_argument("--judge-cache", default=None, help="Verdict cache file (EVAL_JUDGE_CACHE_PATH; '' for none)")
+    parser.add_argument("--fake-llm", action="store_true", help="Offline: fake graph LLM and judge, local weather stub")
+    parser.add_argument("--fake-latency", type=float, default=0.05, help="Seconds per fake LLM / weather call")
+    parser.add_argument("--show-below", type=float, default=0.5, help="Print examples scoring below this")
+    parser.add_argument("--output", help="Write predictions, verdicts and the summary as JSON to this path")
+    args = parser.parse_args()
+
+    if args.local:
+        report = run_local_evaluation(args)
+        if report["summary"]["ungraded"]:
+            print("Error: the judge gave no verdict for some examples; their scores are unknown.")
+            sys.exit(1)
+    elif not os.getenv("LANGCHAIN_API_KEY"):
         print("Error: LANGCHAIN_API_KEY not found in environment.")
     else:
         print("Starting LangSmith evaluation...")
@@ -1,17 +1,53 @@
-from langchain_huggingface import HuggingFaceEmbeddings
+import json
 import os
+from src.embedding_cache import EmbeddingCache, CachedEmbeddings
+from src.embeddings import (
+    EMBEDDING_MODEL, EMBEDDING_DIM, ONNX_FILES, OnnxEmbeddings, build_embeddings, cache_model_name, export_onnx,
+    measure_tolerance,
+)
+from src.router import DEFAULT_EXAMPLES
+
+# Sample texts for checking the ONNX exports against PyTorch: short queries plus a chunk-sized passage
+TOLERANCE_TEXTS = [text for examples in DEFAULT_EXAMPLES.values() for text in examples] + [
+    "To reset the device, hold the power button for ten seconds until the status light blinks amber. " * 8,
+]
 
 print("Starting model download for caching...")
 try:
     # Use the same parameters as in src/rag.py
-    embeddings = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-MiniLM-L6-v2",
-        model_kwargs={'device': 'cpu'},
-        encode_kwargs={'normalize_embeddings': True}
-    )
+    embeddings = build_embeddings("torch")
     # Perform a dummy encoding to trigger download
     embeddings.embed_query("hello world")
     print("Model successfully downloaded and cached.")
+
+    # Export the ONNX Runtime models and record how closely they agree with PyTorch
+    backend = os.getenv("EMBEDDING_BACKEND", "torch")
+    try:
+        model_dir = export_onnx(EMBEDDING_MODEL)
+        tolerance = {}
+        for name, file_name in ONNX_FILES.items():
+            candidate = OnnxEmbeddings(os.path.join(model_dir, file_name), os.path.join(model_dir, "tokenizer.json"))
+            tolerance[name] = measure_tolerance(embeddings, candidate, TOLERANCE_TEXTS)
+            print(f"{name}: min cosine vs PyTorch {tolerance[name]['min_cosine']:.4f}")
+        with open(os.path.join(model_dir, "tolerance.json"), "w", encoding="utf-8") as f:
+            json.dump(tolerance, f, indent=2)
+    except ImportError as e:
+        if backend != "torch":
+            raise RuntimeError(f"EMBEDDING_BACKEND={backend} needs the onnx extra (uv sync --extra onnx): {e}")
+        print(f"Skipping ONNX export: {e}")
+    if backend != "torch":
+        # The configured backend must load here, or every container would silently fall back to PyTorch
+        OnnxEmbeddings.load(backend, EMBEDDING_MODEL)
+        print(f"{backend} export is within tolerance.")
+
+    # Warm the embedding cache with the router exemplars so startup skips their inference,
+    # using the backend that will serve queries since each backend has its own cache entries
+    serving = embeddings if backend == "torch" else build_embeddings(backend)
+    cache = EmbeddingCache.from_env(dim=EMBEDDING_DIM)
+    cached = CachedEmbeddings(serving, cache, model_name=cache_model_name(serving))
+    for examples in DEFAULT_EXAMPLES.values():
+        cached.embed_documents(examples)
+    print(f"Embedding cache warmed: {cache.stats()['size']} entries.")
 except Exception as e:
-    print(f"Error downloading model: {e}")
+    print(f"Error preloading models: {e}")
     exit(1)
@@ -0,0 +1,136 @@
+import os
+import re
+import time
+import threading
+import numpy as np
+from src.weather import normalize_city
+
+
+# Words that can join city names in a question ("Tokyo and Osaka", "Paris vs Lima")
+CITY_JOINERS = re.compile(r",|&|/|\b(?:and|or|vs|versus|plus)\b")
+
+
+def _city_set(cities) -> frozenset:
+    return frozenset(normalize_city(city) for city in cities if city.strip())
+
+
+def _mentioned_cities(question: str, cities: frozenset):
+    """The subset of cities named in the question as whole words, without an LLM call.
+
+    Returns None when the question joins more names than that subset accounts
+    for ("Tokyo and Osaka" checked against {"tokyo"}), as the other name may
+    be a city never cached.
+    """
+    text = normalize_city(question)
+    found = set()
+    for city in cities:
+        pattern = r"(?<!\w)" + r"\s+".join(map(re.escape, city.split())) + r"(?!\w)"
+        text, matched = re.subn(pattern, " ", text)
+        if matched:
+            found.add(city)
+    if len(CITY_JOINERS.findall(text)) > max(len(found) - 1, 0):
+        return None
+    return frozenset(found)
+
+
+class SemanticAnswerCache:
+    """Final answers looked up by question embedding similarity, scoped by route.
+
+    A question only reuses an answer given under the same route, with cosine
+    similarity of at least `threshold`. Weather answers expire after
+    `weather_ttl` and are only reused for a question about exactly the same
+    cities ("tokyo weather now" may reuse "Weather in Tokyo", never "Weather
+    in Paris" or "Weather in Tokyo and Osaka"), found by matching the cached
+    city names in the question, so a hit needs no LLM call. RAG answers are
+    tagged with the collection version and dropped once documents change.
+    Each route keeps at most `max_entries` answers, oldest evicted first.
+    """
+
+    def __init__(self, embeddings, threshold: float = 0.93, weather_ttl: float = 600, max_entries: int = 512,
+                 version=lambda: 0):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.weather_ttl = weather_ttl
+        self.max_entries = max_entries
+        self.version = version  # Returns the current RAG collection version
+        self._entries = {}  # {route: list of (vector, answer, city set, created, version)}
+        self._lock = threading.Lock()
+        self._stats = {}  # {route: {"hits": n, "misses": n, "expired": n}}
+
+    @classmethod
+    def from_env(cls, embeddings, version=lambda: 0):
+        return cls(
+            embeddings,
+            threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.93")),
+            weather_ttl=float(os.getenv("ANSWER_CACHE_WEATHER_TTL", "600")),
+            max_entries=int(os.getenv("ANSWER_CACHE_SIZE", "512")),
+            version=version,
+        )
+
+    def _vector(self, question: str) -> np.ndarray:
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) + 1e-12)
+
+    def _fresh(self, route: str, entry: tuple, now: float) -> bool:
+        if route == "weather":
+            return now - entry[3] < self.weather_ttl
+        return entry[4] == self.version()
+
+    def _count(self, route: str, key: str, n: int = 1):
+        stats = self._stats.setdefault(route, {"hits": 0, "misses": 0, "expired": 0})
+        stats[key] += n
+
+    def lookup(self, question: str, route: str, cities=None):
+        """Returns (answer, similarity) for a confident hit under this route, else None.
+
+        cities are the cities the question asks about, if already known;
+        otherwise each city-scoped answer's cities are looked for in the
+        question, and the answer is skipped when that is inconclusive.
+        """
+        if self.max_entries <= 0:
+            return None
+        vector = self._vector(question)
+        now = time.time()
+        with self._lock:
+            entries = self._entries.get(route, [])
+            fresh = [entry for entry in entries if self._fresh(route, entry, now)]
+            if len(fresh) != len(entries):
+                self._count(route, "expired", len(entries) - len(fresh))
+                self._entries[route] = entries = fresh
+            candidates = sorted(((float(entry[0] @ vector), entry) for entry in entries), key=lambda c: -c[0])
+            candidates = [(score, entry) for score, entry in candidates if score >= self.threshold]
+        asked = _city_set(cities) if cities is not None else None
+        best = next(((score, entry) for score, entry in candidates
+                     if not entry[2] or entry[2] == (asked if asked is not None else _mentioned_cities(question, entry[2]))),
+                    None)
+        with self._lock:
+            self._count(route, "hits" if best is not None else "misses")
+        return (best[1][1], best[0]) if best is not None else None
+
+    def store(self, question: str, route: str, answer: str, cities: list[str] = ()):
+        if self.max_entries <= 0 or not answer:
+            return
+        if route == "weather" and not _city_set(cities):
+            return  # Can't tell which city the answer is about, so it could never be matched safely
+        entry = (self._vector(question), answer, _city_set(cities), time.time(), self.version())
+        with self._lock:
+            entries = self._entries.setdefault(route, [])
+            entries.append(entry)
+            del entries[:-self.max_entries]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Hit/miss/expired counts and hit rate per route, plus totals."""
+        with self._lock:
+            routes = {route: dict(stats) for route, stats in self._stats.items()}
+            size = sum(len(entries) for entries in self._entries.values())
+        for stats in routes.values():
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        hits = sum(stats["hits"] for stats in routes.values())
+        lookups = hits + sum(stats["misses"] for stats in routes.values())
+        return {"routes": routes, "hits": hits, "lookups": lookups, "hit_rate": hits / lookups if lookups else 0.0,
+                "size": size, "threshold": self.threshold}
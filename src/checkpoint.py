@@ -0,0 +1,246 @@
+import os
+import time
+import asyncio
+import random
+import sqlite3
+import threading
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP, BaseCheckpointSaver, CheckpointTuple, get_checkpoint_id, get_checkpoint_metadata,
+    writes_sort_key,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    thread_id TEXT PRIMARY KEY,
+    last_access REAL NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS threads_last_access ON threads (last_access);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL,
+    checkpoint_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    checkpoint BLOB NOT NULL,
+    metadata_type TEXT NOT NULL,
+    metadata BLOB NOT NULL,
+    PRIMARY KEY (thread_id, checkpoint_ns)
+);
+CREATE TABLE IF NOT EXISTS writes (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL,
+    checkpoint_id TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    type TEXT NOT NULL,
+    value BLOB NOT NULL,
+    task_path TEXT NOT NULL,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+);
+"""
+
+
+class SQLiteCheckpointer(BaseCheckpointSaver[str]):
+    """Bounded SQLite checkpointer keeping only the latest checkpoint of each thread.
+
+    Replacing MemorySaver, it keeps conversations across restarts while
+    capping what they cost: each put overwrites the thread's previous
+    checkpoint (so there is no history to replay or fork from), threads idle
+    longer than ttl are dropped, and the least recently used threads are
+    evicted beyond max_threads or max_bytes of stored checkpoints. SQLite's
+    page cache is limited to cache_kb, so RSS stays flat however many
+    threads are stored.
+    """
+
+    def __init__(self, path: str = ":memory:", ttl: float = 7 * 24 * 3600, max_threads: int = 1000,
+                 max_bytes: int = 256 * 1024 * 1024, cache_kb: int = 2048, serde=None):
+        super().__init__(serde=serde)
+        self.path = path
+        self.ttl = ttl
+        self.max_threads = max_threads
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._evictions = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # auto_vacuum only takes effect before the first table is created
+        self._conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._conn.execute(f"PRAGMA cache_size = -{int(cache_kb)}")
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            path=os.getenv("CHECKPOINT_DB_PATH", "checkpoints.sqlite") or ":memory:",
+            ttl=float(os.getenv("CHECKPOINT_TTL", str(7 * 24 * 3600))),
+            max_threads=int(os.getenv("CHECKPOINT_MAX_THREADS", "1000")),
+            max_bytes=int(os.getenv("CHECKPOINT_MAX_BYTES", str(256 * 1024 * 1024))),
+            cache_kb=int(os.getenv("CHECKPOINT_CACHE_KB", "2048")),
+        )
+
+    def _tuple(self, row, thread_id: str, checkpoint_ns: str) -> CheckpointTuple:
+        checkpoint_id, type_, checkpoint, metadata_type, metadata = row
+        writes = sorted(self._conn.execute(
+            "SELECT task_path, task_id, idx, channel, type, value FROM writes "
+            "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ), key=lambda write: writes_sort_key(*write[:3]))
+        return CheckpointTuple(
+            config={"configurable": {
+                "thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id,
+            }},
+            checkpoint=self.serde.loads_typed((type_, checkpoint)),
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            pending_writes=[(task_id, channel, self.serde.loads_typed((t, v))) for _, task_id, _, channel, t, v in writes],
+            parent_config=None,  # Earlier checkpoints are not kept
+        )
+
+    def get_tuple(self, config):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = get_checkpoint_id(config)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT checkpoint_id, type, checkpoint, metadata_type, metadata FROM checkpoints "
+                "WHERE thread_id = ? AND checkpoint_ns = ?", (thread_id, checkpoint_ns),
+            ).fetchone()
+            if row is None or (checkpoint_id and row[0] != checkpoint_id):
+                return None
+            self._conn.execute("UPDATE threads SET last_access = ? WHERE thread_id = ?", (time.time(), thread_id))
+            return self._tuple(row, thread_id, checkpoint_ns)
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        query = "SELECT thread_id, checkpoint_ns, checkpoint_id, type, checkpoint, metadata_type, metadata FROM checkpoints"
+        params = ()
+        if config:
+            query += " WHERE thread_id = ?"
+            params = (config["configurable"]["thread_id"],)
+            if config["configurable"].get("checkpoint_ns") is not None:
+                query += " AND checkpoint_ns = ?"
+                params += (config["configurable"]["checkpoint_ns"],)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY checkpoint_id DESC", params).fetchall()
+        config_checkpoint_id = get_checkpoint_id(config) if config else None
+        before_checkpoint_id = get_checkpoint_id(before) if before else None
+        for thread_id, checkpoint_ns, *row in rows:
+            if limit is not None and limit <= 0:
+                return
+            if config_checkpoint_id and row[0] != config_checkpoint_id:
+                continue
+            if before_checkpoint_id and row[0] >= before_checkpoint_id:
+                continue
+            with self._lock:
+                item = self._tuple(row, thread_id, checkpoint_ns)
+            if filter and not all(item.metadata.get(key) == value for key, value in filter.items()):
+                continue
+            if limit is not None:
+                limit -= 1
+            yield item
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        type_, blob = self.serde.dumps_typed(checkpoint)
+        metadata_type, metadata_blob = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (thread_id, checkpoint_ns, checkpoint["id"], type_, blob, metadata_type, metadata_blob),
+            )
+            # Writes only matter while their checkpoint is the latest one
+            self._conn.execute(
+                "DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id != ?",
+                (thread_id, checkpoint_ns, checkpoint["id"]),
+            )
+            self._touch(thread_id)
+            self._evict(keep=thread_id)
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}}
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            type_, blob = self.serde.dumps_typed(value)
+            rows.append((thread_id, checkpoint_ns, checkpoint_id, task_id, WRITES_IDX_MAP.get(channel, idx),
+                         channel, type_, blob, task_path))
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            # Special writes (errors, interrupts) are replaced; regular ones are kept if already recorded
+            for conflict, matches in (("REPLACE", lambda idx: idx < 0), ("IGNORE", lambda idx: idx >= 0)):
+                self._conn.executemany(
+                    f"INSERT OR {conflict} INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [row for row in rows if matches(row[4])],
+                )
+            self._touch(thread_id)
+
+    def _touch(self, thread_id: str):
+        size = self._conn.execute(
+            "SELECT (SELECT COALESCE(SUM(LENGTH(checkpoint) + LENGTH(metadata)), 0) FROM checkpoints WHERE thread_id = ?)"
+            " + (SELECT COALESCE(SUM(LENGTH(value)), 0) FROM writes WHERE thread_id = ?)", (thread_id, thread_id),
+        ).fetchone()[0]
+        self._conn.execute("INSERT OR REPLACE INTO threads VALUES (?, ?, ?)", (thread_id, time.time(), size))
+
+    def _delete(self, thread_ids):
+        for table in ("checkpoints", "writes", "threads"):
+            self._conn.executemany(f"DELETE FROM {table} WHERE thread_id = ?", [(t,) for t in thread_ids])
+
+    def _evict(self, keep: str):
+        """Drops expired threads, then the least recently used ones beyond the thread and size caps.
+
+        The thread being written (keep) is never evicted.
+        """
+        expired = [row[0] for row in self._conn.execute(
+            "SELECT thread_id FROM threads WHERE last_access < ? AND thread_id != ?", (time.time() - self.ttl, keep)
+        )]
+        count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM threads").fetchone()
+        doomed = set(expired)
+        if count - len(doomed) > self.max_threads or total > self.max_bytes:
+            for thread_id, size in self._conn.execute("SELECT thread_id, size FROM threads ORDER BY last_access"):
+                if count - len(doomed) <= self.max_threads and total <= self.max_bytes:
+                    break
+                if thread_id not in doomed and thread_id != keep:
+                    doomed.add(thread_id)
+                    total -= size
+        if doomed:
+            self._delete(list(doomed))
+            self._evictions += len(doomed)
+            self._conn.execute("PRAGMA incremental_vacuum")
+
+    def delete_thread(self, thread_id: str):
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._delete([thread_id])
+
+    # sqlite3 blocks, so the async variants run in worker threads rather than on the event loop
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        items = await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for item in items:
+            yield item
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str):
+        return await asyncio.to_thread(self.delete_thread, thread_id)
+
+    def get_next_version(self, current, channel):
+        # Same scheme as MemorySaver: monotonic counter plus a random tiebreaker
+        current_v = 0 if current is None else current if isinstance(current, int) else int(current.split(".")[0])
+        return f"{current_v + 1:032}.{random.random():016}"
+
+    def stats(self) -> dict:
+        with self._lock:
+            threads, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM threads").fetchone()
+        return {"threads": threads, "bytes": size, "evictions": self._evictions}
@@ -0,0 +1,121 @@
+import os
+from qdrant_client.models import (
+    VectorParams, VectorParamsDiff, Distance, HnswConfigDiff, ScalarQuantization, ScalarQuantizationConfig,
+    ScalarType, Disabled, SearchParams, QuantizationSearchParams,
+)
+
+# Memory/recall trade-offs for the RAG collection. Sizes are per point for 384-dim vectors.
+PROFILES = {
+    # float32 vectors and the HNSW graph in RAM (~1.6 KB/point): what the collection always used
+    "default": {"on_disk": False, "quantization": None, "hnsw_m": 16, "ef_construct": 100,
+                "hnsw_on_disk": False, "hnsw_ef": None, "oversampling": None},
+    # int8 copies in RAM for search, float32 originals on disk for rescoring the top candidates
+    "lean": {"on_disk": True, "quantization": "int8", "quantile": 0.99, "hnsw_m": 16, "ef_construct": 100,
+             "hnsw_on_disk": False, "hnsw_ef": 64, "oversampling": 2.0},
+    # Smallest footprint: sparser HNSW graph kept on disk as well
+    "minimal": {"on_disk": True, "quantization": "int8", "quantile": 0.99, "hnsw_m": 8, "ef_construct": 64,
+                "hnsw_on_disk": True, "hnsw_ef": 96, "oversampling": 3.0},
+}
+
+
+def get_profile(name: str = None) -> dict:
+    """Returns the QDRANT_COLLECTION_PROFILE profile with QDRANT_HNSW_* overrides applied."""
+    name = name or os.getenv("QDRANT_COLLECTION_PROFILE", "default")
+    if name not in PROFILES:
+        raise ValueError(f"Unknown collection profile '{name}', expected one of {list(PROFILES)}")
+    profile = dict(PROFILES[name], name=name)
+    for key, env, cast in (("hnsw_m", "QDRANT_HNSW_M", int), ("ef_construct", "QDRANT_HNSW_EF_CONSTRUCT", int),
+                           ("hnsw_ef", "QDRANT_SEARCH_EF", int)):
+        if os.getenv(env):
+            profile[key] = cast(os.getenv(env))
+    return profile
+
+
+def is_local(client) -> bool:
+    """Local (path= or :memory:) mode does exact search and ignores index, quantization and search settings."""
+    return bool(client.init_options.get("path") or client.init_options.get("location") == ":memory:")
+
+
+def _quantization_config(profile: dict):
+    if profile["quantization"] != "int8":
+        return None
+    # Quantized vectors always stay in RAM; they are what HNSW traverses
+    return ScalarQuantization(scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=profile["quantile"],
+                                                              always_ram=True))
+
+
+def _quantization_settings(quantization) -> tuple | None:
+    """The parts of a quantization config a profile sets, comparable between the profile and a collection."""
+    if quantization is None:
+        return None
+    scalar = getattr(quantization, "scalar", None)
+    if scalar is None:
+        return (type(quantization).__name__,)  # Product or binary quantization: never what a profile asks for
+    return ("scalar", str(scalar.type), scalar.quantile, bool(scalar.always_ram))
+
+
+def collection_config(profile: dict, dim: int) -> dict:
+    """create_collection() keyword arguments for a profile."""
+    return {
+        "vectors_config": VectorParams(size=dim, distance=Distance.COSINE, on_disk=profile["on_disk"]),
+        "hnsw_config": HnswConfigDiff(m=profile["hnsw_m"], ef_construct=profile["ef_construct"],
+                                      on_disk=profile["hnsw_on_disk"]),
+        "quantization_config": _quantization_config(profile),
+    }
+
+
+def search_params(profile: dict):
+    """Query-time parameters for a profile: HNSW ef and rescoring of oversampled quantized hits."""
+    if profile["hnsw_ef"] is None and profile["quantization"] is None:
+        return None
+    quantization = None
+    if profile["quantization"] is not None:
+        quantization = QuantizationSearchParams(rescore=True, oversampling=profile["oversampling"])
+    return SearchParams(hnsw_ef=profile["hnsw_ef"], quantization=quantization)
+
+
+def profile_drift(client, collection_name: str, profile: dict) -> list[str]:
+    """Names the settings where an existing collection differs from the profile."""
+    config = client.get_collection(collection_name).config
+    vectors = config.params.vectors
+    drift = []
+    if bool(vectors.on_disk) != profile["on_disk"]:
+        drift.append("on_disk")
+    if config.hnsw_config.m != profile["hnsw_m"] or config.hnsw_config.ef_construct != profile["ef_construct"] \
+            or bool(config.hnsw_config.on_disk) != profile["hnsw_on_disk"]:
+        drift.append("hnsw")
+    if _quantization_settings(config.quantization_config) != _quantization_settings(_quantization_config(profile)):
+        drift.append("quantization")
+    return drift
+
+
+def migrate_collection(client, collection_name: str, profile: dict) -> list[str]:
+    """Moves an existing collection onto a profile in place; returns the settings that changed.
+
+    Qdrant applies the change in the background (re-quantizing, moving vectors
+    to or from disk, rebuilding HNSW) while the collection keeps serving.
+    """
+    drift = profile_drift(client, collection_name, profile)
+    if not drift:
+        return []
+    config = collection_config(profile, dim=0)
+    client.update_collection(
+        collection_name=collection_name,
+        vectors_config={"": VectorParamsDiff(on_disk=profile["on_disk"])} if "on_disk" in drift else None,
+        hnsw_config=config["hnsw_config"] if "hnsw" in drift else None,
+        quantization_config=(config["quantization_config"] or Disabled.DISABLED) if "quantization" in drift else None,
+    )
+    return drift
+
+
+def estimate_ram_bytes(profile: dict, points: int, dim: int) -> int:
+    """Approximate resident memory for vectors and the HNSW graph (payloads and IDs excluded)."""
+    per_point = 0
+    if not profile["on_disk"]:
+        per_point += dim * 4
+    if profile["quantization"] == "int8":
+        per_point += dim + 4  # int8 components plus a per-vector offset
+    if not profile["hnsw_on_disk"]:
+        # Level 0 holds 2*m u32 links; upper levels add roughly another 10%
+        per_point += int(2 * profile["hnsw_m"] * 4 * 1.1)
+    return per_point * points
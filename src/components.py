@@ -0,0 +1,136 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+
+def _build_weather_api(components):
+    from src.weather import WeatherAPI
+    return WeatherAPI()
+
+
+def _build_rag_system(components):
+    from src.rag import RAGSystem
+    return RAGSystem()
+
+
+def _build_semantic_router(components):
+    # Local fast-path router reusing the RAG embeddings (None if the model failed to load)
+    from src.router import SemanticRouter
+    rag_system = components.get("rag_system")
+    if not rag_system.initialized:
+        return None
+    router = SemanticRouter(rag_system.embeddings)
+    router.classify("warm up")  # Embeds the exemplars and runs the model once
+    return router
+
+
+def _build_answer_cache(components):
+    # Near-duplicate questions skip the graph; the local router has to pick the route without an LLM
+    from src.answer_cache import SemanticAnswerCache
+    if components.get("semantic_router") is None:
+        return None
+    rag_system = components.get("rag_system")
+    return SemanticAnswerCache.from_env(rag_system.embeddings, version=lambda: rag_system.collection_version)
+
+
+BUILDERS = {
+    "weather_api": _build_weather_api,
+    "rag_system": _build_rag_system,
+    "semantic_router": _build_semantic_router,
+    "answer_cache": _build_answer_cache,
+}
+
+
+class Components:
+    """Process-wide heavy components, built on first use or by a background warm-up.
+
+    Importing the app builds nothing, so Streamlit can render the login page
+    immediately while warm_up() loads the embedding model, opens Qdrant and
+    embeds the router exemplars in a daemon thread. Each component is built
+    once per process (module state survives Streamlit reruns); a node that
+    needs one before warm-up reaches it builds or waits for it. Build times
+    are recorded and compared to COLD_START_BUDGET seconds.
+    """
+
+    def __init__(self, builders: dict = None, budget: float = None):
+        self._builders = dict(builders or BUILDERS)
+        self._instances = {}
+        self._locks = {name: threading.Lock() for name in self._builders}
+        self._lock = threading.Lock()
+        self._warm_thread = None
+        self._ready = threading.Event()
+        self.budget = budget if budget is not None else float(os.getenv("COLD_START_BUDGET", "30"))
+        self.timings = {}  # {component: build seconds}
+        self.warm_seconds = None
+        self.error = None
+
+    def get(self, name: str):
+        """Returns the component, building it on first use."""
+        if name in self._instances:
+            return self._instances[name]
+        if name not in self._builders:
+            raise KeyError(f"Unknown component '{name}'")
+        with self._locks[name]:
+            # Another thread (usually the warm-up) may have built it while we waited
+            if name not in self._instances:
+                started = time.perf_counter()
+                self._instances[name] = self._builders[name](self)
+                self.timings[name] = time.perf_counter() - started
+            return self._instances[name]
+
+    def warm_up(self, background: bool = True):
+        """Builds every component once, in a daemon thread unless background is False."""
+        with self._lock:
+            if self._warm_thread is None:
+                self._warm_thread = threading.Thread(target=self._warm, name="components-warm-up", daemon=True)
+                self._warm_thread.start()
+        if not background:
+            self.wait()
+
+    def _warm(self):
+        started = time.perf_counter()
+        try:
+            for name in self._builders:
+                self.get(name)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            self.error = str(e)
+        self.warm_seconds = time.perf_counter() - started
+        if self.warm_seconds > self.budget:
+            print(f"Cold start took {self.warm_seconds:.1f}s, over the {self.budget:.0f}s budget: {self.timings}")
+        self._ready.set()
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._ready.wait(timeout)
+
+    @contextmanager
+    def override(self, **instances):
+        """Temporarily replaces components (e.g. with fakes in tests)."""
+        saved = {name: self._instances[name] for name in instances if name in self._instances}
+        self._instances.update(instances)
+        try:
+            yield self
+        finally:
+            for name in instances:
+                self._instances.pop(name, None)
+            self._instances.update(saved)
+
+    def status(self) -> dict:
+        return {
+            "ready": self.ready,
+            "warming": self._warm_thread is not None and not self.ready,
+            "warm_seconds": self.warm_seconds,
+            "budget": self.budget,
+            "within_budget": self.warm_seconds is not None and self.warm_seconds <= self.budget,
+            "timings": dict(self.timings),
+            "error": self.error,
+        }
+
+
+components = Components()
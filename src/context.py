@@ -0,0 +1,157 @@
+import os
+import threading
+from src.lexical import tokenize
+
+CHARS_PER_TOKEN = 4  # Rough average for English prose with Llama-style tokenizers
+SEPARATOR = "\n\n"
+
+
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def overlap_length(head: str, tail: str, min_overlap: int = 20) -> int:
+    """Length of the longest suffix of head that is also a prefix of tail (0 if under min_overlap)."""
+    if len(head) < min_overlap or len(tail) < min_overlap:
+        return 0
+    probe = tail[:min_overlap]
+    pos = head.find(probe, max(0, len(head) - len(tail)))
+    while pos != -1:
+        if tail.startswith(head[pos:]):
+            return len(head) - pos
+        pos = head.find(probe, pos + 1)
+    return 0
+
+
+def _jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+class ContextPacker:
+    """Assembles retrieved chunks into a prompt context within a token budget.
+
+    Chunks from the same source_file whose text overlaps (the splitter repeats
+    up to chunk_overlap characters between neighbours) are stitched into one
+    passage, passages are ordered by maximal marginal relevance over their
+    word sets, and they are packed greedily until the budget is spent.
+    """
+
+    def __init__(self, max_tokens: int = 1024, candidates: int = 8, lambda_mult: float = 0.7,
+                 min_overlap: int = 20, count_tokens=estimate_tokens, baseline_chunks: int = 5):
+        self.max_tokens = max_tokens
+        self.candidates = candidates  # Chunks retrieved per question before packing
+        self.baseline_chunks = baseline_chunks  # Top chunks sent verbatim before packing; what savings are measured against
+        self.lambda_mult = lambda_mult  # 1.0 ranks by relevance only, 0.0 by novelty only
+        self.min_overlap = min_overlap
+        self.count_tokens = count_tokens
+        self._lock = threading.Lock()
+        self._stats = {"turns": 0, "raw_tokens": 0, "packed_tokens": 0, "tokens_saved": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_tokens=int(os.getenv("RAG_CONTEXT_TOKENS", "1024")),
+            candidates=int(os.getenv("RAG_CONTEXT_CANDIDATES", "8")),
+            lambda_mult=float(os.getenv("RAG_CONTEXT_MMR_LAMBDA", "0.7")),
+        )
+
+    def merge_overlapping(self, docs) -> list[dict]:
+        """Stitches overlapping chunks of the same file; passages keep their best rank."""
+        passages = []
+        for rank, doc in enumerate(docs):
+            text = doc.page_content
+            source = doc.metadata.get("source_file")
+            passage = {"text": text, "source": source, "rank": rank, "chunks": 1}
+            for other in passages:
+                if other["source"] == source and self._absorb(other, passage):
+                    passage = other
+                    break
+            else:
+                passages.append(passage)
+                continue
+            # The grown passage may now bridge two earlier ones
+            for other in list(passages):
+                if other is not passage and other["source"] == source and self._absorb(passage, other):
+                    passages.remove(other)
+        return passages
+
+    def _absorb(self, passage: dict, other: dict) -> bool:
+        """Merges other into passage in place if one contains or overlaps the other."""
+        if other["text"] in passage["text"]:
+            merged = passage["text"]
+        elif passage["text"] in other["text"]:
+            merged = other["text"]
+        elif overlap := overlap_length(passage["text"], other["text"], self.min_overlap):
+            merged = passage["text"] + other["text"][overlap:]
+        elif overlap := overlap_length(other["text"], passage["text"], self.min_overlap):
+            merged = other["text"] + passage["text"][overlap:]
+        else:
+            return False
+        passage.update(text=merged, rank=min(passage["rank"], other["rank"]),
+                       chunks=passage["chunks"] + other["chunks"])
+        return True
+
+    def mmr(self, passages: list[dict]) -> list[dict]:
+        """Orders passages by maximal marginal relevance, using retrieval rank as relevance."""
+        if not passages:
+            return []
+        worst = max(p["rank"] for p in passages) + 1
+        terms = [set(tokenize(p["text"])) for p in passages]
+        remaining = list(range(len(passages)))
+        selected = []
+        while remaining:
+            def score(i):
+                redundancy = max((_jaccard(terms[i], terms[j]) for j in selected), default=0.0)
+                return self.lambda_mult * (1 - passages[i]["rank"] / worst) - (1 - self.lambda_mult) * redundancy
+            best = max(remaining, key=score)
+            selected.append(best)
+            remaining.remove(best)
+        return [passages[i] for i in selected]
+
+    def pack(self, docs) -> tuple[str, dict]:
+        """Returns the packed context and this turn's token accounting."""
+        raw_tokens = self.count_tokens(SEPARATOR.join(doc.page_content for doc in docs[:self.baseline_chunks]))
+        passages = self.mmr(self.merge_overlapping(docs))
+
+        packed, used = [], 0
+        separator_tokens = self.count_tokens(SEPARATOR)
+        for passage in passages:
+            cost = self.count_tokens(passage["text"]) + (separator_tokens if packed else 0)
+            if used + cost <= self.max_tokens:
+                packed.append(passage["text"])
+                used += cost
+            elif not packed:
+                # Never return nothing: cut the most relevant passage down to the budget
+                packed.append(self._truncate(passage["text"]))
+                used = self.count_tokens(packed[0])
+        context = SEPARATOR.join(packed)
+
+        stats = {
+            "chunks_in": len(docs),
+            "passages": len(packed),
+            "raw_tokens": raw_tokens,
+            "packed_tokens": self.count_tokens(context),
+        }
+        stats["tokens_saved"] = max(0, stats["raw_tokens"] - stats["packed_tokens"])
+        with self._lock:
+            self._stats["turns"] += 1
+            for key in ("raw_tokens", "packed_tokens", "tokens_saved"):
+                self._stats[key] += stats[key]
+        return context, stats
+
+    def _truncate(self, text: str) -> str:
+        """Longest prefix of text within the token budget, measured with count_tokens."""
+        low, high = 0, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.count_tokens(text[:mid]) <= self.max_tokens:
+                low = mid
+            else:
+                high = mid - 1
+        return text[:low]
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["saved_rate"] = stats["tokens_saved"] / stats["raw_tokens"] if stats["raw_tokens"] else 0.0
+        return stats
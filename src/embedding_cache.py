@@ -0,0 +1,247 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from src.lru import LRUCache, normalize_text
+
+
+class EmbeddingCache:
+    """Content-addressed LRU cache of embedding vectors, persisted on disk.
+
+    Keys are a hash of the model name and the chunk text, so identical chunks
+    from any document share one entry. Vectors are stored compactly in a
+    fixed-size memory-mapped .npy array (float16 by default) and an index maps
+    each key to its slot in LRU order. Without a path the cache is in-memory.
+
+    The index is a snapshot (index.json) plus an append-only journal of the
+    slots each batch took, so a batch costs O(batch) I/O; the journal is
+    folded into a new snapshot once it outgrows the index. A reused slot is
+    dropped from the journal before its vector is overwritten, and only
+    mapped to its new key after the vector is flushed, so a crash can lose
+    entries but never serve one key's vector for another.
+    """
+
+    def __init__(self, path: str = None, dim: int = 384, max_entries: int = 50000, dtype: str = "float16"):
+        self.path = path
+        self.dim = dim
+        self.max_entries = max_entries
+        self.dtype = np.dtype(dtype)
+        self._slots = OrderedDict()  # {key: slot}, least recently used first
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0}
+        self._generation = 0  # Of the snapshot; its journal is index.<generation>.log
+        self._journal_records = 0
+        self._vectors = self._open()
+        used = set(self._slots.values())
+        self._free = [slot for slot in range(self.max_entries - 1, -1, -1) if slot not in used]
+
+    @classmethod
+    def from_env(cls, dim: int = 384):
+        return cls(
+            path=os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache") or None,
+            dim=dim,
+            max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", "50000")),
+            dtype=os.getenv("EMBEDDING_CACHE_DTYPE", "float16"),
+        )
+
+    @staticmethod
+    def key(model_name: str, text: str) -> str:
+        return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def _open(self):
+        shape = (self.max_entries, self.dim)
+        if not self.path:
+            return np.zeros(shape, dtype=self.dtype)
+
+        os.makedirs(self.path, exist_ok=True)
+        vectors_path = os.path.join(self.path, "vectors.npy")
+        vectors = None
+        if os.path.exists(vectors_path):
+            try:
+                vectors = np.lib.format.open_memmap(vectors_path, mode="r+")
+                if vectors.shape != shape or vectors.dtype != self.dtype:
+                    vectors = None  # Resized or retyped: start over
+                else:
+                    self._load_index()
+            except (OSError, ValueError):
+                vectors = None
+        if vectors is None:
+            self._slots.clear()
+            vectors = np.lib.format.open_memmap(vectors_path, mode="w+", dtype=self.dtype, shape=shape)
+        return vectors
+
+    def _journal_path(self, generation: int) -> str:
+        return os.path.join(self.path, f"index.{generation}.log")
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.path, "index.json"), "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            snapshot = {"generation": 0, "entries": []}
+        if isinstance(snapshot, list):
+            snapshot = {"generation": 0, "entries": snapshot}  # Written before the journal existed
+        self._generation = snapshot["generation"]
+        owners = {}  # {slot: key}
+        for key, slot in snapshot["entries"]:
+            if 0 <= slot < self.max_entries:
+                self._slots[key] = slot
+                owners[slot] = key
+        try:
+            with open(self._journal_path(self._generation), "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # A line cut short by a crash; nothing after it was written
+                    self._journal_records += 1
+                    slot = record[-1]
+                    if not 0 <= slot < self.max_entries:
+                        continue
+                    previous = owners.pop(slot, None)
+                    if previous is not None:
+                        self._slots.pop(previous, None)
+                    if record[0] == "put":
+                        self._slots.pop(record[1], None)
+                        self._slots[record[1]] = slot
+                        owners[slot] = record[1]
+        except OSError:
+            pass
+
+    def get_many(self, keys: list[str]) -> list:
+        """Returns the cached vector for each key, or None where it is missing."""
+        results = []
+        with self._lock:
+            for key in keys:
+                slot = self._slots.get(key)
+                if slot is None:
+                    self._counters["misses"] += 1
+                    results.append(None)
+                    continue
+                self._slots.move_to_end(key)
+                self._counters["hits"] += 1
+                results.append(self._vectors[slot].astype(np.float32).tolist())
+        return results
+
+    def put_many(self, items):
+        """Stores (key, vector) pairs, evicting the least recently used entries when full."""
+        with self._lock:
+            written, deferred = {}, {}  # {slot: key}, {evicted slot: vector}
+            for key, vector in items:
+                slot = self._slots.get(key)
+                evicted = False
+                if slot is None:
+                    if self._free:
+                        slot = self._free.pop()
+                    else:
+                        _, slot = self._slots.popitem(last=False)
+                        self._counters["evictions"] += 1
+                        evicted = True
+                    self._slots[key] = slot
+                self._slots.move_to_end(key)
+                written[slot] = key
+                if evicted and self.path:
+                    deferred[slot] = vector  # Written once the old key no longer points here
+                else:
+                    self._vectors[slot] = np.asarray(vector, dtype=self.dtype)
+            if not self.path:
+                return
+            if deferred:
+                self._append([["drop", slot] for slot in deferred], sync=True)
+                for slot, vector in deferred.items():
+                    self._vectors[slot] = np.asarray(vector, dtype=self.dtype)
+            self._vectors.flush()
+            self._append([["put", key, slot] for slot, key in written.items()])
+            if self._journal_records > max(1024, 2 * len(self._slots)):
+                self._compact()
+
+    def _append(self, records: list, sync: bool = False):
+        try:
+            with open(self._journal_path(self._generation), "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(record) + "\n" for record in records))
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            self._journal_records += len(records)
+        except OSError as e:
+            print(f"Could not persist embedding cache index: {e}")
+
+    def _compact(self):
+        """Folds the journal into a new snapshot, which starts an empty journal."""
+        index_path = os.path.join(self.path, "index.json")
+        tmp_path = f"{index_path}.tmp"
+        old_journal = self._journal_path(self._generation)
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"generation": self._generation + 1, "entries": list(self._slots.items())}, f)
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            print(f"Could not persist embedding cache index: {e}")
+            return
+        self._generation += 1
+        self._journal_records = 0
+        try:
+            os.remove(old_journal)
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters)
+            stats["size"] = len(self._slots)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an Embeddings model so embed_documents only runs inference for uncached texts."""
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model_name: str):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_name = model_name
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [self.cache.key(self.model_name, text) for text in texts]
+        vectors = self.cache.get_many(keys)
+        missing = {}
+        for key, text, vector in zip(keys, texts, vectors):
+            if vector is None:
+                missing.setdefault(key, text)  # Duplicate chunks are embedded once
+        if missing:
+            computed = dict(zip(missing, self.embeddings.embed_documents(list(missing.values()))))
+            self.cache.put_many(computed.items())
+            vectors = [computed[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embeddings.embed_query(text)
+
+
+class QueryEmbeddingCache(Embeddings):
+    """Wraps an Embeddings model with a bounded in-memory LRU of query vectors.
+
+    Keys are the normalized query text; all-MiniLM-L6-v2 lowercases its input,
+    so case and whitespace variants map to the same vector anyway.
+    """
+
+    def __init__(self, embeddings: Embeddings, max_size: int = None):
+        self.embeddings = embeddings
+        if max_size is None:
+            max_size = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "1024"))
+        self.cache = LRUCache(max_size)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        key = normalize_text(text)
+        vector = self.cache.get(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.cache.set(key, vector)
+        return vector
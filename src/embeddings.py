@@ -0,0 +1,197 @@
+import os
+import json
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_DIM = 384
+MAX_SEQ_LENGTH = 256  # all-MiniLM-L6-v2 truncates here as well
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+ONNX_FILES = {"onnx": "model.onnx", "onnx-int8": "model_int8.onnx"}
+
+
+def _cpu_count() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def onnx_model_dir(model_name: str = EMBEDDING_MODEL) -> str:
+    """Where preload_models.py exports the ONNX models for a sentence-transformers model."""
+    return os.path.join(os.getenv("ONNX_MODEL_DIR", "onnx_models"), model_name.replace("/", "__"))
+
+
+def token_budget_batches(lengths: list[int], max_tokens: int) -> list[list[int]]:
+    """Groups indices by length so each padded batch stays within max_tokens.
+
+    Sorting first means each batch pads to a similar length, so short chunks
+    don't pay for the longest one in the document.
+    """
+    batches, batch, longest = [], [], 0
+    for index in sorted(range(len(lengths)), key=lengths.__getitem__):
+        length = max(lengths[index], 1)
+        if batch and max(longest, length) * (len(batch) + 1) > max_tokens:
+            batches.append(batch)
+            batch, longest = [], 0
+        batch.append(index)
+        longest = max(longest, length)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def mean_pool(hidden: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Sentence-transformers mean pooling followed by L2 normalization."""
+    mask = mask[..., None].astype(hidden.dtype)
+    pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+    return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+
+class OnnxEmbeddings(Embeddings):
+    """all-MiniLM-L6-v2 on ONNX Runtime, optionally int8-quantized.
+
+    Produces the same mean-pooled, normalized vectors as the PyTorch path (the
+    measured cosine agreement is recorded by preload_models.py). Texts are
+    tokenized once, then run in length-sorted batches bounded by a token budget.
+    """
+
+    def __init__(self, model_path: str, tokenizer_path: str, threads: int = None, max_batch_tokens: int = None,
+                 backend: str = "onnx"):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads or int(os.getenv("EMBEDDING_THREADS", "0")) or _cpu_count()
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(MAX_SEQ_LENGTH)
+        self.tokenizer.no_padding()
+        self.max_batch_tokens = max_batch_tokens or int(os.getenv("EMBEDDING_MAX_BATCH_TOKENS", "8192"))
+        self.backend = backend
+
+    @classmethod
+    def load(cls, backend: str = "onnx-int8", model_name: str = EMBEDDING_MODEL, min_cosine: float = None):
+        """Loads the exported model, refusing one whose agreement is unmeasured or below min_cosine."""
+        model_dir = onnx_model_dir(model_name)
+        model_path = os.path.join(model_dir, ONNX_FILES[backend])
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"{model_path} not found; run preload_models.py to export it")
+        if min_cosine is None:
+            min_cosine = float(os.getenv("EMBEDDING_ONNX_MIN_COSINE", "0.99"))
+        try:
+            with open(os.path.join(model_dir, "tolerance.json"), "r", encoding="utf-8") as f:
+                measured = json.load(f).get(backend, {}).get("min_cosine")
+        except (OSError, ValueError):
+            measured = None
+        if measured is None:
+            raise ValueError(f"{backend} export has no recorded agreement with PyTorch; run preload_models.py")
+        if measured < min_cosine:
+            raise ValueError(f"{backend} export agrees with PyTorch to cosine {measured:.4f} < {min_cosine}")
+        return cls(model_path, os.path.join(model_dir, "tokenizer.json"), backend=backend)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        encodings = self.tokenizer.encode_batch(texts)
+        vectors = [None] * len(texts)
+        for batch in token_budget_batches([len(e.ids) for e in encodings], self.max_batch_tokens):
+            width = max(len(encodings[i].ids) for i in batch)
+            input_ids = np.zeros((len(batch), width), dtype=np.int64)
+            attention_mask = np.zeros((len(batch), width), dtype=np.int64)
+            for row, index in enumerate(batch):
+                ids = encodings[index].ids
+                input_ids[row, :len(ids)] = ids
+                attention_mask[row, :len(ids)] = 1
+            feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+            if "token_type_ids" in self.input_names:
+                feeds["token_type_ids"] = np.zeros_like(input_ids)
+            hidden = self.session.run(None, feeds)[0]
+            for index, vector in zip(batch, mean_pool(hidden, attention_mask)):
+                vectors[index] = vector.tolist()
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+def build_embeddings(backend: str = None, model_name: str = EMBEDDING_MODEL) -> Embeddings:
+    """Returns the embedding model for EMBEDDING_BACKEND ("torch", "onnx" or "onnx-int8").
+
+    ONNX backends fall back to PyTorch when onnxruntime is missing, the model
+    hasn't been exported or won't load, or the export is outside the cosine
+    tolerance.
+    """
+    backend = backend or os.getenv("EMBEDDING_BACKEND", "torch")
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown EMBEDDING_BACKEND '{backend}', expected one of {BACKENDS}")
+    if backend != "torch":
+        try:
+            return OnnxEmbeddings.load(backend, model_name)
+        except (ImportError, OSError, ValueError, RuntimeError) as e:
+            print(f"{backend} embeddings unavailable, using PyTorch: {e}")
+
+    from langchain_huggingface import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs={'device': 'cpu'},
+        encode_kwargs={'normalize_embeddings': True}
+    )
+
+
+def cache_model_name(embeddings: Embeddings, model_name: str = EMBEDDING_MODEL) -> str:
+    """Embedding cache namespace for the backend actually serving, so fp32 and int8 vectors never mix."""
+    return f"{model_name}:{getattr(embeddings, 'backend', 'torch')}"
+
+
+def export_onnx(model_name: str = EMBEDDING_MODEL, quantize: bool = True) -> str:
+    """Exports the transformer behind a sentence-transformers model to ONNX (plus an int8 copy)."""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    model_dir = onnx_model_dir(model_name)
+    os.makedirs(model_dir, exist_ok=True)
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer = model[0].auto_model.eval()
+    model.tokenizer.save_pretrained(model_dir)  # Writes tokenizer.json for the fast tokenizer
+
+    sample = model.tokenizer(["hello world"], return_tensors="pt")
+    names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+
+    class Encoder(torch.nn.Module):
+        """Takes positional inputs in a fixed order, independent of the transformer's forward() signature."""
+
+        def __init__(self):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, *inputs):
+            return self.transformer(**dict(zip(names, inputs))).last_hidden_state
+
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    model_path = os.path.join(model_dir, ONNX_FILES["onnx"])
+    with torch.no_grad():
+        torch.onnx.export(
+            Encoder(), tuple(sample[name] for name in names), model_path,
+            input_names=names, output_names=["last_hidden_state"], dynamic_axes=dynamic_axes,
+            opset_version=17, dynamo=False,
+        )
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(model_path, os.path.join(model_dir, ONNX_FILES["onnx-int8"]), weight_type=QuantType.QInt8)
+    return model_dir
+
+
+def measure_tolerance(reference: Embeddings, candidate: Embeddings, texts: list[str]) -> dict:
+    """Cosine agreement between two embedding backends over sample texts."""
+    ref = np.asarray(reference.embed_documents(texts), dtype=np.float32)
+    cand = np.asarray(candidate.embed_documents(texts), dtype=np.float32)
+    cosines = (ref * cand).sum(axis=1) / (np.linalg.norm(ref, axis=1) * np.linalg.norm(cand, axis=1) + 1e-12)
+    return {"min_cosine": float(cosines.min()), "mean_cosine": float(cosines.mean()), "samples": len(texts)}
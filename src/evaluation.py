@@ -0,0 +1,212 @@
+import os
+import re
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import threading
+from langchain_core.messages import HumanMessage, SystemMessage
+
+JUDGE_SYSTEM = (
+    "You are an evaluator. Grade each prediction against its reference answer. For every item reply with "
+    "one line in the format '<item number>. Score: <0-1> Reason: <brief explanation>', in item order."
+)
+VERDICT_PATTERN = re.compile(r"^\s*(\d+)[.):]\s*Score:\s*([01](?:\.\d+)?)\s*(?:Reason:\s*(.*))?$", re.M)
+
+
+def load_dataset(path: str) -> list[dict]:
+    """Examples from a JSONL or JSON list file, as {"question", "reference"}.
+
+    Each record is either {"question", "answer"} or LangSmith-style
+    {"inputs": {"question"}, "outputs": {"answer"}}.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    records = json.loads(text) if text.lstrip().startswith("[") else [
+        json.loads(line) for line in text.splitlines() if line.strip()
+    ]
+    examples = []
+    for record in records:
+        inputs, outputs = record.get("inputs", record), record.get("outputs", record)
+        examples.append({"question": inputs["question"], "reference": outputs["answer"]})
+    return examples
+
+
+def judge_key(question: str, reference: str, prediction: str, model: str = "") -> str:
+    return hashlib.sha256(f"{model}\0{question}\0{reference}\0{prediction}".encode("utf-8")).hexdigest()
+
+
+def judge_prompt(items: list[dict]) -> list:
+    """One judge request grading several items; FakeJudgeModel parses the same layout."""
+    blocks = [f"Item {n}\nQuestion: {item['question']}\nReference: {item['reference']}\nPrediction: {item['prediction']}"
+              for n, item in enumerate(items, start=1)]
+    return [SystemMessage(content=JUDGE_SYSTEM), HumanMessage(content="\n\n".join(blocks))]
+
+
+def parse_verdicts(response: str) -> dict:
+    """{item number: (score, reason)} for every well-formed line of a judge reply."""
+    return {int(n): (float(score), (reason or "").strip()) for n, score, reason in VERDICT_PATTERN.findall(response)}
+
+
+class JudgeCache:
+    """Judge verdicts keyed by a hash of (judge model, question, reference, prediction), persisted on disk.
+
+    Re-running a suite only grades predictions that changed. Verdicts are
+    appended to a JSONL file as they arrive, so an interrupted run keeps the
+    ones it already paid for. Without a path the cache is in-memory.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self._entries = {}  # {key: {"score", "comment"}}
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0}
+        if self.path:
+            self._load()
+
+    @classmethod
+    def from_env(cls):
+        return cls(path=os.getenv("EVAL_JUDGE_CACHE_PATH", "eval_judge_cache.jsonl") or None)
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self._entries[entry["key"]] = {"score": entry["score"], "comment": entry["comment"]}
+                    except (ValueError, KeyError):
+                        continue  # A line cut short by an interrupted run
+        except OSError:
+            return
+
+    def get(self, key: str):
+        with self._lock:
+            verdict = self._entries.get(key)
+            self._counters["hits" if verdict is not None else "misses"] += 1
+            return verdict
+
+    def set(self, key: str, verdict: dict):
+        with self._lock:
+            self._entries[key] = verdict
+            if self.path:
+                try:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps({"key": key, **verdict}) + "\n")
+                except OSError as e:
+                    print(f"Could not persist judge verdict: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters, size=len(self._entries))
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+class EvaluationRunner:
+    """Runs a dataset through the graph with bounded concurrency and grades it with batched, cached judge calls.
+
+    Every example gets a fresh thread_id (deleted from the checkpointer once
+    answered), so examples can't see each other's history. Up to concurrency
+    examples run at once on the graph's async path; predictions missing from
+    the judge cache are graded judge_batch_size per judge call, with the same
+    concurrency limit on judge calls. Predictions the judge still gives no
+    verdict for are ungraded (score None) and counted in the summary.
+    """
+
+    def __init__(self, graph, judge_llm, cache: JudgeCache = None, concurrency: int = 8, judge_batch_size: int = 8,
+                 judge_model: str = ""):
+        self.graph = graph
+        self.judge_llm = judge_llm
+        self.cache = cache if cache is not None else JudgeCache()
+        self.concurrency = max(1, concurrency)
+        self.judge_batch_size = max(1, judge_batch_size)
+        self.judge_model = judge_model  # Part of the cache key, so another judge grades afresh
+        self.judge_calls = 0
+
+    async def _predict(self, example: dict, semaphore: asyncio.Semaphore) -> dict:
+        async with semaphore:
+            thread_id = str(uuid.uuid4())
+            started = time.perf_counter()
+            try:
+                result = await self.graph.ainvoke({"question": example["question"]},
+                                                  {"configurable": {"thread_id": thread_id}})
+                prediction, error = result.get("answer", "No answer produced"), None
+            except Exception as e:
+                prediction, error = "", str(e)
+            finally:
+                await self.graph.checkpointer.adelete_thread(thread_id)
+            return dict(example, prediction=prediction, error=error, seconds=time.perf_counter() - started)
+
+    async def _judge_batch(self, items: list[dict], semaphore: asyncio.Semaphore) -> dict:
+        """{index in items: verdict} for the items the judge graded."""
+        async with semaphore:
+            self.judge_calls += 1
+            try:
+                response = (await self.judge_llm.ainvoke(judge_prompt(items))).content
+            except Exception as e:
+                print(f"Judge call failed: {e}")
+                return {}
+        verdicts = parse_verdicts(response)
+        return {n - 1: {"score": score, "comment": reason} for n, (score, reason) in verdicts.items() if 0 < n <= len(items)}
+
+    async def _judge(self, results: list[dict]):
+        pending = []
+        for result in results:
+            result["judge_key"] = judge_key(result["question"], result["reference"], result["prediction"], self.judge_model)
+            verdict = self.cache.get(result["judge_key"]) if result["error"] is None else None
+            if verdict is not None:
+                result.update(verdict, cached=True)
+            elif result["error"] is None:
+                pending.append(result)
+            else:
+                result.update(score=0.0, comment=f"Error: {result['error']}", cached=False)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        for attempt in range(2):
+            # Items a batched reply skipped or garbled are retried one per call
+            size = self.judge_batch_size if attempt == 0 else 1
+            batches = [pending[i:i + size] for i in range(0, len(pending), size)]
+            graded = await asyncio.gather(*(self._judge_batch(batch, semaphore) for batch in batches))
+            missed = []
+            for batch, verdicts in zip(batches, graded):
+                for index, result in enumerate(batch):
+                    if index in verdicts:
+                        result.update(verdicts[index], cached=False)
+                        self.cache.set(result["judge_key"], verdicts[index])
+                    else:
+                        missed.append(result)
+            pending = missed
+        for result in pending:
+            # Ungraded, not a middling score: left out of the mean and not cached
+            result.update(score=None, comment="Judge gave no parsable verdict", cached=False)
+
+    async def arun(self, examples: list[dict]) -> dict:
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*(self._predict(example, semaphore) for example in examples))
+        predict_seconds = time.perf_counter() - started
+        await self._judge(results)
+        seconds = time.perf_counter() - started
+        for result in results:
+            result.pop("judge_key", None)
+        scores = [result["score"] for result in results if result["score"] is not None]
+        return {
+            "results": results,
+            "summary": {
+                "examples": len(results),
+                "mean_score": sum(scores) / len(scores) if scores else 0.0,  # Over graded examples only
+                "ungraded": len(results) - len(scores),
+                "errors": sum(result["error"] is not None for result in results),
+                "predict_seconds": predict_seconds,
+                "seconds": seconds,
+                "examples_per_sec": len(results) / seconds if seconds else 0.0,
+                "judge_calls": self.judge_calls,
+                "judge_cache": self.cache.stats(),
+            },
+        }
+
+    def run(self, examples: list[dict]) -> dict:
+        return asyncio.run(self.arun(examples))
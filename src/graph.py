@@ -1,15 +1,55 @@
+import os
+import asyncio
+import threading
 from langgraph.graph import StateGraph, END
-from langgraph.checkpoint.memory import MemorySaver
-from src.nodes import AgentState, router_node, weather_node, rag_node, generate_node
+from src.checkpoint import SQLiteCheckpointer
+from src.metrics import graph_metrics
+from src.nodes import (
+    AgentState, router_node, fused_router_node, weather_node, rag_node, generate_node, summarize_node,
+    arouter_node, afused_router_node, aweather_node, arag_node, agenerate_node, asummarize_node, needs_summary,
+)
+
+def _env_flag(name: str) -> bool:
+    return os.getenv(name, "").lower() in ("1", "true", "yes")
+
+def build_graph(fused_routing: bool = None, async_nodes: bool = None, checkpointer=None, metrics=None):
+    """Compiles the agent graph.
+
+    With fused_routing the router also extracts cities in the same LLM call, so
+    weather questions skip the separate extraction round trip. With async_nodes
+    the graph uses the async node variants and is meant to be driven with
+    astream. Both default to the FUSED_ROUTING / ASYNC_GRAPH environment
+    variables so the modes can be A/B tested. The checkpointer defaults to the
+    bounded SQLite one configured by the CHECKPOINT_* environment variables.
+    Unless metrics (default: the process-wide graph_metrics) is disabled, every
+    node is timed and the LLM tokens it uses are counted.
+    """
+    if fused_routing is None:
+        fused_routing = _env_flag("FUSED_ROUTING")
+    if async_nodes is None:
+        async_nodes = _env_flag("ASYNC_GRAPH")
+
+    if async_nodes:
+        router = afused_router_node if fused_routing else arouter_node
+        weather, rag, generate, summarize = aweather_node, arag_node, agenerate_node, asummarize_node
+    else:
+        router = fused_router_node if fused_routing else router_node
+        weather, rag, generate, summarize = weather_node, rag_node, generate_node, summarize_node
+
+    if metrics is None:
+        metrics = graph_metrics
+
+    def node(name, fn, starts_turn=False):
+        return metrics.instrument(name, fn, starts_turn) if metrics.enabled else fn
 
-def build_graph():
     workflow = StateGraph(AgentState)
 
     # Add nodes
-    workflow.add_node("router", router_node)
-    workflow.add_node("weather", weather_node)
-    workflow.add_node("rag", rag_node)
-    workflow.add_node("generate", generate_node)
+    workflow.add_node("router", node("router", router, starts_turn=True))
+    workflow.add_node("weather", node("weather", weather))
+    workflow.add_node("rag", node("rag", rag))
+    workflow.add_node("generate", node("generate", generate))
+    workflow.add_node("summarize", node("summarize", summarize))
 
     # Set entry point
     workflow.set_entry_point("router")
@@ -24,18 +64,67 @@ def build_graph():
         route_decision,
         {
             "weather": "weather",
-            "rag": "rag"
+            "rag": "rag",
+            "busy": "generate",  # The LLM rate limit queue is full: answer with the error
         }
     )
 
     # Add normal edges
     workflow.add_edge("weather", "generate")
     workflow.add_edge("rag", "generate")
-    workflow.add_edge("generate", END)
+    # Only turns that overflow the history window pay for a summary update
+    workflow.add_conditional_edges(
+        "generate",
+        lambda state: "summarize" if needs_summary(state) else "end",
+        {"summarize": "summarize", "end": END}
+    )
+    workflow.add_edge("summarize", END)
+
+    # Add checkpointer for conversation memory: latest checkpoint per thread, idle threads evicted
+    if checkpointer is None:
+        checkpointer = SQLiteCheckpointer.from_env()
+    compiled = workflow.compile(checkpointer=checkpointer)
+    # LLM calls inside a node inherit the graph's callbacks, so tokens are attributed to the node
+    return compiled.with_config(callbacks=[metrics.callback]) if metrics.enabled else compiled
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Process-wide event loop running in a daemon thread, shared by all sessions."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="graph-event-loop", daemon=True).start()
+        return _loop
+
+def stream_graph(graph, inputs: dict, config: dict, **kwargs):
+    """Runs graph.astream on the shared event loop and yields its chunks to the calling thread.
+
+    Every conversation's I/O is multiplexed on the one loop; the caller (e.g. a
+    Streamlit script thread) only waits for the next chunk.
+    """
+    loop = get_event_loop()
+    stream = graph.astream(inputs, config, **kwargs)
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(stream.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        asyncio.run_coroutine_threadsafe(stream.aclose(), loop).result()
 
-    # Add checkpointer for conversation memory
-    memory = MemorySaver()
-    return workflow.compile(checkpointer=memory)
 
+_graph = None
+_graph_lock = threading.Lock()
 
-graph = build_graph()
+def get_graph():
+    """The process-wide graph, compiled (and its checkpoint database opened) on first use rather than on import."""
+    global _graph
+    with _graph_lock:
+        if _graph is None:
+            _graph = build_graph()
+        return _graph
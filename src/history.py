@@ -0,0 +1,84 @@
+import os
+from langchain_core.messages import HumanMessage, SystemMessage, RemoveMessage
+from src.context import estimate_tokens
+
+SUMMARY_SYSTEM = (
+    "You maintain a running summary of a conversation between a user and an assistant that answers weather "
+    "and document questions. Update the summary with the new exchanges. Keep names, cities, documents, "
+    "facts and open questions; drop pleasantries. Reply with the updated summary only, in at most {words} words."
+)
+
+
+class ConversationHistory:
+    """Bounds the history sent with each prompt and folds the rest into a rolling summary.
+
+    The last keep_turns exchanges (a user message and everything after it) are
+    sent verbatim, as long as they fit in max_tokens. Older exchanges are
+    summarized into AgentState["summary"] and removed from the checkpoint. Each
+    fold only sends the previous summary and the newly evicted exchanges, so
+    its cost doesn't grow with the length of the conversation.
+    """
+
+    def __init__(self, keep_turns: int = 4, max_tokens: int = 1500, summary_words: int = 200,
+                 count_tokens=estimate_tokens):
+        self.keep_turns = keep_turns
+        self.max_tokens = max_tokens
+        self.summary_words = summary_words
+        self.count_tokens = count_tokens
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            keep_turns=int(os.getenv("HISTORY_KEEP_TURNS", "4")),
+            max_tokens=int(os.getenv("HISTORY_MAX_TOKENS", "1500")),
+            summary_words=int(os.getenv("HISTORY_SUMMARY_WORDS", "200")),
+        )
+
+    @staticmethod
+    def _turns(messages) -> list[list]:
+        turns = []
+        for message in messages:
+            if isinstance(message, HumanMessage) or not turns:
+                turns.append([])
+            turns[-1].append(message)
+        return turns
+
+    def _split(self, messages) -> tuple[list, list]:
+        """(evicted, kept): the newest turns that fit both limits are kept."""
+        turns = self._turns(messages)
+        kept, used = [], 0
+        for turn in reversed(turns[-self.keep_turns:] if self.keep_turns > 0 else []):
+            cost = sum(self.count_tokens(str(message.content)) for message in turn)
+            if used + cost > self.max_tokens:
+                break
+            kept.insert(0, turn)
+            used += cost
+        evicted = turns[:len(turns) - len(kept)]
+        return [m for turn in evicted for m in turn], [m for turn in kept for m in turn]
+
+    def window(self, messages) -> list:
+        """The recent messages to send verbatim."""
+        return self._split(list(messages))[1]
+
+    def overflow(self, messages) -> list:
+        """The older messages that should be folded into the summary."""
+        return self._split(list(messages))[0]
+
+    def summary_prompt(self, summary: str, evicted: list) -> list:
+        """Messages asking the LLM to extend the previous summary with the evicted exchanges."""
+        lines = []
+        for message in evicted:
+            role = "User" if isinstance(message, HumanMessage) else "Assistant"
+            lines.append(f"{role}: {message.content}")
+        content = f"Current summary:\n{summary or '(empty)'}\n\nNew exchanges:\n" + "\n".join(lines)
+        return [SystemMessage(content=SUMMARY_SYSTEM.format(words=self.summary_words)), HumanMessage(content=content)]
+
+    def fold(self, summary: str, evicted: list) -> dict:
+        """State update storing the new summary and dropping the evicted messages from the checkpoint."""
+        return {"summary": summary, "messages": [RemoveMessage(id=message.id) for message in evicted]}
+
+    @staticmethod
+    def summary_message(summary: str):
+        if not summary:
+            return None
+        return SystemMessage(content=f"Summary of the earlier conversation:\n{summary}")
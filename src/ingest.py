@@ -0,0 +1,247 @@
+import os
+import time
+import uuid
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from pypdf import PdfReader
+from qdrant_client.models import PointStruct
+
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+
+def _cpu_count() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def parse_page_range(file_path: str, start: int, stop: int, chunk_size: int = CHUNK_SIZE,
+                     chunk_overlap: int = CHUNK_OVERLAP) -> list[tuple[str, dict]]:
+    """Extracts and splits pages [start, stop) into (text, metadata) chunks.
+
+    Runs in a worker process, so it only returns plain picklable data. Metadata
+    matches what PyPDFLoader puts on each page.
+    """
+    reader = PdfReader(file_path)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    total_pages = len(reader.pages)
+    chunks = []
+    for page in range(start, stop):
+        text = reader.pages[page].extract_text() or ""
+        metadata = {"source": file_path, "total_pages": total_pages, "page": page}
+        chunks.extend((chunk, dict(metadata)) for chunk in splitter.split_text(text))
+    return chunks
+
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+def get_parse_pool(max_workers: int) -> ProcessPoolExecutor:
+    """Process-wide pool for PDF parsing, created on first use and reused across ingests.
+
+    Workers are spawned rather than forked so they don't inherit the torch
+    thread pools of the embedding model.
+    """
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return _parse_pool
+
+
+def stable_point_ids(seed: str):
+    """Point ID function giving the n-th chunk of a page the same ID on every run.
+
+    A resumed ingest re-upserting a window that was cut short overwrites
+    those points instead of duplicating them. Chunks must arrive in page order.
+    """
+    counts = {}
+
+    def point_id(doc: Document) -> str:
+        page = doc.metadata.get("page", 0)
+        counts[page] = counts.get(page, -1) + 1
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{seed}:{page}:{counts[page]}"))
+    return point_id
+
+
+class IngestPipeline:
+    """Parses, embeds and upserts a PDF with the three stages overlapped.
+
+    Pages are parsed and split in a process pool (large PDFs only; small ones
+    are cheaper in-process). Chunks are embedded in batches sized to the
+    available cores, and each batch is upserted to Qdrant on a background
+    thread while the next one is embedding.
+
+    With window_pages set (INGEST_WINDOW_PAGES, default 32), the PDF is
+    streamed through in windows of that many pages, parsing the next window
+    while this one embeds, so peak memory holds about two windows of chunks
+    whatever the document's size. on_window is called once a window is fully
+    stored, and start_page resumes after the last stored window.
+    """
+
+    def __init__(self, client, collection_name: str, embeddings, content_key: str = "page_content",
+                 metadata_key: str = "metadata", chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP,
+                 embed_batch_size: int = None, parse_workers: int = None, min_parallel_pages: int = None,
+                 window_pages: int = None):
+        cores = _cpu_count()
+        self.client = client
+        self.collection_name = collection_name
+        self.embeddings = embeddings
+        self.content_key = content_key
+        self.metadata_key = metadata_key
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.embed_batch_size = embed_batch_size or int(os.getenv("INGEST_EMBED_BATCH_SIZE", "0")) or 32 * min(cores, 8)
+        self.parse_workers = parse_workers or int(os.getenv("INGEST_PARSE_WORKERS", "0")) or cores
+        if min_parallel_pages is None:
+            min_parallel_pages = int(os.getenv("INGEST_MIN_PARALLEL_PAGES", "32"))
+        self.min_parallel_pages = min_parallel_pages
+        if window_pages is None:
+            window_pages = int(os.getenv("INGEST_WINDOW_PAGES", "32"))
+        self.window_pages = window_pages  # 0 parses the whole PDF in one go
+
+    def iter_chunks(self, file_path: str, extra_metadata: dict = None, total_pages: int = None):
+        """Yields chunk Documents in page order, parsing in worker processes for large PDFs."""
+        if total_pages is None:
+            total_pages = len(PdfReader(file_path).pages)
+        if total_pages < self.min_parallel_pages or self.parse_workers <= 1:
+            results = (parse_page_range(file_path, 0, total_pages, self.chunk_size, self.chunk_overlap),)
+        else:
+            # A few ranges per worker keeps them busy when page costs are uneven
+            step = max(1, -(-total_pages // (self.parse_workers * 4)))
+            ranges = [(start, min(start + step, total_pages)) for start in range(0, total_pages, step)]
+            pool = get_parse_pool(self.parse_workers)
+            results = pool.map(
+                parse_page_range,
+                *zip(*[(file_path, start, stop, self.chunk_size, self.chunk_overlap) for start, stop in ranges]),
+            )
+        # map() yields in submission order, so embedding starts as soon as the first range is parsed
+        for chunks in results:
+            for text, metadata in chunks:
+                metadata.update(extra_metadata or {})
+                yield Document(page_content=text, metadata=metadata)
+
+    def iter_windows(self, file_path: str, total_pages: int, start_page: int = 0):
+        """Yields (start, stop, chunks) for each window of pages from start_page on, in order.
+
+        For large PDFs the next window is parsed in the process pool while the
+        caller embeds this one; at most two windows are held at once.
+        """
+        windows = [(start, min(start + self.window_pages, total_pages))
+                   for start in range(start_page, total_pages, self.window_pages)]
+        parallel = total_pages >= self.min_parallel_pages and self.parse_workers > 1
+
+        def submit(start, stop):
+            pool = get_parse_pool(self.parse_workers)
+            step = max(1, -(-(stop - start) // self.parse_workers))
+            return [pool.submit(parse_page_range, file_path, page, min(page + step, stop), self.chunk_size,
+                                self.chunk_overlap) for page in range(start, stop, step)]
+
+        pending = submit(*windows[0]) if parallel and windows else None
+        for n, (start, stop) in enumerate(windows):
+            if parallel:
+                futures = pending
+                pending = submit(*windows[n + 1]) if n + 1 < len(windows) else None
+                chunks = [chunk for future in futures for chunk in future.result()]
+            else:
+                chunks = parse_page_range(file_path, start, stop, self.chunk_size, self.chunk_overlap)
+            yield start, stop, chunks
+
+    def ingest(self, file_path: str, extra_metadata: dict = None, on_batch=None, on_window=None, start_page: int = 0,
+               point_id=None) -> dict:
+        """Ingests a PDF and returns throughput stats plus the upserted point IDs.
+
+        on_window(pages_done, total_pages, point_ids) is called after each
+        stored window (streaming only). point_id(doc) overrides the random IDs,
+        e.g. stable_point_ids() so a resumed ingest can overwrite a cut-short window.
+        """
+        started = time.perf_counter()
+        total_pages = len(PdfReader(file_path).pages)
+        if self.window_pages <= 0:
+            start_page = 0  # Nothing to resume from without windows
+            stats = self.upsert_documents(self.iter_chunks(file_path, extra_metadata, total_pages), on_batch, point_id)
+            stats["windows"] = 1
+        else:
+            stats = {"chunks": 0, "batches": 0, "embed_seconds": 0.0, "upsert_seconds": 0.0, "point_ids": [],
+                     "windows": 0, "max_window_chunks": 0}
+            for start, stop, chunks in self.iter_windows(file_path, total_pages, start_page):
+                documents = [Document(page_content=text, metadata={**metadata, **(extra_metadata or {})})
+                             for text, metadata in chunks]
+                del chunks  # Only the Documents stay alive while the window embeds
+                window = self.upsert_documents(documents, on_batch, point_id)
+                for key in ("chunks", "batches", "embed_seconds", "upsert_seconds", "point_ids"):
+                    stats[key] += window[key]
+                stats["windows"] += 1
+                stats["max_window_chunks"] = max(stats["max_window_chunks"], window["chunks"])
+                if on_window is not None:
+                    on_window(stop, total_pages, window["point_ids"])
+        stats["pages"] = total_pages - start_page
+        stats["total_pages"] = total_pages
+        stats["seconds"] = time.perf_counter() - started
+        stats["pages_per_sec"] = stats["pages"] / stats["seconds"] if stats["seconds"] else 0.0
+        stats["chunks_per_sec"] = stats["chunks"] / stats["seconds"] if stats["seconds"] else 0.0
+        return stats
+
+    def upsert_documents(self, documents, on_batch=None, point_id=None) -> dict:
+        """Embeds and upserts documents in batches, overlapping each upsert with the next embed.
+
+        on_batch, if given, is called with each batch of points once Qdrant has stored it.
+        """
+        stats = {"chunks": 0, "batches": 0, "embed_seconds": 0.0, "upsert_seconds": 0.0, "point_ids": []}
+        pending = None
+
+        def settle():
+            nonlocal pending
+            (future, points), pending = pending, None
+            stats["upsert_seconds"] += future.result()
+            if on_batch is not None:
+                on_batch(points)
+
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="qdrant-upsert") as upserter:
+            try:
+                for batch in self._batches(documents):
+                    embed_started = time.perf_counter()
+                    vectors = self.embeddings.embed_documents([doc.page_content for doc in batch])
+                    stats["embed_seconds"] += time.perf_counter() - embed_started
+
+                    points = [
+                        PointStruct(
+                            # Strings are the form Qdrant returns, so IDs compare equal
+                            id=point_id(doc) if point_id is not None else str(uuid.uuid4()),
+                            vector=vector,
+                            payload={self.content_key: doc.page_content, self.metadata_key: doc.metadata},
+                        )
+                        for doc, vector in zip(batch, vectors)
+                    ]
+                    # One upsert in flight bounds memory to about two batches
+                    if pending is not None:
+                        settle()
+                    pending = (upserter.submit(self._upsert, points), points)
+                    stats["point_ids"].extend(point.id for point in points)
+                    stats["chunks"] += len(points)
+                    stats["batches"] += 1
+            finally:
+                # A batch upserted before a later one failed is reported too, or on_batch would miss stored points
+                if pending is not None:
+                    settle()
+        return stats
+
+    def _batches(self, documents):
+        batch = []
+        for doc in documents:
+            batch.append(doc)
+            if len(batch) >= self.embed_batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _upsert(self, points: list) -> float:
+        started = time.perf_counter()
+        self.client.upsert(collection_name=self.collection_name, points=points, wait=True)
+        return time.perf_counter() - started
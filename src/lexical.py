@@ -0,0 +1,264 @@
+import os
+import re
+import json
+import math
+import heapq
+import threading
+from collections import Counter
+
+# Keeps part numbers, versions and acronyms ("AB-1234", "v2.3", "RS485") as single tokens
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+
+# Function words that match most chunks, so they add scoring work without ranking signal
+STOPWORDS = frozenset(
+    "a about an and any are as at be but by can could did do does for from had has have how i if in into is it its "
+    "me my no not of on or our so than that the their them then there these they this to was we were what when "
+    "where which who why will with would you your".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def reciprocal_rank_fusion(rankings: list[list], k: int = 60) -> list:
+    """Fuses ranked lists of IDs: each ID scores sum(1 / (k + rank)) over the lists it appears in."""
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class BM25Index:
+    """Incremental in-memory BM25 inverted index over chunk texts, keyed by Qdrant point ID.
+
+    Chunks are grouped by (tenant, content hash) so a whole document of one
+    tenant can be dropped at once. Searches only touch the postings of the
+    discriminating query terms, so cost scales with term frequency rather than
+    corpus size. The index is
+    saved as a JSON snapshot plus an append-only log of the chunks added and
+    documents removed since, so save() costs O(change); the log is folded into
+    a new snapshot once it outgrows the index. It can also be rebuilt from the
+    chunk texts stored in Qdrant.
+    """
+
+    def __init__(self, path: str = None, k1: float = 1.5, b: float = 0.75, min_idf: float = 0.1):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.min_idf = min_idf  # Terms in more than ~90% of chunks are skipped
+        self._reset()
+        self._pending = []  # Log records not yet saved
+        self._log_records = 0
+        self._lock = threading.RLock()
+        if self.path:
+            self._load()
+
+    @classmethod
+    def from_env(cls):
+        return cls(path=os.getenv("LEXICAL_INDEX_PATH", "lexical_index.json") or None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._docs)
+
+    def _reset(self):
+        self._postings = {}  # {term: {point_id: term frequency}}
+        self._docs = {}  # {point_id: (group, length, terms)}
+        self._groups = {}  # {(tenant, content_hash): set of point_ids}
+        self._total_length = 0
+        self._min_length = math.inf  # Not raised by removals, so only ever a lower bound
+
+    def add(self, point_id, text: str, group: tuple):
+        with self._lock:
+            if point_id in self._docs:
+                self._remove(point_id)
+            counts = Counter(tokenize(text))
+            self._index(point_id, group, counts)
+            if self.path:
+                self._pending.append(["add", point_id, group, dict(counts)])
+
+    def _remove(self, point_id):
+        group, length, terms = self._docs.pop(point_id)
+        for term in terms:
+            postings = self._postings[term]
+            del postings[point_id]
+            if not postings:
+                del self._postings[term]
+        self._groups[group].discard(point_id)
+        if not self._groups[group]:
+            del self._groups[group]
+        self._total_length -= length
+
+    def remove_groups(self, groups):
+        """Drops every chunk of the given documents."""
+        with self._lock:
+            for group in groups:
+                for point_id in list(self._groups.get(group, ())):
+                    self._remove(point_id)
+                if self.path:
+                    self._pending.append(["remove", group])
+
+    def search(self, query: str, k: int = 5) -> list[tuple]:
+        """Returns the top-k (point_id, score) pairs by BM25.
+
+        Stopwords and terms with an idf below min_idf are skipped. The rest are
+        scored rarest first, and once the terms left could not lift an unseen
+        chunk into the top k, only the chunks that still can are updated
+        (max-score pruning). Scoring runs outside the lock on copies of the
+        query terms' postings, so searches don't hold up ingestion.
+        """
+        with self._lock:
+            count = len(self._docs)
+            if not count:
+                return []
+            avg_length = self._total_length / count
+            min_length = self._min_length
+            docs = self._docs
+            terms = []
+            for term in set(tokenize(query)) - STOPWORDS:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                if idf >= self.min_idf:
+                    terms.append((idf, postings.copy()))
+
+        k1, base, slope = self.k1, self.k1 * (1 - self.b), self.k1 * self.b / avg_length
+        terms.sort(key=lambda term: term[0], reverse=True)
+        # Upper bound on what each term can add: its highest tf in the shortest chunk
+        remaining = []
+        for idf, postings in terms:
+            max_tf = max(postings.values())
+            remaining.append(idf * max_tf * (k1 + 1) / (max_tf + base + slope * min_length))
+        for n in range(len(remaining) - 2, -1, -1):
+            remaining[n] += remaining[n + 1]
+        scores, pruned = {}, False
+        for n, (idf, postings) in enumerate(terms):
+            if len(scores) >= k:
+                threshold = heapq.nlargest(k, scores.values())[-1]
+                if remaining[n] < threshold:
+                    # Unseen chunks can no longer reach the top k, nor can scored ones this far behind
+                    scores = {point_id: score for point_id, score in scores.items() if score + remaining[n] >= threshold}
+                    pruned = True
+            weight = idf * (k1 + 1)
+            for point_id in scores.keys() & postings.keys() if pruned else postings:
+                doc = docs.get(point_id)
+                if doc is None:
+                    continue  # Removed since the snapshot
+                tf = postings[point_id]
+                scores[point_id] = scores.get(point_id, 0.0) + weight * tf / (tf + base + slope * doc[1])
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def needs_rebuild(self, point_count: int) -> bool:
+        return len(self) != point_count
+
+    def rebuild(self, client, collection_name: str, content_key: str = "page_content",
+                metadata_key: str = "metadata", scroll_filter=None, batch_size: int = 512):
+        """Re-indexes every chunk text stored in the collection."""
+        with self._lock:
+            self._reset()
+            offset = None
+            while True:
+                points, offset = client.scroll(
+                    collection_name=collection_name, scroll_filter=scroll_filter, limit=batch_size, offset=offset,
+                    with_payload=[content_key, f"{metadata_key}.source_file", f"{metadata_key}.content_hash",
+                                  f"{metadata_key}.tenant"],
+                    with_vectors=False,
+                )
+                for point in points:
+                    payload = point.payload or {}
+                    metadata = payload.get(metadata_key) or {}
+                    group = (metadata.get("tenant") or "",
+                             metadata.get("content_hash") or f"name:{metadata.get('source_file')}")
+                    self.add(point.id, payload.get(content_key) or "", group)
+                if offset is None:
+                    break
+            self._compact()
+
+    @property
+    def _log_path(self) -> str:
+        return f"{self.path}.log"
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                docs = json.load(f)
+        except (OSError, ValueError):
+            docs = []
+        for point_id, group, counts in docs:
+            if not isinstance(group, list):
+                return self._discard()
+            self._index(point_id, tuple(group), counts)
+        # Replaying records already in the snapshot (a crash mid-compaction) ends in the same state
+        try:
+            with open(self._log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # A line cut short by a crash
+                    self._log_records += 1
+                    if not isinstance(record[2 if record[0] == "add" else 1], list):
+                        return self._discard()
+                    if record[0] == "add":
+                        if record[1] in self._docs:
+                            self._remove(record[1])
+                        self._index(record[1], tuple(record[2]), record[3])
+                    else:
+                        for point_id in list(self._groups.get(tuple(record[1]), ())):
+                            self._remove(point_id)
+        except OSError:
+            pass
+
+    def _discard(self):
+        """Empties an index saved before groups were scoped by tenant; the count check at startup rebuilds it."""
+        self._reset()
+        self._compact()
+
+    def _index(self, point_id, group: tuple, counts: dict):
+        for term, tf in counts.items():
+            self._postings.setdefault(term, {})[point_id] = tf
+        length = sum(counts.values())
+        self._docs[point_id] = (group, length, list(counts))
+        self._groups.setdefault(group, set()).add(point_id)
+        self._total_length += length
+        self._min_length = min(self._min_length, length)
+
+    def save(self):
+        """Appends the changes since the last save to the log."""
+        if not self.path:
+            return
+        with self._lock:
+            records, self._pending = self._pending, []
+            if not records:
+                return
+            try:
+                with open(self._log_path, "a", encoding="utf-8") as f:
+                    f.write("".join(json.dumps(record) + "\n" for record in records))
+                self._log_records += len(records)
+            except OSError as e:
+                print(f"Could not persist lexical index: {e}")
+            if self._log_records > max(1024, len(self._docs)):
+                self._compact()
+
+    def _compact(self):
+        """Writes the whole index as a new snapshot and empties the log."""
+        if not self.path:
+            return
+        with self._lock:
+            docs = [
+                [point_id, group, {term: self._postings[term][point_id] for term in terms}]
+                for point_id, (group, _, terms) in self._docs.items()
+            ]
+            tmp_path = f"{self.path}.tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(docs, f)
+                os.replace(tmp_path, self.path)
+                open(self._log_path, "w").close()
+            except OSError as e:
+                print(f"Could not persist lexical index: {e}")
+                return
+            self._pending, self._log_records = [], 0
@@ -0,0 +1,129 @@
+import os
+import asyncio
+import threading
+import weakref
+from collections import OrderedDict
+import httpx
+from langchain_groq import ChatGroq
+from src.outbound import ProviderRateLimiter, api_key_id, outbound
+
+DEFAULT_MODEL = "llama-3.3-70b-versatile"
+
+
+class LLMClientRegistry:
+    """Process-wide cache of ChatGroq clients sharing one pooled keep-alive HTTP transport.
+
+    Clients are keyed by (api_key, model) so each Streamlit session reuses the
+    same instance, and every instance shares the same connection pool. Async
+    clients get one pool per event loop, since connections can't cross loops.
+    """
+
+    def __init__(self, max_connections: int = None, max_keepalive_connections: int = None,
+                 keepalive_expiry: float = None, max_clients: int = 64):
+        self.limits = httpx.Limits(
+            max_connections=max_connections or int(os.getenv("LLM_MAX_CONNECTIONS", "20")),
+            max_keepalive_connections=max_keepalive_connections or int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "10")),
+            keepalive_expiry=keepalive_expiry or float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60")),
+        )
+        self.max_clients = max_clients
+        self._clients = OrderedDict()  # {(api_key, model): ChatGroq}
+        self._http_client = None
+        self._async_clients = weakref.WeakKeyDictionary()  # {event loop: OrderedDict of ChatGroq}
+        self._async_http_clients = weakref.WeakKeyDictionary()  # {event loop: httpx.AsyncClient}
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "connections_opened": 0}
+
+    def _trace(self, event_name: str, info: dict):
+        # httpcore only emits connect events when the pool has no idle connection to reuse
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self._stats["connections_opened"] += 1
+
+    def _on_request(self, request: httpx.Request):
+        with self._lock:
+            self._stats["requests"] += 1
+        request.extensions["trace"] = self._trace
+
+    async def _atrace(self, event_name: str, info: dict):
+        self._trace(event_name, info)
+
+    async def _aon_request(self, request: httpx.Request):
+        with self._lock:
+            self._stats["requests"] += 1
+        request.extensions["trace"] = self._atrace
+
+    @property
+    def http_client(self) -> httpx.Client:
+        """The shared pooled HTTP client, created on first use."""
+        with self._lock:
+            if self._http_client is None:
+                self._http_client = httpx.Client(
+                    verify=False,
+                    limits=self.limits,
+                    event_hooks={"request": [self._on_request]},
+                )
+            return self._http_client
+
+    def _build(self, api_key: str, model: str, http_async_client: httpx.AsyncClient = None) -> ChatGroq:
+        # Clients of one API key queue on its Groq token bucket; the SDK retries 429s with jittered backoff
+        provider = outbound("groq", api_key_id(api_key))
+        return ChatGroq(
+            model=model,
+            temperature=0,
+            api_key=api_key,
+            http_client=self.http_client,
+            http_async_client=http_async_client,
+            streaming=True,
+            rate_limiter=ProviderRateLimiter(provider),
+            max_retries=provider.max_retries,
+        )
+
+    def _remember(self, clients: OrderedDict, key: tuple, llm: ChatGroq) -> ChatGroq:
+        with self._lock:
+            # Another thread may have raced us; keep the first instance
+            llm = clients.setdefault(key, llm)
+            clients.move_to_end(key)
+            while len(clients) > self.max_clients:
+                clients.popitem(last=False)
+            return llm
+
+    def get(self, api_key: str, model: str = DEFAULT_MODEL) -> ChatGroq:
+        """Returns the cached client for this key and model, building it on first use."""
+        key = (api_key, model)
+        with self._lock:
+            llm = self._clients.get(key)
+            if llm is not None:
+                self._clients.move_to_end(key)
+                return llm
+        return self._remember(self._clients, key, self._build(api_key, model))
+
+    def get_async(self, api_key: str, model: str = DEFAULT_MODEL) -> ChatGroq:
+        """Like get(), but the async HTTP pool is bound to the running event loop."""
+        loop = asyncio.get_running_loop()
+        key = (api_key, model)
+        with self._lock:
+            clients = self._async_clients.setdefault(loop, OrderedDict())
+            llm = clients.get(key)
+            if llm is not None:
+                clients.move_to_end(key)
+                return llm
+            http_async_client = self._async_http_clients.get(loop)
+            if http_async_client is None:
+                http_async_client = httpx.AsyncClient(
+                    verify=False,
+                    limits=self.limits,
+                    event_hooks={"request": [self._aon_request]},
+                )
+                self._async_http_clients[loop] = http_async_client
+        return self._remember(clients, key, self._build(api_key, model, http_async_client))
+
+    def stats(self) -> dict:
+        """Returns client count and connection pool reuse counters."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["clients"] = len(self._clients) + sum(len(clients) for clients in self._async_clients.values())
+        stats["connections_reused"] = max(stats["requests"] - stats["connections_opened"], 0)
+        return stats
+
+
+llm_registry = LLMClientRegistry()
@@ -0,0 +1,253 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+
+def file_sha256(file_path: str) -> str:
+    """Hex SHA-256 of a file's bytes, read in blocks."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DocumentManifest:
+    """Persistent record of ingested documents keyed by file content hash.
+
+    Each entry holds the filenames it was uploaded under, its chunk count and
+    its Qdrant point IDs, so a byte-identical upload under any name becomes an
+    alias instead of a re-ingest. The JSON file is only a fast path: the
+    manifest can be rebuilt from the source_file/content_hash payloads stored
+    with every point.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self._entries = {}  # {content_hash: {"filenames": [...], "chunks": int, "point_ids": [...]}}
+        self._aliases = {}  # {filename: content_hash}
+        self._lock = threading.Lock()
+        if self.path:
+            self._load()
+
+    @classmethod
+    def from_env(cls):
+        return cls(path=os.getenv("DOCUMENT_MANIFEST_PATH", "document_manifest.json") or None)
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        self._set_entries(entries)
+
+    def _set_entries(self, entries: dict):
+        self._entries = entries
+        self._aliases = {name: content_hash for content_hash, entry in entries.items() for name in entry["filenames"]}
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not persist document manifest: {e}")
+
+    def filenames(self) -> list[str]:
+        with self._lock:
+            return list(self._aliases)
+
+    def hash_for(self, filename: str):
+        with self._lock:
+            return self._aliases.get(filename)
+
+    def get(self, content_hash: str):
+        with self._lock:
+            entry = self._entries.get(content_hash)
+            return dict(entry) if entry is not None else None
+
+    def total_chunks(self) -> int:
+        with self._lock:
+            return sum(entry["chunks"] for entry in self._entries.values())
+
+    def add(self, content_hash: str, filename: str, chunks: int, point_ids: list):
+        """Records a newly ingested document."""
+        with self._lock:
+            self._entries[content_hash] = {"filenames": [filename], "chunks": chunks, "point_ids": list(point_ids)}
+            self._aliases[filename] = content_hash
+            self._save()
+
+    def add_alias(self, content_hash: str, filename: str):
+        """Records another filename for an already ingested document."""
+        with self._lock:
+            self._entries[content_hash]["filenames"].append(filename)
+            self._aliases[filename] = content_hash
+            self._save()
+
+    def orphans(self, filenames: list[str]) -> dict:
+        """Entries that would have no names left once these filenames are removed, by content hash."""
+        names = set(filenames)
+        with self._lock:
+            hashes = {self._aliases[name] for name in names if name in self._aliases}
+            return {
+                content_hash: dict(self._entries[content_hash])
+                for content_hash in hashes
+                if names.issuperset(self._entries[content_hash]["filenames"])
+            }
+
+    def remove_many(self, filenames: list[str]):
+        """Drops filenames, and any entry left with no names."""
+        with self._lock:
+            for filename in filenames:
+                content_hash = self._aliases.pop(filename, None)
+                if content_hash is None:
+                    continue
+                entry = self._entries[content_hash]
+                entry["filenames"].remove(filename)
+                if not entry["filenames"]:
+                    del self._entries[content_hash]
+            self._save()
+
+    def needs_rebuild(self, point_count: int) -> bool:
+        """True when the manifest doesn't account for exactly the points in the collection."""
+        return self.total_chunks() != point_count
+
+    def rebuild(self, client, collection_name: str, metadata_key: str = "metadata", scroll_filter=None,
+                batch_size: int = 1024):
+        """Rebuilds the manifest from point payloads, fetching only the two fields it needs.
+
+        Aliases that never made it into a payload are lost; points ingested
+        before content hashes were recorded are keyed by filename instead.
+        """
+        fields = [f"{metadata_key}.source_file", f"{metadata_key}.content_hash"]
+        entries = {}
+        offset = None
+        while True:
+            points, offset = client.scroll(
+                collection_name=collection_name, scroll_filter=scroll_filter, limit=batch_size, offset=offset,
+                with_payload=fields, with_vectors=False,
+            )
+            for point in points:
+                metadata = (point.payload or {}).get(metadata_key) or {}
+                filename = metadata.get("source_file")
+                if filename is None:
+                    continue
+                content_hash = metadata.get("content_hash") or f"name:{filename}"
+                entry = entries.setdefault(content_hash, {"filenames": [], "chunks": 0, "point_ids": []})
+                if filename not in entry["filenames"]:
+                    entry["filenames"].append(filename)
+                entry["chunks"] += 1
+                entry["point_ids"].append(point.id)
+            if offset is None:
+                break
+
+        with self._lock:
+            # Keep aliases we still know about for documents that survived
+            for content_hash, entry in entries.items():
+                known = self._entries.get(content_hash)
+                if known:
+                    entry["filenames"] += [name for name in known["filenames"] if name not in entry["filenames"]]
+            self._set_entries(entries)
+            self._save()
+
+
+class IngestCheckpoints:
+    """Progress of streaming ingests that haven't finished, keyed by file content hash.
+
+    Each entry holds the filename the ingest started under, the pages stored
+    so far and one [start page, stop page, chunks] range per committed window,
+    saved after every window. Point IDs aren't kept: they are stable per page,
+    so the finished document's IDs are read back from Qdrant. An ingest that
+    was interrupted resumes from pages_done when the same file is uploaded
+    again; finish() drops the entry once the document is in the manifest.
+    Each entry also records when it last made progress, so ingests that were
+    abandoned can be found with stale(). Without a path the checkpoints are
+    in-memory.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self._entries = {}  # {content_hash: {"filename", "pages_done", "total_pages", "chunks", "windows", "updated"}}
+        self._lock = threading.Lock()
+        if self.path:
+            self._load()
+
+    @classmethod
+    def from_env(cls):
+        return cls(path=os.getenv("INGEST_CHECKPOINT_PATH", "ingest_checkpoints.json") or None)
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        for entry in self._entries.values():
+            # Checkpoints written before windows were recorded kept every point ID instead
+            if "windows" not in entry:
+                entry.pop("point_ids", None)
+                entry["windows"] = [[0, entry["pages_done"], entry["chunks"]]] if entry["pages_done"] else []
+            entry.setdefault("updated", 0.0)  # Unknown, so stale
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not persist ingest checkpoints: {e}")
+
+    @staticmethod
+    def _copy(entry: dict) -> dict:
+        return dict(entry, windows=[list(window) for window in entry["windows"]])
+
+    def get(self, content_hash: str):
+        with self._lock:
+            entry = self._entries.get(content_hash)
+            return self._copy(entry) if entry is not None else None
+
+    def pending(self) -> dict:
+        """{content_hash: entry} of every unfinished ingest."""
+        with self._lock:
+            return {content_hash: self._copy(entry) for content_hash, entry in self._entries.items()}
+
+    def stale(self, max_age: float) -> list[str]:
+        """Content hashes of ingests that made no progress for max_age seconds."""
+        cutoff = time.time() - max_age
+        with self._lock:
+            return [content_hash for content_hash, entry in self._entries.items() if entry["updated"] < cutoff]
+
+    def start(self, content_hash: str, filename: str) -> dict:
+        """The checkpoint to resume from, created empty for a new ingest."""
+        with self._lock:
+            if content_hash not in self._entries:
+                self._entries[content_hash] = {"filename": filename, "pages_done": 0, "total_pages": None,
+                                               "chunks": 0, "windows": [], "updated": time.time()}
+                self._save()
+            return self._copy(self._entries[content_hash])
+
+    def commit(self, content_hash: str, pages_done: int, total_pages: int, chunks: int) -> int:
+        """Records a stored window of pages and its chunk count; returns the chunks stored so far."""
+        with self._lock:
+            entry = self._entries[content_hash]
+            entry["windows"].append([entry["pages_done"], pages_done, chunks])
+            entry["pages_done"] = pages_done
+            entry["total_pages"] = total_pages
+            entry["chunks"] += chunks
+            entry["updated"] = time.time()
+            self._save()
+            return entry["chunks"]
+
+    def finish(self, content_hash: str):
+        with self._lock:
+            if self._entries.pop(content_hash, None) is not None:
+                self._save()
@@ -0,0 +1,265 @@
+import os
+import json
+import asyncio
+import time
+import threading
+import contextvars
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from langchain_core.callbacks import BaseCallbackHandler
+from src.context import estimate_tokens
+from src.lru import LRUCache
+
+# Upper bounds (seconds) of the node duration histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# (node name, this turn's record of the node, GraphMetrics) while a node runs; set per task/thread by instrument()
+_current = contextvars.ContextVar("graph_node", default=None)
+
+
+def record_event(event: str, n: int = 1):
+    """Counts an event (cache hit, retrieved chunks, ...) against the node currently running.
+
+    A no-op outside an instrumented node, so components can call it unconditionally.
+    """
+    current = _current.get()
+    if current is not None:
+        current[2]._add(current[0], current[1], event, n)
+
+
+class _TokenCallback(BaseCallbackHandler):
+    """Adds LLM prompt/completion tokens to the node the call was made from."""
+
+    run_inline = True  # Called on the calling task, so _current still names the node
+
+    def __init__(self):
+        self._prompts = {}  # {run_id: estimated prompt tokens}, used when the provider reports no usage
+
+    @property
+    def ignore_chain(self) -> bool:
+        return True
+
+    @property
+    def ignore_retriever(self) -> bool:
+        return True
+
+    @property
+    def ignore_agent(self) -> bool:
+        return True
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        if _current.get() is not None:
+            self._prompts[run_id] = sum(estimate_tokens(str(m.content)) for batch in messages for m in batch)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        estimate = self._prompts.pop(run_id, None)
+        current = _current.get()
+        if current is None:
+            return
+        prompt = completion = 0
+        for generation in (response.generations[0] if response.generations else []):
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                prompt += usage.get("input_tokens", 0)
+                completion += usage.get("output_tokens", 0)
+            else:
+                prompt += estimate or 0
+                completion += estimate_tokens(generation.text)
+        name, record, metrics = current
+        metrics._add(name, record, "prompt_tokens", prompt)
+        metrics._add(name, record, "completion_tokens", completion)
+        metrics._add(name, record, "llm_calls", 1)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._prompts.pop(run_id, None)
+
+
+class GraphMetrics:
+    """Per-node wall time, LLM tokens and component events for the compiled graph.
+
+    build_graph() wraps every node with instrument(), which times it and makes
+    it the target of record_event() calls and of the LLM token callback for the
+    duration of the call. Totals are kept as a duration histogram and counters
+    per node, exported as Prometheus text or JSON (served on METRICS_PORT when
+    set); each thread's latest turn is kept for the per-turn breakdown in the
+    UI. Recording is a dict update under a lock, cheap enough to leave on.
+    """
+
+    def __init__(self, enabled: bool = True, port: int = None, max_turns: int = 1000):
+        self.enabled = enabled
+        self.port = port
+        self.callback = _TokenCallback()
+        self._lock = threading.Lock()
+        self._durations = {}  # {node: [bucket counts..., +Inf count, sum]}
+        self._counters = {}  # {(node, key): total}
+        self._turns = LRUCache(max_turns)  # {thread_id: {node: record}} for the latest turn
+        self._sources = {}  # {name: fn returning {label value: {stat: number}}}, e.g. outbound providers
+        self._server = None
+
+    @classmethod
+    def from_env(cls):
+        port = os.getenv("METRICS_PORT")
+        return cls(
+            enabled=os.getenv("METRICS_ENABLED", "1").lower() in ("1", "true", "yes"),
+            port=int(port) if port else None,
+            max_turns=int(os.getenv("METRICS_TURNS", "1000")),
+        )
+
+    def _add(self, name: str, record: dict, key: str, n):
+        record[key] = record.get(key, 0) + n
+        with self._lock:
+            self._counters[(name, key)] = self._counters.get((name, key), 0) + n
+
+    def _begin(self, name: str, config: dict, starts_turn: bool) -> dict:
+        thread_id = ((config or {}).get("configurable") or {}).get("thread_id")
+        turn = None
+        if thread_id is not None:
+            turn = self._turns.get(thread_id)
+            if starts_turn or turn is None:
+                turn = {}
+                self._turns.set(thread_id, turn)
+        record = {}
+        if turn is not None:
+            turn[name] = record
+        return record
+
+    def _observe(self, name: str, seconds: float, record: dict, failed: bool):
+        record["seconds"] = seconds
+        with self._lock:
+            histogram = self._durations.setdefault(name, [0] * (len(BUCKETS) + 2))
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+            if failed:
+                self._counters[(name, "errors")] = self._counters.get((name, "errors"), 0) + 1
+
+    def instrument(self, name: str, fn, starts_turn: bool = False):
+        """Wraps a sync or async node function; starts_turn marks the graph's entry node."""
+        # No functools.wraps: LangGraph reads the signature to decide whether to pass config
+        if asyncio.iscoroutinefunction(fn):
+            async def node(state, config):
+                record = self._begin(name, config, starts_turn)
+                token = _current.set((name, record, self))
+                started, failed = time.perf_counter(), True
+                try:
+                    result = await fn(state)
+                    failed = False
+                    return result
+                finally:
+                    _current.reset(token)
+                    self._observe(name, time.perf_counter() - started, record, failed)
+        else:
+            def node(state, config):
+                record = self._begin(name, config, starts_turn)
+                token = _current.set((name, record, self))
+                started, failed = time.perf_counter(), True
+                try:
+                    result = fn(state)
+                    failed = False
+                    return result
+                finally:
+                    _current.reset(token)
+                    self._observe(name, time.perf_counter() - started, record, failed)
+        node.__name__ = fn.__name__
+        return node
+
+    def add_source(self, name: str, stats, label: str = "provider"):
+        """Exports stats() ({label value: {stat: number}}) alongside the node metrics as name_<stat> gauges."""
+        self._sources[name] = (stats, label)
+
+    def last_turn(self, thread_id: str) -> dict:
+        """{node: {"seconds", "prompt_tokens", "completion_tokens", events...}} of the thread's latest turn."""
+        turn = self._turns.get(thread_id)
+        return {name: dict(record) for name, record in turn.items()} if turn else {}
+
+    def to_json(self) -> dict:
+        with self._lock:
+            durations = {name: list(histogram) for name, histogram in self._durations.items()}
+            counters = dict(self._counters)
+        nodes = {}
+        for name, histogram in durations.items():
+            calls, total = histogram[-2], histogram[-1]
+            nodes[name] = {"calls": calls, "errors": 0, "seconds_sum": total,
+                           "mean_seconds": total / calls if calls else 0.0,
+                           "buckets": {str(bound): count for bound, count in zip(BUCKETS, histogram)}}
+        for (name, key), value in counters.items():
+            nodes.setdefault(name, {"calls": 0, "errors": 0})[key] = value
+        return {"nodes": nodes, **{name: stats() for name, (stats, _) in self._sources.items()}}
+
+    def prometheus(self) -> str:
+        """The totals in the Prometheus text exposition format."""
+        with self._lock:
+            durations = {name: list(histogram) for name, histogram in self._durations.items()}
+            counters = dict(self._counters)
+        lines = ["# HELP graph_node_duration_seconds Wall time of each graph node.",
+                 "# TYPE graph_node_duration_seconds histogram"]
+        for name, histogram in sorted(durations.items()):
+            for bound, count in zip(BUCKETS, histogram):
+                lines.append(f'graph_node_duration_seconds_bucket{{node="{name}",le="{bound}"}} {count}')
+            lines.append(f'graph_node_duration_seconds_bucket{{node="{name}",le="+Inf"}} {histogram[-2]}')
+            lines.append(f'graph_node_duration_seconds_sum{{node="{name}"}} {histogram[-1]}')
+            lines.append(f'graph_node_duration_seconds_count{{node="{name}"}} {histogram[-2]}')
+        groups = {
+            "graph_node_errors_total": ("Exceptions raised by each graph node.", {}),
+            "graph_llm_tokens_total": ("LLM tokens used by each graph node.", {}),
+            "graph_llm_calls_total": ("LLM calls made by each graph node.", {}),
+            "graph_node_events_total": ("Cache hits, retrieved chunks and other events per graph node.", {}),
+        }
+        for (name, key), value in sorted(counters.items()):
+            if key == "errors":
+                groups["graph_node_errors_total"][1][f'node="{name}"'] = value
+            elif key in ("prompt_tokens", "completion_tokens"):
+                groups["graph_llm_tokens_total"][1][f'node="{name}",kind="{key[:-len("_tokens")]}"'] = value
+            elif key == "llm_calls":
+                groups["graph_llm_calls_total"][1][f'node="{name}"'] = value
+            else:
+                groups["graph_node_events_total"][1][f'node="{name}",event="{key}"'] = value
+        for metric, (help_text, samples) in groups.items():
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+            lines += [f"{metric}{{{labels}}} {value}" for labels, value in samples.items()]
+        for name, (stats, label) in sorted(self._sources.items()):
+            gauges = {}
+            for value_label, values in sorted(stats().items()):
+                for stat, value in values.items():
+                    gauges.setdefault(f"{name}_{stat}", []).append(f'{name}_{stat}{{{label}="{value_label}"}} {value}')
+            for metric, samples in gauges.items():
+                lines += [f"# TYPE {metric} gauge", *samples]
+        return "\n".join(lines) + "\n"
+
+    def start(self):
+        """Serves /metrics (Prometheus) and /metrics.json on 127.0.0.1:port, once per process."""
+        with self._lock:
+            if self.port is None or self._server is not None:
+                return
+            metrics = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path == "/metrics":
+                        body, content_type = metrics.prometheus().encode(), "text/plain; version=0.0.4"
+                    elif self.path == "/metrics.json":
+                        body, content_type = json.dumps(metrics.to_json()).encode(), "application/json"
+                    else:
+                        self.send_error(404)
+                        return
+                    self.send_response(200)
+                    self.send_header("Content-Type", content_type)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            try:
+                self._server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+            except OSError as e:
+                print(f"Could not serve metrics on port {self.port}: {e}")
+                self.port = None
+                return
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+
+
+graph_metrics = GraphMetrics.from_env()
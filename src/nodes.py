@@ -1,32 +1,81 @@
-import httpx
+import asyncio
 from typing import TypedDict, Literal
-from langchain_core.messages import HumanMessage, SystemMessage
-from langchain_groq import ChatGroq
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 from pydantic import BaseModel, Field
-from src.weather import WeatherAPI
-from src.rag import RAGSystem
+from src.components import components
+from src.context import ContextPacker
+from src.history import ConversationHistory
+from src.llm import llm_registry, DEFAULT_MODEL
+from src.metrics import record_event
+from src.outbound import RateLimitQueueFull, api_key_id, outbound
 import os
 from dotenv import load_dotenv
 load_dotenv()
-# Initialize components
-weather_api = WeatherAPI()
-rag_system = RAGSystem()
-# Global initialization removed to support dynamic API key
-# llm = ChatGroq(...)
-
-def get_llm():
-    """Lazily initialize LLM with current environment variable."""
+# Weather API, RAG system, local router and answer cache are built lazily in src.components.
+# Nodes fetch them with components.get() at call time; LangGraph inspects the attributes
+# node functions read when compiling, which would otherwise build them on import.
+# Dedupes, diversifies and budgets retrieved chunks before they reach the prompt
+context_packer = ContextPacker.from_env()
+# Keeps prompts flat in long conversations: recent turns verbatim, older ones summarized
+conversation_history = ConversationHistory.from_env()
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "llama-3.1-8b-instant")
+# LLM clients are built per API key and pooled in src.llm
+
+def cached_answer(question: str):
+    """Returns (route, answer, similarity) for a confident, fresh cached answer, else None."""
+    answer_cache, semantic_router = components.get("answer_cache"), components.get("semantic_router")
+    if answer_cache is None:
+        return None
+    try:
+        route, margin = semantic_router.classify(question)
+    except Exception as e:
+        print(f"Answer cache lookup failed: {e}")
+        return None
+    if margin < semantic_router.margin_threshold:
+        return None
+    # Weather answers are matched on the cities named in the question, so a hit makes no LLM call
+    hit = answer_cache.lookup(question, route)
+    return (route, *hit) if hit is not None else None
+
+def _flight_key(kind: str, model: str, key_id: str, messages) -> tuple:
+    return (kind, model, key_id, tuple((message.type, str(message.content)) for message in messages))
+
+def _invoke(runnable, messages, kind: str, model: str = DEFAULT_MODEL):
+    """runnable.invoke(messages), shared with an identical call already in flight (e.g. a burst of one question).
+
+    Only for calls whose result is all the caller needs: a follower gets the
+    leader's result but none of its streamed tokens, so generation isn't shared.
+    """
+    key_id = api_key_id(os.getenv("GROQ_API_KEY") or "")
+    return outbound("groq", key_id).coalesce(_flight_key(kind, model, key_id, messages), lambda: runnable.invoke(messages))
+
+async def _ainvoke(runnable, messages, kind: str, model: str = DEFAULT_MODEL):
+    key_id = api_key_id(os.getenv("GROQ_API_KEY") or "")
+    return await outbound("groq", key_id).acoalesce(_flight_key(kind, model, key_id, messages),
+                                                    lambda: runnable.ainvoke(messages))
+
+def _busy_message(error: RateLimitQueueFull) -> str:
+    return f"Error: the language model is busy right now ({error}). Please try again in a moment."
+
+def _busy_answer(query: str, message: str) -> dict:
+    """The turn's answer when the Groq rate limit queue is full; no LLM call is made."""
+    return {"answer": message, "messages": [HumanMessage(content=query), AIMessage(content=message)]}
+
+def get_llm(model: str = DEFAULT_MODEL):
+    """Returns the pooled LLM client for the current environment API key."""
     api_key = os.getenv("GROQ_API_KEY")
     if not api_key:
         raise ValueError("GROQ_API_KEY not found in environment variables. Please login.")
     
-    return ChatGroq(
-        model="llama-3.3-70b-versatile", 
-        temperature=0,
-        api_key=api_key,
-        http_client=httpx.Client(verify=False),
-        streaming=True
-    )
+    return llm_registry.get(api_key, model)
+
+def get_async_llm(model: str = DEFAULT_MODEL):
+    """Returns the pooled LLM client whose async pool is bound to the running event loop."""
+    api_key = os.getenv("GROQ_API_KEY")
+    if not api_key:
+        raise ValueError("GROQ_API_KEY not found in environment variables. Please login.")
+
+    return llm_registry.get_async(api_key, model)
 
 
 # Pydantic Models
@@ -39,7 +88,21 @@ class RouterOutput(BaseModel):
 
 class CityExtraction(BaseModel):
     """Extraction format for city names."""
-    city: str = Field(..., description="The name of the city extracted from the query.")
+    cities: list[str] = Field(
+        default_factory=list,
+        description="Every city the user asks about, in the order mentioned (e.g. ['Delhi', 'Mumbai', 'Pune'])."
+    )
+
+class FusedRouterOutput(BaseModel):
+    """The target destination for the user query plus any cities it asks about."""
+    source: Literal["weather", "rag"] = Field(
+        ..., 
+        description="The tool to use. 'weather' for live weather data, 'rag' for document questions."
+    )
+    cities: list[str] = Field(
+        default_factory=list,
+        description="The city names the user asks about when source is 'weather'. Empty for 'rag'."
+    )
 
 from langchain_core.messages import BaseMessage
 from typing import Annotated, Sequence
@@ -50,57 +113,131 @@ class AgentState(TypedDict):
     context: str
     answer: str
     source: str
+    cities: list[str]  # Set by the fused router so weather_node can skip extraction
+    context_stats: dict  # Token accounting of the packed RAG context for this turn
+    summary: str  # Rolling summary of the turns no longer sent verbatim
     messages: Annotated[Sequence[BaseMessage], add_messages]  # Conversation history
 
+ROUTER_SYSTEM = "You are a router. Classify the user's query. You have a realtime weather API and a document retrieval system (RAG). If the user is asking about current weather conditions, route to 'weather'. For all other queries, route to 'rag'. Respond ONLY with 'weather' or 'rag'."
+FUSED_ROUTER_SYSTEM = "You are a router. Classify the user's query. You have a realtime weather API and a document retrieval system (RAG). If the user is asking about current weather conditions, route to 'weather' and list every city they ask about in 'cities'. For all other queries, route to 'rag' with no cities."
+
 def router_node(state: AgentState) -> dict:
     """Decides whether to route to Weather or RAG."""
     query = state["question"]
+
+    # Fast path: classify locally and only pay for the LLM call when unsure
+    semantic_router = components.get("semantic_router")
+    if semantic_router is not None:
+        source = semantic_router.route(query)
+        semantic_router.record(skipped_llm=source is not None)
+        if source is not None:
+            record_event("local_routes")
+            return {"source": source, "cities": []}
     
     # Structured Output for Routing
     structured_llm = get_llm().with_structured_output(RouterOutput)
     
-    system = "You are a router. Classify the user's query. You have a realtime weather API and a document retrieval system (RAG). If the user is asking about current weather conditions, route to 'weather'. For all other queries, route to 'rag'. Respond ONLY with 'weather' or 'rag'."
-    messages = [SystemMessage(content=system), HumanMessage(content=query)]
+    messages = [SystemMessage(content=ROUTER_SYSTEM), HumanMessage(content=query)]
     
     try:
-        result = structured_llm.invoke(messages)
-        return {"source": result.source}
+        result = _invoke(structured_llm, messages, "router")
+        return {"source": result.source, "cities": []}
+    except RateLimitQueueFull as e:
+        # Straight to generate, which answers with the error instead of guessing a route
+        return {"source": "busy", "cities": [], "context": _busy_message(e)}
     except Exception:
         # Fallback if structured output fails (rare)
-        return {"source": "rag"}
+        return {"source": "rag", "cities": []}
+
+def fused_router_node(state: AgentState) -> dict:
+    """Decides the route and extracts cities in a single LLM call."""
+    query = state["question"]
+
+    # A confident local "rag" needs no LLM call; "weather" still needs the cities
+    semantic_router = components.get("semantic_router")
+    if semantic_router is not None:
+        local = semantic_router.route(query) == "rag"
+        semantic_router.record(skipped_llm=local)
+        if local:
+            record_event("local_routes")
+            return {"source": "rag", "cities": []}
+
+    structured_llm = get_llm().with_structured_output(FusedRouterOutput)
+    messages = [SystemMessage(content=FUSED_ROUTER_SYSTEM), HumanMessage(content=query)]
+
+    try:
+        return _fused_route(_invoke(structured_llm, messages, "fused_router"))
+    except RateLimitQueueFull as e:
+        return {"source": "busy", "cities": [], "context": _busy_message(e)}
+    except Exception:
+        return {"source": "rag", "cities": []}
+
+def _fused_route(result: FusedRouterOutput) -> dict:
+    cities = [city for city in result.cities if city.strip()] if result.source == "weather" else []
+    return {"source": result.source, "cities": cities}
+
+CITY_SYSTEM = "Extract every city the user asks about from the query, in the order mentioned."
+
+def _extracted_cities(result: CityExtraction) -> list[str]:
+    cities = [city for city in result.cities if city.strip()]
+    if not cities:
+        raise ValueError("No city found in the query")
+    return cities
 
 def weather_node(state: AgentState) -> dict:
-    """Fetches weather data."""
+    """Fetches weather data for every city in the question."""
     query = state["question"]
-    
-    # Structured Output for City Extraction
-    structured_llm = get_llm().with_structured_output(CityExtraction)
-    system = "Extract the city name from the query."
+    cities = state.get("cities") or []
     
     try:
-        result = structured_llm.invoke([SystemMessage(content=system), HumanMessage(content=query)])
-        city = result.city
-        result_text = weather_api.get_weather(city)
+        if not cities:
+            # Structured Output for City Extraction (skipped when the fused router already did it)
+            structured_llm = get_llm().with_structured_output(CityExtraction)
+            result = _invoke(structured_llm, [SystemMessage(content=CITY_SYSTEM), HumanMessage(content=query)], "cities")
+            cities = _extracted_cities(result)
+        # All cities are fetched concurrently and merged into one context block
+        result_text = components.get("weather_api").get_weather_many(cities)
+    except RateLimitQueueFull as e:
+        return {"context": _busy_message(e)}
     except Exception:
-        result_text = "Error: Could not extract city name."
+        return {"context": "Error: Could not extract city name."}
 
-    return {"context": result_text}
+    return {"context": result_text, "cities": cities}
 
 def rag_node(state: AgentState) -> dict:
     """Retrieves documents."""
     query = state["question"]
-    docs = rag_system.retrieve(query)
-    
+    docs = components.get("rag_system").retrieve(query, k=context_packer.candidates)
+    return _rag_context(docs)
+
+def _rag_context(docs) -> dict:
     if not docs or len(docs) == 0:
-        context = "No documents have been uploaded yet. Please upload a PDF document first to ask questions about it."
-    else:
-        context = "\n\n".join([d.page_content for d in docs])
-    
-    return {"context": context}
+        return {"context": "No documents have been uploaded yet. Please upload a PDF document first to ask questions about it.",
+                "context_stats": {}}
+    context, stats = context_packer.pack(docs)
+    return {"context": context, "context_stats": stats}
 
 def generate_node(state: AgentState) -> dict:
     """Generates an answer based on context."""
     query = state["question"]
+    if state["source"] == "busy":
+        return _busy_answer(query, state["context"])
+    # The client streams, so graph.stream(stream_mode="messages") yields tokens as they arrive.
+    # Not coalesced: a follower of a shared call would stream nothing
+    try:
+        response = get_llm().invoke(_generation_messages(state))
+    except RateLimitQueueFull as e:
+        return _busy_answer(query, _busy_message(e))
+    
+    # Return with messages to update the checkpoint
+    return {
+        "answer": response.content,
+        "messages": [HumanMessage(content=query), response]
+    }
+
+def _generation_messages(state: AgentState) -> list:
+    """Builds the system prompt, history and current question for generation."""
+    query = state["question"]
     context = state["context"]
     source = state["source"]
     conversation_messages = state.get("messages", [])
@@ -118,16 +255,132 @@ def generate_node(state: AgentState) -> dict:
     
     messages = [SystemMessage(content=system)]
     
-    # Add conversation history from checkpointer
-    messages.extend(conversation_messages)
+    # Add conversation history from checkpointer: a summary of older turns plus the recent ones
+    summary = conversation_history.summary_message(state.get("summary"))
+    if summary is not None:
+        messages.append(summary)
+    messages.extend(conversation_history.window(conversation_messages))
     
     # Add current query
     messages.append(HumanMessage(content=query))
-    
-    response = get_llm().invoke(messages)
-    
-    # Return with messages to update the checkpoint
+    return messages
+
+def needs_summary(state: AgentState) -> bool:
+    """True when turns have fallen out of the history window and should be folded into the summary."""
+    return bool(conversation_history.overflow(state.get("messages", [])))
+
+def summarize_node(state: AgentState) -> dict:
+    """Folds the turns that left the history window into the rolling summary."""
+    evicted = conversation_history.overflow(state.get("messages", []))
+    if not evicted:
+        return {}
+    try:
+        response = _invoke(get_llm(SUMMARY_MODEL), conversation_history.summary_prompt(state.get("summary"), evicted),
+                           "summarize", SUMMARY_MODEL)
+    except Exception as e:
+        # The prompt stays bounded by the window either way; retry on the next turn
+        print(f"Error summarizing conversation history: {e}")
+        return {}
+    return conversation_history.fold(response.content, evicted)
+
+
+# --- Async variants, used by build_graph(async_nodes=True) under graph.astream ---
+
+async def arouter_node(state: AgentState) -> dict:
+    """Async router_node."""
+    query = state["question"]
+
+    # Building the router (on a cold start) and embedding are CPU-bound, keep them off the event loop
+    semantic_router = await asyncio.to_thread(components.get, "semantic_router")
+    if semantic_router is not None:
+        source = await asyncio.to_thread(semantic_router.route, query)
+        semantic_router.record(skipped_llm=source is not None)
+        if source is not None:
+            record_event("local_routes")
+            return {"source": source, "cities": []}
+
+    structured_llm = get_async_llm().with_structured_output(RouterOutput)
+    messages = [SystemMessage(content=ROUTER_SYSTEM), HumanMessage(content=query)]
+
+    try:
+        result = await _ainvoke(structured_llm, messages, "router")
+        return {"source": result.source, "cities": []}
+    except RateLimitQueueFull as e:
+        return {"source": "busy", "cities": [], "context": _busy_message(e)}
+    except Exception:
+        return {"source": "rag", "cities": []}
+
+async def afused_router_node(state: AgentState) -> dict:
+    """Async fused_router_node."""
+    query = state["question"]
+
+    semantic_router = await asyncio.to_thread(components.get, "semantic_router")
+    if semantic_router is not None:
+        local = await asyncio.to_thread(semantic_router.route, query) == "rag"
+        semantic_router.record(skipped_llm=local)
+        if local:
+            record_event("local_routes")
+            return {"source": "rag", "cities": []}
+
+    structured_llm = get_async_llm().with_structured_output(FusedRouterOutput)
+    messages = [SystemMessage(content=FUSED_ROUTER_SYSTEM), HumanMessage(content=query)]
+
+    try:
+        return _fused_route(await _ainvoke(structured_llm, messages, "fused_router"))
+    except RateLimitQueueFull as e:
+        return {"source": "busy", "cities": [], "context": _busy_message(e)}
+    except Exception:
+        return {"source": "rag", "cities": []}
+
+async def aweather_node(state: AgentState) -> dict:
+    """Async weather_node."""
+    query = state["question"]
+    cities = state.get("cities") or []
+
+    try:
+        if not cities:
+            structured_llm = get_async_llm().with_structured_output(CityExtraction)
+            messages = [SystemMessage(content=CITY_SYSTEM), HumanMessage(content=query)]
+            result = await _ainvoke(structured_llm, messages, "cities")
+            cities = _extracted_cities(result)
+        result_text = await components.get("weather_api").aget_weather_many(cities)
+    except RateLimitQueueFull as e:
+        return {"context": _busy_message(e)}
+    except Exception:
+        return {"context": "Error: Could not extract city name."}
+
+    return {"context": result_text, "cities": cities}
+
+async def arag_node(state: AgentState) -> dict:
+    """Async rag_node; the embedding and Qdrant search run in a worker thread."""
+    docs = await asyncio.to_thread(lambda: components.get("rag_system").retrieve(state["question"], context_packer.candidates))
+    return _rag_context(docs)
+
+async def agenerate_node(state: AgentState) -> dict:
+    """Async generate_node."""
+    query = state["question"]
+    if state["source"] == "busy":
+        return _busy_answer(query, state["context"])
+    try:
+        response = await get_async_llm().ainvoke(_generation_messages(state))
+    except RateLimitQueueFull as e:
+        return _busy_answer(query, _busy_message(e))
+
     return {
         "answer": response.content,
         "messages": [HumanMessage(content=query), response]
     }
+
+async def asummarize_node(state: AgentState) -> dict:
+    """Async summarize_node."""
+    evicted = conversation_history.overflow(state.get("messages", []))
+    if not evicted:
+        return {}
+    try:
+        prompt = conversation_history.summary_prompt(state.get("summary"), evicted)
+        response = await _ainvoke(get_async_llm(SUMMARY_MODEL), prompt, "summarize", SUMMARY_MODEL)
+    except Exception as e:
+        print(f"Error summarizing conversation history: {e}")
+        return {}
+    return conversation_history.fold(response.content, evicted)
+
@@ -0,0 +1,329 @@
+import os
+import copy
+import hashlib
+import time
+import random
+import asyncio
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future
+from langchain_core.rate_limiters import BaseRateLimiter
+from src.metrics import graph_metrics, record_event
+
+# Requests per second and burst per provider. OpenWeatherMap matches its free tier (60/min); Groq's limits
+# depend on the account and model, so its client-side limit is off unless GROQ_RATE_LIMIT is set
+PROVIDER_LIMITS = {
+    "openweathermap": (1.0, 10),
+    "groq": (0.0, 5),
+}
+
+
+class RateLimitQueueFull(Exception):
+    """Raised instead of queueing a call that would wait longer than the provider's max_wait."""
+
+
+def status_code(exc: BaseException):
+    """HTTP status of a requests/httpx/SDK error, if it carries one."""
+    for source in (exc, getattr(exc, "response", None)):
+        code = getattr(source, "status_code", None)
+        if isinstance(code, int):
+            return code
+    return None
+
+
+def retry_after(exc: BaseException):
+    """Seconds the provider asked us to wait (Retry-After), if it said."""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    try:
+        return float(headers.get("retry-after")) if headers is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens per second up to `burst`; a rate of 0 means unlimited.
+
+    reserve() always takes a token, letting the balance go negative, and
+    returns how long the caller must wait before using it, so concurrent
+    callers queue in arrival order without polling.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    def refund(self):
+        with self._lock:
+            self._tokens += 1
+
+
+class OutboundProvider:
+    """Shared outbound-call layer for one provider: coalescing, rate limiting and 429 retries.
+
+    coalesce() runs concurrent calls with the same key once and hands every
+    caller a copy of the result (single-flight). throttle() queues callers on
+    a token bucket, failing fast rather than waiting longer than max_wait.
+    call() does both and retries 429 responses with jittered exponential
+    backoff, honouring Retry-After. Sync and async callers share the bucket;
+    in-flight calls are shared per event loop, since futures can't cross loops.
+    """
+
+    def __init__(self, name: str, rate: float = 0.0, burst: int = 1, max_retries: int = 3, base_delay: float = 0.5,
+                 max_delay: float = 20.0, max_wait: float = 30.0):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._flights = {}  # {key: Future} of sync calls in flight
+        self._async_flights = weakref.WeakKeyDictionary()  # {event loop: {key: asyncio.Future}}
+        self._queue_depth = 0
+        self._counters = {"calls": 0, "coalesced": 0, "requests": 0, "rate_limited": 0, "retries": 0,
+                          "throttled": 0, "rejected": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0,
+                          "max_queue_depth": 0}
+
+    @classmethod
+    def from_env(cls, name: str):
+        prefix = name.upper()
+        rate, burst = PROVIDER_LIMITS.get(name, (0.0, 1))
+        return cls(
+            name,
+            rate=float(os.getenv(f"{prefix}_RATE_LIMIT", str(rate))),
+            burst=int(os.getenv(f"{prefix}_RATE_BURST", str(burst))),
+            max_retries=int(os.getenv("OUTBOUND_MAX_RETRIES", "3")),
+            max_wait=float(os.getenv("OUTBOUND_MAX_WAIT", "30")),
+        )
+
+    def _count(self, key: str, n=1):
+        with self._lock:
+            self._counters[key] += n
+
+    # --- Rate limiting ---
+
+    def _reserve(self) -> float:
+        wait = self.bucket.reserve()
+        if wait > self.max_wait:
+            self.bucket.refund()
+            self._count("rejected")
+            raise RateLimitQueueFull(f"{self.name}: rate limit queue is {wait:.0f}s deep")
+        if wait > 0:
+            with self._lock:
+                self._counters["throttled"] += 1
+                self._queue_depth += 1
+                self._counters["max_queue_depth"] = max(self._counters["max_queue_depth"], self._queue_depth)
+            record_event(f"{self.name}_throttled")
+        return wait
+
+    def _dequeue(self, wait: float):
+        with self._lock:
+            self._queue_depth -= 1
+            self._counters["wait_seconds"] += wait
+            self._counters["max_wait_seconds"] = max(self._counters["max_wait_seconds"], wait)
+
+    def throttle(self):
+        """Blocks until the rate limit admits one request."""
+        wait = self._reserve()
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            finally:
+                self._dequeue(wait)
+
+    async def athrottle(self):
+        wait = self._reserve()
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self._dequeue(wait)
+
+    # --- Retries ---
+
+    def _backoff(self, attempt: int, exc: BaseException) -> float:
+        # Full jitter keeps callers that were rejected together from retrying together
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        asked = retry_after(exc)
+        return min(self.max_delay, asked + delay) if asked is not None else delay
+
+    def _should_retry(self, attempt: int, exc: BaseException) -> bool:
+        if status_code(exc) != 429:
+            return False
+        self._count("rate_limited")
+        if attempt >= self.max_retries:
+            return False
+        self._count("retries")
+        return True
+
+    def _attempts(self, fn):
+        for attempt in range(self.max_retries + 1):
+            self.throttle()
+            self._count("requests")
+            try:
+                return fn()
+            except Exception as e:
+                if not self._should_retry(attempt, e):
+                    raise
+                time.sleep(self._backoff(attempt, e))
+
+    async def _aattempts(self, afn):
+        for attempt in range(self.max_retries + 1):
+            await self.athrottle()
+            self._count("requests")
+            try:
+                return await afn()
+            except Exception as e:
+                if not self._should_retry(attempt, e):
+                    raise
+                await asyncio.sleep(self._backoff(attempt, e))
+
+    # --- Single flight ---
+
+    def coalesce(self, key, fn):
+        """Runs fn, or waits for the identical call (same key) already in flight and copies its result."""
+        self._count("calls")
+        with self._lock:
+            future = self._flights.get(key)
+            leader = future is None
+            if leader:
+                future = self._flights[key] = Future()
+            else:
+                self._counters["coalesced"] += 1
+        if not leader:
+            record_event(f"{self.name}_coalesced")
+            return copy.deepcopy(future.result())
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+
+    async def acoalesce(self, key, afn):
+        """Async coalesce(); afn returns the awaitable to share."""
+        self._count("calls")
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            flights = self._async_flights.setdefault(loop, {})
+            future = flights.get(key)
+            leader = future is None
+            if leader:
+                future = flights[key] = loop.create_future()
+            else:
+                self._counters["coalesced"] += 1
+        if not leader:
+            record_event(f"{self.name}_coalesced")
+            # shield: a follower giving up must not cancel the leader's call
+            return copy.deepcopy(await asyncio.shield(future))
+        try:
+            result = await afn()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Followers may not exist; don't log "exception was never retrieved"
+            raise
+        finally:
+            with self._lock:
+                flights.pop(key, None)
+
+    def call(self, fn, key=None):
+        """fn through the rate limit with 429 retries, coalesced with identical in-flight calls when keyed."""
+        if key is None:
+            self._count("calls")
+            return self._attempts(fn)
+        return self.coalesce(key, lambda: self._attempts(fn))
+
+    async def acall(self, afn, key=None):
+        if key is None:
+            self._count("calls")
+            return await self._aattempts(afn)
+        return await self.acoalesce(key, lambda: self._aattempts(afn))
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters, queue_depth=self._queue_depth)
+        stats["mean_wait_seconds"] = stats["wait_seconds"] / stats["throttled"] if stats["throttled"] else 0.0
+        return stats
+
+
+class ProviderRateLimiter(BaseRateLimiter):
+    """Lets LangChain chat models (e.g. ChatGroq's rate_limiter) queue on a provider's token bucket."""
+
+    def __init__(self, provider: OutboundProvider):
+        self.provider = provider
+
+    def acquire(self, *, blocking: bool = True) -> bool:
+        if blocking:
+            self.provider.throttle()
+            return True
+        if self.provider.bucket.reserve() > 0:
+            self.provider.bucket.refund()
+            return False
+        return True
+
+    async def aacquire(self, *, blocking: bool = True) -> bool:
+        if blocking:
+            await self.provider.athrottle()
+            return True
+        return self.acquire(blocking=False)
+
+
+_providers = OrderedDict()  # {name or "name:scope": OutboundProvider}, least recently used first
+_providers_lock = threading.Lock()
+MAX_PROVIDERS = 64  # Scoped providers are per API key, so the oldest are dropped like LLM clients
+
+
+def outbound(name: str, scope: str = None) -> OutboundProvider:
+    """The process-wide provider, configured from the environment on first use.
+
+    scope (e.g. a hash of the API key) gives each account its own bucket and
+    in-flight calls, since the provider rate-limits per key. Only the
+    MAX_PROVIDERS most recently used are kept.
+    """
+    key = name if scope is None else f"{name}:{scope}"
+    with _providers_lock:
+        provider = _providers.get(key)
+        if provider is None:
+            provider = _providers[key] = OutboundProvider.from_env(name)
+        _providers.move_to_end(key)
+        while len(_providers) > MAX_PROVIDERS:
+            _providers.popitem(last=False)
+        return provider
+
+
+def api_key_id(api_key: str) -> str:
+    """Short, non-reversible id of an API key, for scoping providers and coalescing keys."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+
+def outbound_stats() -> dict:
+    with _providers_lock:
+        providers = dict(_providers)
+    return {name: provider.stats() for name, provider in providers.items()}
+
+
+# Queue depth, wait times, coalesced calls and retries per provider on the metrics endpoint
+graph_metrics.add_source("outbound", outbound_stats)
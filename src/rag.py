@@ -1,12 +1,23 @@
 import os
+import warnings
+import threading
 from dotenv import load_dotenv
 import httpx
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_qdrant import QdrantVectorStore
 from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance
+from qdrant_client.models import (
+    Filter, FieldCondition, MatchAny, MatchValue, IsEmptyCondition, PayloadField, HasIdCondition,
+    FilterSelector, PayloadSchemaType, KeywordIndexParams, KeywordIndexType,
+)
+from src.ingest import IngestPipeline, stable_point_ids
+from src.collection_profiles import get_profile, collection_config, search_params, migrate_collection, is_local
+from src.embeddings import EMBEDDING_MODEL, EMBEDDING_DIM, build_embeddings, cache_model_name
+from src.embedding_cache import EmbeddingCache, CachedEmbeddings, QueryEmbeddingCache
+from src.lru import LRUCache, normalize_text
+from src.lexical import BM25Index, reciprocal_rank_fusion
+from langchain_core.documents import Document
+from src.manifest import DocumentManifest, IngestCheckpoints, file_sha256
+from src.metrics import record_event
 # from langchain_community.retrievers import ContextualCompressionRetriever
 # from langchain_community.retrievers. import LLMChainExtractor
 # from langchain_groq import ChatGroq
@@ -14,34 +25,117 @@ from qdrant_client.models import VectorParams, Distance
 load_dotenv()
 
 class RAGSystem:
-    def __init__(self, collection_name: str = "test_rag_collection"):
+    def __init__(self, collection_name: str = "test_rag_collection", client: QdrantClient = None,
+                 embeddings=None, manifest: DocumentManifest = None, tenant: str = None,
+                 lexical_index: BM25Index = None, ingest_checkpoints: IngestCheckpoints = None):
+        """Opens the persistent collection; client, embeddings and indexes can be injected (e.g. in tests)."""
         self.collection_name = collection_name
-        self.uploaded_pdfs = {}  # Track uploaded PDFs: {filename: {chunks: int, doc_ids: []}}
+        self.tenant = tenant or os.getenv("RAG_TENANT", "default")  # Stored on every chunk, scopes deletes
+        # Uploaded PDFs by content hash, survives restarts
+        self.manifest = manifest if manifest is not None else DocumentManifest.from_env()
+        # Pages stored so far by ingests that were interrupted, so a re-upload resumes
+        self.ingest_checkpoints = ingest_checkpoints if ingest_checkpoints is not None else IngestCheckpoints.from_env()
+        # Sparse lexical index fused with dense search, so exact part numbers and acronyms match
+        self.lexical_index = lexical_index if lexical_index is not None else BM25Index.from_env()
+        self.retrieval_mode = os.getenv("RAG_RETRIEVAL_MODE", "hybrid")  # "hybrid" or "dense"
         self.vector_store = None  # Initialize to None to avoid AttributeError
+        self.ingest_pipeline = None
+        self.embedding_cache = None
+        self.last_ingest_stats = None  # Throughput of the most recent ingest, for sizing hardware
+        self.retriever = None
+        # Bumped whenever chunks are added or removed; part of every result cache key
+        self.collection_version = 0
+        self._version_lock = threading.Lock()
+        self.result_cache = LRUCache(int(os.getenv("RAG_RESULT_CACHE_SIZE", "256")))
+        # Quantization, on-disk vectors and HNSW settings for the collection (QDRANT_COLLECTION_PROFILE)
+        self.collection_profile = get_profile()
         self.initialized = False
         
         try:
-            # Use persistent disk storage
-            self.client = QdrantClient(path="qdrant_storage") 
-            # Using HuggingFace embeddings - no local server needed, works on any machine
-            self.embeddings = HuggingFaceEmbeddings(
-                model_name="sentence-transformers/all-MiniLM-L6-v2",
-                model_kwargs={'device': 'cpu'},
-                encode_kwargs={'normalize_embeddings': True}
-            )
+            # Use persistent disk storage, or a Qdrant server when QDRANT_URL is set
+            if client is not None:
+                self.client = client
+            elif os.getenv("QDRANT_URL"):
+                self.client = QdrantClient(url=os.getenv("QDRANT_URL"), api_key=os.getenv("QDRANT_API_KEY"))
+            else:
+                self.client = QdrantClient(path="qdrant_storage")
+            if embeddings is not None:
+                self.embeddings = embeddings
+            else:
+                # Using HuggingFace embeddings - no local server needed, works on any machine
+                # EMBEDDING_BACKEND picks PyTorch or the (int8) ONNX Runtime export of the same model
+                # Chunks seen before (re-uploads, shared pages) are served from the on-disk cache
+                # Keyed by the backend that actually loaded, as a fallback to PyTorch changes the vectors
+                self.embedding_cache = EmbeddingCache.from_env(dim=EMBEDDING_DIM)
+                model = build_embeddings()
+                self.embeddings = CachedEmbeddings(
+                    model,
+                    self.embedding_cache,
+                    model_name=cache_model_name(model),
+                )
+            # Repeated questions (from the router and retrieval alike) skip the forward pass
+            self.embeddings = QueryEmbeddingCache(self.embeddings)
             
             # Ensure collection exists (384 dimensions for all-MiniLM-L6-v2)
+            # Local (path=) mode searches exactly and ignores the profile; it applies on a Qdrant server
+            local = is_local(self.client)
             if not self.client.collection_exists(self.collection_name):
                 self.client.create_collection(
                     collection_name=self.collection_name,
-                    vectors_config=VectorParams(size=384, distance=Distance.COSINE)
+                    **collection_config(self.collection_profile, EMBEDDING_DIM)
                 )
+            elif not local:
+                # Existing collections are moved onto the configured profile in place
+                changed = migrate_collection(self.client, self.collection_name, self.collection_profile)
+                if changed:
+                    print(f"Migrating collection to the '{self.collection_profile['name']}' profile: {', '.join(changed)}")
+            self._ensure_payload_indexes()
 
             self.vector_store = QdrantVectorStore(
                 client=self.client,
                 collection_name=self.collection_name,
                 embedding=self.embeddings,
             )
+            # Only this tenant's chunks (and those stored before tenants were recorded) are searched,
+            # and none from an ingest that hasn't finished
+            search_kwargs = {"k": 5, "filter": self._retrieval_filter()}
+            params = search_params(self.collection_profile)
+            if params is not None and not local:
+                # HNSW ef, plus rescoring oversampled int8 hits against the on-disk originals
+                search_kwargs["search_params"] = params
+            self.retriever = self.vector_store.as_retriever(search_kwargs=search_kwargs)
+            self.ingest_pipeline = IngestPipeline(
+                client=self.client,
+                collection_name=self.collection_name,
+                embeddings=self.embeddings,
+                content_key=self.vector_store.content_payload_key,
+                metadata_key=self.vector_store.metadata_payload_key,
+            )
+
+            # The vectors persist in qdrant_storage, so make sure the manifest describes them.
+            # Chunks of unfinished ingests aren't documents yet; they're completed when the file is uploaded again
+            completed = self._retrieval_filter()
+            complete_count = self.client.count(self.collection_name, count_filter=completed, exact=True).count
+            if self.manifest.needs_rebuild(complete_count):
+                self.manifest.rebuild(self.client, self.collection_name, self.vector_store.metadata_payload_key,
+                                      completed)
+                print(f"Rebuilt document manifest from {complete_count} stored chunks.")
+            for content_hash in self.ingest_checkpoints.pending():
+                if self.manifest.get(content_hash) is not None:
+                    # Published just before a crash, so there is nothing left to resume
+                    self.ingest_checkpoints.finish(content_hash)
+            # Ingests abandoned for longer than INGEST_CHECKPOINT_TTL won't be resumed; free their chunks
+            discarded = self.discard_pending_ingests(max_age=float(os.getenv("INGEST_CHECKPOINT_TTL", "86400")))
+            if discarded:
+                print(f"Discarded {discarded} abandoned ingests.")
+            owned = self._tenant_filter(include_legacy=True)
+            point_count = self.client.count(self.collection_name, count_filter=owned, exact=True).count
+            if self.lexical_index.needs_rebuild(point_count):
+                self.lexical_index.rebuild(
+                    self.client, self.collection_name, self.vector_store.content_payload_key,
+                    self.vector_store.metadata_payload_key, owned,
+                )
+                print(f"Rebuilt lexical index from {point_count} stored chunks.")
             
             # Initialize Compressor
             # llm was here, removed to avoid early API key requirement since compressor is commented out
@@ -58,8 +152,65 @@ class RAGSystem:
             self.initialized = False
             # We don't raise here to allow the app to start, but ingest/retrieve will fail gracefully
 
-    def ingest_pdf(self, file_path: str, filename: str):
-        """Ingests a PDF file into the vector database."""
+    def _metadata_field(self, name: str) -> str:
+        return f"{QdrantVectorStore.METADATA_KEY}.{name}"
+
+    def _ensure_payload_indexes(self):
+        """Indexes the payload fields used by filtered deletes and searches, once per collection."""
+        indexes = {
+            self._metadata_field("source_file"): PayloadSchemaType.KEYWORD,
+            self._metadata_field("content_hash"): PayloadSchemaType.KEYWORD,
+            self._metadata_field("ingest_complete"): PayloadSchemaType.BOOL,
+            # Tenant indexes let Qdrant co-locate each tenant's points
+            self._metadata_field("tenant"): KeywordIndexParams(type=KeywordIndexType.KEYWORD, is_tenant=True),
+        }
+        existing = self.client.get_collection(self.collection_name).payload_schema
+        with warnings.catch_warnings():
+            # Local (path=) mode ignores payload indexes and warns; they take effect on a Qdrant server
+            warnings.simplefilter("ignore", UserWarning)
+            for field_name, schema in indexes.items():
+                if field_name not in existing:
+                    self.client.create_payload_index(self.collection_name, field_name=field_name, field_schema=schema)
+
+    def _tenant_filter(self, include_legacy: bool = False) -> Filter:
+        """Matches this tenant's points, plus points stored before tenants were recorded if asked."""
+        tenant = FieldCondition(key=self._metadata_field("tenant"), match=MatchValue(value=self.tenant))
+        if not include_legacy:
+            return Filter(must=[tenant])
+        return Filter(should=[tenant, IsEmptyCondition(is_empty=PayloadField(key=self._metadata_field("tenant")))])
+
+    def _retrieval_filter(self) -> Filter:
+        """Chunks retrieval may return: this tenant's, minus those of unfinished ingests."""
+        incomplete = FieldCondition(key=self._metadata_field("ingest_complete"), match=MatchValue(value=False))
+        return Filter(must=[self._tenant_filter(include_legacy=True)], must_not=[incomplete])
+
+    def _documents_filter(self, content_hashes: list[str]) -> Filter:
+        """Matches every chunk of the given documents through the indexed payload fields."""
+        hashes = [h for h in content_hashes if not h.startswith("name:")]
+        # Documents rebuilt from chunks without a content hash are keyed by filename
+        legacy = [h[len("name:"):] for h in content_hashes if h.startswith("name:")]
+        should = []
+        if hashes:
+            should.append(Filter(must=[
+                FieldCondition(key=self._metadata_field("content_hash"), match=MatchAny(any=hashes)),
+                *self._tenant_filter().must,
+            ]))
+        if legacy:
+            # Only chunks that really have no hash, and aren't another tenant's
+            should.append(Filter(must=[
+                FieldCondition(key=self._metadata_field("source_file"), match=MatchAny(any=legacy)),
+                IsEmptyCondition(is_empty=PayloadField(key=self._metadata_field("content_hash"))),
+                self._tenant_filter(include_legacy=True),
+            ]))
+        return Filter(should=should)
+
+    def ingest_pdf(self, file_path: str, filename: str, on_progress=None):
+        """Ingests a PDF file into the vector database.
+
+        on_progress(pages_done, total_pages, chunks) is called after each
+        stored window of pages. An ingest of the same file that was cut short
+        resumes after its last stored window.
+        """
         if not self.initialized or self.vector_store is None:
             return "Error: RAG System not initialized. Check server logs for details."
 
@@ -67,60 +218,174 @@ class RAGSystem:
             return f"Error: File '{file_path}' not found."
         
         # Check if already uploaded
-        if filename in self.uploaded_pdfs:
+        if self.manifest.hash_for(filename) is not None:
             return f"PDF '{filename}' is already uploaded."
 
-        loader = PyPDFLoader(file_path)
-        documents = loader.load()
-        
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200
-        )
-        texts = text_splitter.split_documents(documents)
-        
-        # Add metadata to track which document each chunk belongs to
-        for doc in texts:
-            doc.metadata['source_file'] = filename
-        
-        # Add documents and get IDs
-        doc_ids = self.vector_store.add_documents(texts)
-        
+        # A byte-identical PDF under another name reuses the stored chunks
+        content_hash = file_sha256(file_path)
+        existing = self.manifest.get(content_hash)
+        if existing is not None:
+            self.manifest.add_alias(content_hash, filename)
+            return f"PDF '{filename}' is identical to '{existing['filenames'][0]}'; reused its {existing['chunks']} chunks."
+
+        # Resumed ingests keep the filename their stored chunks were tagged with
+        checkpoint = self.ingest_checkpoints.start(content_hash, filename)
+        source_file = checkpoint["filename"]
+
+        def on_window(pages_done, total_pages, point_ids):
+            chunks = self.ingest_checkpoints.commit(content_hash, pages_done, total_pages, len(point_ids))
+            if on_progress is not None:
+                on_progress(pages_done, total_pages, chunks)
+
+        # Parse, embed and upsert page windows in overlapping stages; chunks are tagged with their source file.
+        # They stay out of retrieval until the whole document is stored
+        metadata = {'source_file': source_file, 'content_hash': content_hash, 'tenant': self.tenant,
+                    'ingest_complete': False}
+        try:
+            stats = self.ingest_pipeline.ingest(
+                file_path, extra_metadata=metadata,
+                on_batch=self._index_points, on_window=on_window, start_page=checkpoint["pages_done"],
+                point_id=stable_point_ids(f"{self.tenant}:{content_hash}"),
+            )
+        except Exception as e:
+            pages_done = self.ingest_checkpoints.get(content_hash)["pages_done"]
+            print(f"Ingest of '{filename}' stopped after page {pages_done}: {e}")
+            return f"Error ingesting '{filename}' after page {pages_done}: {e}. Upload it again to resume."
+        finally:
+            self.lexical_index.save()
+            # Even a failed ingest may have upserted some chunks
+            self._bump_version()
+        stats.pop('point_ids')
+        self.last_ingest_stats = stats
+
+        try:
+            # Stable IDs make a window stored twice (or by an earlier run) the same points, so Qdrant has them all
+            doc_ids = self._document_point_ids(content_hash)
+            # Published before it is tracked: a crash in between leaves a checkpoint to finish, not a hidden document
+            self.client.set_payload(
+                collection_name=self.collection_name, payload={'ingest_complete': True},
+                points=FilterSelector(filter=self._documents_filter([content_hash])),
+                key=self.vector_store.metadata_payload_key,
+            )
+        except Exception as e:
+            print(f"Could not publish '{filename}': {e}")
+            return f"Error finishing '{filename}': {e}. Upload it again to retry."
+        finally:
+            self._bump_version()
+
         # Track uploaded PDF
-        self.uploaded_pdfs[filename] = {
-            'chunks': len(texts),
-            'doc_ids': doc_ids if doc_ids else []
-        }
+        self.manifest.add(content_hash, source_file, len(doc_ids), doc_ids)
+        if filename != source_file:
+            self.manifest.add_alias(content_hash, filename)
+        self.ingest_checkpoints.finish(content_hash)
         
-        return f"Successfully ingested {len(texts)} chunks from '{filename}'."
+        resumed = f", resumed at page {checkpoint['pages_done'] + 1}" if checkpoint["pages_done"] else ""
+        return (f"Successfully ingested {len(doc_ids)} chunks from '{filename}' "
+                f"({stats['pages_per_sec']:.1f} pages/s, {stats['chunks_per_sec']:.1f} chunks/s{resumed}).")
+
+    def _document_point_ids(self, content_hash: str) -> list:
+        """IDs of every stored chunk of a document."""
+        point_ids, offset = [], None
+        while True:
+            records, offset = self.client.scroll(self.collection_name, scroll_filter=self._documents_filter([content_hash]),
+                                                 limit=1024, offset=offset, with_payload=False, with_vectors=False)
+            point_ids.extend(record.id for record in records)
+            if offset is None:
+                return point_ids
+
+    def discard_ingest(self, content_hash: str):
+        """Deletes the stored chunks, lexical entries and checkpoint of an unfinished ingest."""
+        unfinished = Filter(must=[
+            FieldCondition(key=self._metadata_field("content_hash"), match=MatchValue(value=content_hash)),
+            FieldCondition(key=self._metadata_field("ingest_complete"), match=MatchValue(value=False)),
+            *self._tenant_filter().must,
+        ])
+        try:
+            self.client.delete(collection_name=self.collection_name, points_selector=FilterSelector(filter=unfinished))
+            if self.manifest.get(content_hash) is None:
+                self.lexical_index.remove_groups([(self.tenant, content_hash)])
+                self.lexical_index.save()
+        finally:
+            self._bump_version()
+        self.ingest_checkpoints.finish(content_hash)
+
+    def discard_pending_ingests(self, max_age: float = None) -> int:
+        """Discards every unfinished ingest, or those idle for max_age seconds; returns how many."""
+        pending = self.ingest_checkpoints.pending() if max_age is None else self.ingest_checkpoints.stale(max_age)
+        discarded = 0
+        for content_hash in pending:
+            if self.manifest.get(content_hash) is not None:
+                continue  # Published; its checkpoint is dropped at startup
+            try:
+                self.discard_ingest(content_hash)
+                discarded += 1
+            except Exception as e:
+                print(f"Could not discard unfinished ingest {content_hash[:12]}: {e}")
+        return discarded
 
     def delete_pdf(self, filename: str):
         """Deletes a PDF and its embeddings from the vector store."""
-        if filename not in self.uploaded_pdfs:
-            return f"Error: PDF '{filename}' not found."
+        return self.delete_pdfs([filename])
+
+    def delete_pdfs(self, filenames: list[str]):
+        """Deletes several PDFs and their embeddings with one filtered delete."""
+        for filename in filenames:
+            if self.manifest.hash_for(filename) is None:
+                return f"Error: PDF '{filename}' not found."
         
         try:
-            # Get all points and filter by source_file metadata
-            # Since we're using in-memory Qdrant, we'll delete by filtering
-            pdf_info = self.uploaded_pdfs[filename]
-            
-            # Delete from Qdrant by IDs if available
-            if pdf_info.get('doc_ids'):
-                self.client.delete(
-                    collection_name=self.collection_name,
-                    points_selector=pdf_info['doc_ids']
-                )
+            # Documents still reachable under another name keep their chunks
+            orphaned = self.manifest.orphans(filenames)
+            if orphaned:
+                try:
+                    self.client.delete(
+                        collection_name=self.collection_name,
+                        points_selector=FilterSelector(filter=self._documents_filter(list(orphaned)))
+                    )
+                    self.lexical_index.remove_groups(self._lexical_groups(orphaned))
+                    self.lexical_index.save()
+                finally:
+                    self._bump_version()
             
             # Remove from tracking
-            del self.uploaded_pdfs[filename]
+            self.manifest.remove_many(filenames)
             
-            return f"Successfully deleted '{filename}' and its {pdf_info['chunks']} chunks."
+            chunks = sum(entry['chunks'] for entry in orphaned.values())
+            if len(filenames) == 1:
+                if not orphaned:
+                    return f"Successfully deleted '{filenames[0]}'."
+                return f"Successfully deleted '{filenames[0]}' and its {chunks} chunks."
+            return f"Successfully deleted {len(filenames)} PDFs and {chunks} chunks."
         except Exception as e:
-            return f"Error deleting '{filename}': {e}"
+            return f"Error deleting {', '.join(repr(f) for f in filenames)}: {e}"
     
+    def _index_points(self, points):
+        """Adds a freshly upserted batch to the lexical index."""
+        content_key = self.vector_store.content_payload_key
+        metadata_key = self.vector_store.metadata_payload_key
+        for point in points:
+            metadata = point.payload[metadata_key]
+            self.lexical_index.add(point.id, point.payload[content_key],
+                                   (metadata.get('tenant') or "", metadata['content_hash']))
+
+    def _lexical_groups(self, content_hashes):
+        """This tenant's lexical index groups for the documents; unhashed chunks may predate tenants."""
+        groups = []
+        for content_hash in content_hashes:
+            groups.append((self.tenant, content_hash))
+            if content_hash.startswith("name:"):
+                groups.append(("", content_hash))
+        return groups
+
+    def _bump_version(self):
+        """Marks the collection as changed, which invalidates every cached retrieval result."""
+        with self._version_lock:
+            self.collection_version += 1
+        self.result_cache.clear()
+
     def get_uploaded_pdfs(self):
         """Returns list of uploaded PDF filenames."""
-        return list(self.uploaded_pdfs.keys())
+        return self.manifest.filenames()
     
     def retrieve(self, query: str, k: int = 5):
         """Retrieves and compresses relevant documents."""
@@ -128,9 +393,16 @@ class RAGSystem:
             print("RAG system not properly initialized")
             return []
         
+        key = (normalize_text(query), k, self.collection_version)
+        cached = self.result_cache.get(key)
+        if cached is not None:
+            record_event("retrieval_cache_hits")
+            record_event("retrieved_chunks", len(cached))
+            return list(cached)
+
         try:
-            # Base retriever
-            base_retriever = self.vector_store.as_retriever(search_kwargs={"k": k})
+            # Base retriever, built once in __init__
+            base_retriever = self.retriever
             
             # Compression retriever
             # compression_retriever = ContextualCompressionRetriever(
@@ -138,13 +410,45 @@ class RAGSystem:
             #     base_retriever=base_retriever
             # )
             
-            results = base_retriever.invoke(query)
+            if self.retrieval_mode == "hybrid":
+                results = self._hybrid_search(query, k)
+            else:
+                results = base_retriever.invoke(query, k=k)
             print(f"RAG retrieved {len(results)} documents")
-            return results
+            record_event("retrieved_chunks", len(results))
+            # A concurrent ingest/delete bumps the version, so a stale result is never served later
+            self.result_cache.set(key, results)
+            return list(results)
         except Exception as e:
             print(f"Error in RAG retrieval: {e}")
             return []
 
+    def _hybrid_search(self, query: str, k: int, fetch_k: int = None):
+        """Fuses dense and BM25 rankings with reciprocal rank fusion."""
+        fetch_k = fetch_k or max(4 * k, 20)
+        dense = self.retriever.invoke(query, k=fetch_k)
+        docs = {doc.metadata['_id']: doc for doc in dense}
+        dense_ids = list(docs)
+
+        # Chunks only the lexical side found still need their payloads, fetched only if retrieval may return them
+        sparse = [point_id for point_id, _ in self.lexical_index.search(query, fetch_k)]
+        missing = [point_id for point_id in sparse if point_id not in docs]
+        if missing:
+            content_key = self.vector_store.content_payload_key
+            metadata_key = self.vector_store.metadata_payload_key
+            owned = Filter(must=[HasIdCondition(has_id=missing), self._retrieval_filter()])
+            records, _ = self.client.scroll(self.collection_name, scroll_filter=owned, limit=len(missing),
+                                            with_payload=True, with_vectors=False)
+            found = {}
+            for record in records:
+                payload = record.payload or {}
+                metadata = dict(payload.get(metadata_key) or {}, _id=record.id, _collection_name=self.collection_name)
+                found[record.id] = Document(page_content=payload.get(content_key) or "", metadata=metadata)
+            sparse = [point_id for point_id in sparse if point_id in docs or point_id in found]
+            docs.update(found)
+        ranked = reciprocal_rank_fusion([dense_ids, sparse])[:k]
+        return [docs[point_id] for point_id in ranked if point_id in docs]
+
 if __name__ == "__main__":
     # Test RAG
     # Create a dummy PDF first if needed
@@ -0,0 +1,109 @@
+import os
+import threading
+import numpy as np
+
+# Labeled exemplars for the local router. "rag" also covers greetings and
+# anything else that isn't about live weather, matching the LLM router prompt.
+DEFAULT_EXAMPLES = {
+    "weather": [
+        "What's the weather in Paris?",
+        "Weather in Tokyo",
+        "How hot is it in Delhi right now?",
+        "Is it raining in London today?",
+        "What is the temperature in New York?",
+        "Will I need an umbrella in Seattle?",
+        "How windy is it in Chicago?",
+        "What's the humidity in Mumbai?",
+        "Current weather conditions in Berlin",
+        "Is it cold outside in Toronto?",
+        "tokyo weather now",
+        "Tell me about the weather in Sydney.",
+    ],
+    "rag": [
+        "Summarize the document.",
+        "What does the PDF say about installation?",
+        "According to the manual, how do I reset the device?",
+        "What are the key points in the uploaded file?",
+        "Explain section 3 of the report.",
+        "Who is the author of this paper?",
+        "What is the content of the document?",
+        "List the requirements mentioned in the specification.",
+        "Hello",
+        "Hi there, how are you?",
+        "What can you help me with?",
+        "Who won the world cup?",
+    ],
+}
+
+
+class SemanticRouter:
+    """Routes queries locally by cosine similarity to labeled exemplar centroids."""
+
+    def __init__(self, embeddings, examples: dict = None, margin_threshold: float = None):
+        self.embeddings = embeddings
+        self.examples = examples or DEFAULT_EXAMPLES
+        if margin_threshold is None:
+            margin_threshold = float(os.getenv("ROUTER_MARGIN_THRESHOLD", "0.1"))
+        self.margin_threshold = margin_threshold
+
+        self._labels = None
+        self._centroids = None
+        self._lock = threading.Lock()
+        self._fast_path = 0
+        self._fallback = 0
+
+    def _ensure_centroids(self):
+        """Embeds the exemplars once and caches one normalized centroid per label."""
+        if self._centroids is not None:
+            return
+        with self._lock:
+            if self._centroids is not None:
+                return
+            labels = list(self.examples.keys())
+            centroids = []
+            for label in labels:
+                vectors = np.asarray(self.embeddings.embed_documents(self.examples[label]), dtype=np.float32)
+                vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+                centroid = vectors.mean(axis=0)
+                centroids.append(centroid / (np.linalg.norm(centroid) + 1e-12))
+            self._labels = labels
+            self._centroids = np.stack(centroids)
+
+    def classify(self, query: str) -> tuple[str, float]:
+        """Returns the best label and its cosine margin over the runner-up."""
+        self._ensure_centroids()
+        vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        vector /= np.linalg.norm(vector) + 1e-12
+        scores = self._centroids @ vector
+
+        order = np.argsort(scores)[::-1]
+        best = order[0]
+        margin = float(scores[best] - scores[order[1]]) if len(order) > 1 else float(scores[best])
+        return self._labels[best], margin
+
+    def route(self, query: str):
+        """Returns a label when the margin clears the threshold, else None (use the LLM)."""
+        try:
+            label, margin = self.classify(query)
+        except Exception as e:
+            print(f"Semantic router error, falling back to LLM: {e}")
+            return None
+        return label if margin >= self.margin_threshold else None
+
+    def record(self, skipped_llm: bool):
+        """Counts a routing decision; callers report whether the local route actually saved the LLM call."""
+        with self._lock:
+            if skipped_llm:
+                self._fast_path += 1
+            else:
+                self._fallback += 1
+
+    def stats(self) -> dict:
+        """Returns fast-path vs LLM-fallback counts."""
+        with self._lock:
+            total = self._fast_path + self._fallback
+            return {
+                "fast_path": self._fast_path,
+                "fallback": self._fallback,
+                "fast_path_rate": self._fast_path / total if total else 0.0,
+            }
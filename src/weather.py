@@ -1,41 +1,310 @@
 import os
+import json
+import time
+import asyncio
+import threading
+import weakref
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+from src.metrics import record_event
+from src.outbound import OutboundProvider, RateLimitQueueFull, outbound
 
 load_dotenv()
 
+
+def normalize_city(city: str) -> str:
+    """Cache key for a city name: lowercased with collapsed whitespace."""
+    return " ".join(city.strip().lower().split())
+
+
+def merge_weather(cities: list[str], results: list[str]) -> str:
+    """One context block for all cities: a single result as is, otherwise one compact line per city."""
+    if len(results) == 1:
+        return results[0]
+    lines = [f"Current weather for {len(results)} cities:"]
+    for city, result in zip(cities, results):
+        prefix = f"Weather in {city}: "
+        lines.append(f"- {city}: {result[len(prefix):] if result.startswith(prefix) else result}")
+    return "\n".join(lines)
+
+
+class WeatherCache:
+    """Bounded LRU cache with a TTL and a stale-while-revalidate window."""
+
+    def __init__(self, max_size: int = 256, ttl: float = 600, stale_ttl: float = 1800, path: str = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl  # How long past the TTL an entry may still be served
+        self.path = path
+        self._entries = OrderedDict()  # {key: (value, fetched_at)}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._counters = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "evictions": 0}
+        if self.path:
+            self._load()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_size=int(os.getenv("WEATHER_CACHE_SIZE", "256")),
+            ttl=float(os.getenv("WEATHER_CACHE_TTL", "600")),
+            stale_ttl=float(os.getenv("WEATHER_CACHE_STALE_TTL", "1800")),
+            path=os.getenv("WEATHER_CACHE_PATH") or None,
+        )
+
+    def get(self, key: str):
+        """Returns (value, state) where state is "fresh", "stale" or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, fetched_at = entry
+                age = time.time() - fetched_at
+                if age < self.ttl:
+                    self._entries.move_to_end(key)
+                    self._counters["hits"] += 1
+                    return value, "fresh"
+                if age < self.ttl + self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    self._counters["stale_hits"] += 1
+                    return value, "stale"
+                del self._entries[key]
+            self._counters["misses"] += 1
+            return None, None
+
+    def set(self, key: str, value: str):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+            snapshot = list(self._entries.items()) if self.path else None
+        if snapshot is not None:
+            self._save(snapshot)
+
+    def begin_refresh(self, key: str) -> bool:
+        """Claims the background refresh for a key; False if one is already running."""
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            self._counters["refreshes"] += 1
+            return True
+
+    def end_refresh(self, key: str):
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters)
+            stats["size"] = len(self._entries)
+        lookups = stats["hits"] + stats["stale_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] + stats["stale_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                items = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for key, value, fetched_at in items[-self.max_size:]:
+            if now - fetched_at < self.ttl + self.stale_ttl:
+                self._entries[key] = (value, fetched_at)
+
+    def _save(self, snapshot):
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with self._save_lock:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump([[key, value, fetched_at] for key, (value, fetched_at) in snapshot], f)
+                os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not persist weather cache: {e}")
+
+
 class WeatherAPI:
-    def __init__(self):
+    def __init__(self, cache: WeatherCache = None, max_concurrency: int = None, max_cities: int = None,
+                 provider: OutboundProvider = None):
         self.api_key = os.getenv("OPENWEATHERMAP_API_KEY")
-        self.base_url = "https://api.openweathermap.org/data/2.5/weather"
+        # Overridable so benchmarks and staging can point at a local stand-in
+        self.base_url = os.getenv("OPENWEATHERMAP_URL", "https://api.openweathermap.org/data/2.5/weather")
+        self.cache = cache if cache is not None else WeatherCache.from_env()
+        # Coalesces identical in-flight lookups, rate limits them and retries 429s; shared process-wide
+        self.provider = provider if provider is not None else outbound("openweathermap")
+        # Fetches in flight at once, which also sizes the sync and async connection pools
+        self.max_concurrency = max_concurrency or int(os.getenv("WEATHER_MAX_CONCURRENCY", "8"))
+        self.max_cities = max_cities or int(os.getenv("WEATHER_MAX_CITIES", "5"))  # Per question
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._async_clients = weakref.WeakKeyDictionary()  # {event loop: httpx.AsyncClient}
+        self._refresh_tasks = set()
 
     def get_weather(self, city: str) -> str:
-        """Fetch current weather for a given city."""
+        """Fetch current weather for a given city, serving cached results when possible."""
         if not self.api_key:
             return "Error: OpenWeatherMap API key not found."
 
-        params = {
+        key = normalize_city(city)
+        cached, state = self.cache.get(key)
+        if state is not None:
+            record_event("weather_cache_hits")
+        if state == "fresh":
+            return cached
+        if state == "stale":
+            # Serve the stale answer now and refresh it off the request path
+            if self.cache.begin_refresh(key):
+                threading.Thread(target=self._refresh, args=(city, key), daemon=True).start()
+            return cached
+
+        record_event("weather_requests")
+        result = self._fetch(city)
+        if not result.startswith("Error"):
+            self.cache.set(key, result)
+        return result
+
+    def _select(self, cities: list[str]) -> list[str]:
+        """Distinct cities in order of mention, at most max_cities."""
+        seen, selected = set(), []
+        for city in cities:
+            key = normalize_city(city)
+            if key and key not in seen:
+                seen.add(key)
+                selected.append(city.strip())
+        return selected[:self.max_cities]
+
+    def get_weather_many(self, cities: list[str]) -> str:
+        """Weather for several cities, fetched concurrently and merged into one context block.
+
+        Takes about as long as the slowest fetch; at most max_concurrency run at once.
+        """
+        cities = self._select(cities)
+        if len(cities) <= 1:
+            return merge_weather(cities, [self.get_weather(city) for city in cities])
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="weather")
+        # Each fetch runs in a copy of the caller's context, so metrics still attribute it to the node
+        futures = [self._executor.submit(contextvars.copy_context().run, self.get_weather, city) for city in cities]
+        return merge_weather(cities, [future.result() for future in futures])
+
+    def _refresh(self, city: str, key: str):
+        try:
+            result = self._fetch(city)
+            if not result.startswith("Error"):
+                self.cache.set(key, result)
+        finally:
+            self.cache.end_refresh(key)
+
+    def _params(self, city: str) -> dict:
+        return {
             "q": city,
             "appid": self.api_key,
             "units": "metric"
         }
 
+    def _format(self, city: str, data: dict) -> str:
+        weather_desc = data["weather"][0]["description"]
+        temp = data["main"]["temp"]
+        feels_like = data["main"]["feels_like"]
+        humidity = data["main"]["humidity"]
+        wind_speed = data["wind"]["speed"]
+        
+        return (f"Weather in {city}: {weather_desc}. "
+                f"Temperature: {temp}°C (Feels like: {feels_like}°C). "
+                f"Humidity: {humidity}%. Wind Speed: {wind_speed} m/s.")
+
+    def _request(self, city: str) -> dict:
+        response = self._session.get(self.base_url, params=self._params(city), verify=False, timeout=10.0)
+        response.raise_for_status()
+        return response.json()
+
+    def _fetch(self, city: str) -> str:
+        """Fetch current weather for a given city from OpenWeatherMap."""
         try:
-            response = requests.get(self.base_url, params=params,verify=False)
-            response.raise_for_status()
-            data = response.json()
-            
-            weather_desc = data["weather"][0]["description"]
-            temp = data["main"]["temp"]
-            feels_like = data["main"]["feels_like"]
-            humidity = data["main"]["humidity"]
-            wind_speed = data["wind"]["speed"]
-            
-            return (f"Weather in {city}: {weather_desc}. "
-                    f"Temperature: {temp}°C (Feels like: {feels_like}°C). "
-                    f"Humidity: {humidity}%. Wind Speed: {wind_speed} m/s.")
+            # Concurrent lookups of the same city share one request
+            return self._format(city, self.provider.call(lambda: self._request(city), key=normalize_city(city)))
         
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, RateLimitQueueFull) as e:
+            return f"Error fetching weather data: {e}"
+        except KeyError:
+            return f"Error: Could not parse weather data for city '{city}'."
+
+    # --- Async API ---
+
+    def _async_client(self) -> httpx.AsyncClient:
+        """One AsyncClient per running event loop, since pooled connections can't cross loops."""
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+            client = httpx.AsyncClient(verify=False, timeout=10.0, limits=limits)
+            self._async_clients[loop] = client
+        return client
+
+    async def aget_weather(self, city: str) -> str:
+        """Async variant of get_weather sharing the same cache."""
+        if not self.api_key:
+            return "Error: OpenWeatherMap API key not found."
+
+        key = normalize_city(city)
+        cached, state = self.cache.get(key)
+        if state is not None:
+            record_event("weather_cache_hits")
+        if state == "fresh":
+            return cached
+        if state == "stale":
+            if self.cache.begin_refresh(key):
+                task = asyncio.create_task(self._arefresh(city, key))
+                # Keep a reference so the task isn't garbage collected mid-flight
+                self._refresh_tasks.add(task)
+                task.add_done_callback(self._refresh_tasks.discard)
+            return cached
+
+        record_event("weather_requests")
+        result = await self._afetch(city)
+        if not result.startswith("Error"):
+            self.cache.set(key, result)
+        return result
+
+    async def aget_weather_many(self, cities: list[str]) -> str:
+        """Async get_weather_many; the client's pool limits how many requests are in flight."""
+        cities = self._select(cities)
+        results = await asyncio.gather(*(self.aget_weather(city) for city in cities))
+        return merge_weather(cities, list(results))
+
+    async def _arefresh(self, city: str, key: str):
+        try:
+            result = await self._afetch(city)
+            if not result.startswith("Error"):
+                self.cache.set(key, result)
+        finally:
+            self.cache.end_refresh(key)
+
+    async def _arequest(self, city: str) -> dict:
+        response = await self._async_client().get(self.base_url, params=self._params(city))
+        response.raise_for_status()
+        return response.json()
+
+    async def _afetch(self, city: str) -> str:
+        try:
+            data = await self.provider.acall(lambda: self._arequest(city), key=normalize_city(city))
+            return self._format(city, data)
+        except (httpx.HTTPError, RateLimitQueueFull) as e:
             return f"Error fetching weather data: {e}"
         except KeyError:
             return f"Error: Could not parse weather data for city '{city}'."
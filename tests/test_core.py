@@ -1,17 +1,55 @@
+import os
+import sys
+import time
+import json
+import math
+import random
+import threading
+import asyncio
+import numpy as np
+import httpx
 import pytest
-from unittest.mock import MagicMock, patch
-from src.weather import WeatherAPI
-from src.nodes import router_node, weather_node
+import subprocess
+from unittest.mock import AsyncMock, MagicMock, patch
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from langchain_core.embeddings import Embeddings
+from src.weather import WeatherAPI, WeatherCache
+from src.nodes import router_node, fused_router_node, weather_node, FusedRouterOutput, RouterOutput, CityExtraction, aweather_node
+from src.graph import build_graph, stream_graph
 from src.rag import RAGSystem
+from src.components import Components, components
+from src.router import SemanticRouter
+from src.llm import LLMClientRegistry
+from src.ingest import IngestPipeline, stable_point_ids
+from src.embedding_cache import EmbeddingCache, CachedEmbeddings
+from src.manifest import DocumentManifest, IngestCheckpoints, file_sha256
+from src.lexical import BM25Index, STOPWORDS, reciprocal_rank_fusion, tokenize
+from src.context import ContextPacker, overlap_length
+from src.history import ConversationHistory
+from src.checkpoint import SQLiteCheckpointer
+from src.metrics import GraphMetrics
+from src.outbound import OutboundProvider, RateLimitQueueFull, TokenBucket
+from src.evaluation import EvaluationRunner, JudgeCache, load_dataset
+from src.answer_cache import SemanticAnswerCache
+from src.collection_profiles import get_profile, collection_config, migrate_collection, estimate_ram_bytes, profile_drift
+from src.embeddings import OnnxEmbeddings, build_embeddings, cache_model_name, token_budget_batches, mean_pool
+from qdrant_client import QdrantClient
+from qdrant_client.models import VectorParams, Distance
 
 # Mock env vars
 @pytest.fixture(autouse=True)
 def mock_env(monkeypatch):
     monkeypatch.setenv("OPENWEATHERMAP_API_KEY", "fake_key")
     monkeypatch.setenv("GROQ_API_KEY", "fake_key")
+    monkeypatch.setenv("CHECKPOINT_DB_PATH", "")
+    monkeypatch.setenv("INGEST_CHECKPOINT_PATH", "")
+    # Providers are built once per process; keep the shared rate limits from pacing the suite
+    monkeypatch.setenv("OPENWEATHERMAP_RATE_LIMIT", "0")
+    monkeypatch.setenv("GROQ_RATE_LIMIT", "0")
 
 def test_weather_api_success():
-    with patch("src.weather.requests.get") as mock_get:
+    with patch("src.weather.requests.Session.get") as mock_get:
         mock_response = MagicMock()
         mock_response.status_code = 200
         mock_response.json.return_value = {
@@ -26,40 +64,1269 @@ def test_weather_api_success():
         assert "Weather in London: sunny" in result
         assert "Temperature: 25°C" in result
 
+def _weather_response():
+    mock_response = MagicMock()
+    mock_response.json.return_value = {
+        "weather": [{"description": "sunny"}],
+        "main": {"temp": 25, "feels_like": 27, "humidity": 60},
+        "wind": {"speed": 5}
+    }
+    return mock_response
+
+def test_weather_cache_hit_skips_request():
+    with patch("src.weather.requests.Session.get", return_value=_weather_response()) as mock_get:
+        weather = WeatherAPI(cache=WeatherCache(ttl=60))
+        first = weather.get_weather("London")
+        second = weather.get_weather("  london ")
+        assert first == second
+        assert mock_get.call_count == 1
+        assert weather.cache.stats()["hits"] == 1
+
+def test_weather_cache_serves_stale_and_refreshes(tmp_path):
+    cache_path = str(tmp_path / "weather.json")
+    cache = WeatherCache(ttl=60, stale_ttl=600, path=cache_path)
+    cache.set("london", "Weather in London: old")
+    cache._entries["london"] = ("Weather in London: old", 0)  # Force staleness
+    cache.stale_ttl = float("inf")
+
+    with patch("src.weather.requests.Session.get", return_value=_weather_response()) as mock_get:
+        weather = WeatherAPI(cache=cache)
+        assert weather.get_weather("London") == "Weather in London: old"
+        for _ in range(100):
+            if not cache._refreshing:
+                break
+            time.sleep(0.01)
+        assert mock_get.call_count == 1
+        assert cache.get("london")[1] == "fresh"
+        assert cache.stats()["stale_hits"] == 1
+
+    # A warm cache survives a restart
+    assert "sunny" in WeatherCache(ttl=60, path=cache_path).get("london")[0]
+
 
 # Mock Pydantic models
 class MockRouterOutput:
     def __init__(self, source):
         self.source = source
 
+def _empty_rag():
+    rag = MagicMock()
+    rag.retrieve.return_value = []
+    return rag
+
 class MockCityExtraction:
-    def __init__(self, city):
-        self.city = city
+    def __init__(self, cities):
+        self.cities = cities
 
 def test_router_node_weather():
     # Mock LLM to return "WEATHER"
-    with patch("src.nodes.llm") as mock_llm:
-        mock_llm.with_structured_output.return_value.invoke.return_value = MockRouterOutput(source="weather")
+    with components.override(semantic_router=None), patch("src.nodes.get_llm") as mock_get_llm:
+        mock_get_llm.return_value.with_structured_output.return_value.invoke.return_value = MockRouterOutput(source="weather")
         state = {"question": "What's the weather in Paris?", "context": "", "answer": "", "source": ""}
         result = router_node(state)
         assert result["source"] == "weather"
 
 def test_router_node_rag():
-    with patch("src.nodes.llm") as mock_llm:
-        mock_llm.with_structured_output.return_value.invoke.return_value = MockRouterOutput(source="rag")
+    with components.override(semantic_router=None), patch("src.nodes.get_llm") as mock_get_llm:
+        mock_get_llm.return_value.with_structured_output.return_value.invoke.return_value = MockRouterOutput(source="rag")
         state = {"question": "Summarize the document.", "context": "", "answer": "", "source": ""}
         result = router_node(state)
         assert result["source"] == "rag"
 
 def test_weather_node():
-    with patch("src.nodes.llm") as mock_llm:
+    with patch("src.nodes.get_llm") as mock_get_llm:
         # Mock city extraction
-        mock_llm.with_structured_output.return_value.invoke.return_value = MockCityExtraction(city="London")
+        mock_get_llm.return_value.with_structured_output.return_value.invoke.return_value = MockCityExtraction(cities=["London"])
         
-        with patch("src.nodes.weather_api.get_weather") as mock_weather:
+        with patch.object(components.get("weather_api"), "get_weather") as mock_weather:
             mock_weather.return_value = "Sunny in London"
             state = {"question": "Weather in London", "context": "", "answer": "", "source": "weather"}
             result = weather_node(state)
             assert result["context"] == "Sunny in London"
 
+def test_weather_api_async_fetch():
+    def handler(request):
+        assert request.url.params["q"] == "Paris"
+        return httpx.Response(200, json=_weather_response().json.return_value)
+
+    async def run():
+        weather = WeatherAPI(cache=WeatherCache(ttl=60))
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with patch.object(weather, "_async_client", return_value=client):
+            return await weather.aget_weather("Paris"), weather.cache.stats()
+
+    result, stats = asyncio.run(run())
+    assert "Weather in Paris: sunny" in result
+    assert stats["misses"] == 1
+
+def test_async_weather_node_fetches_cities_concurrently():
+    async def slow_weather(city):
+        await asyncio.sleep(0.2)
+        return f"Sunny in {city}"
+
+    with patch.object(components.get("weather_api"), "aget_weather", side_effect=slow_weather):
+        state = {"question": "Paris or Rome?", "source": "weather", "cities": ["Paris", "Rome"]}
+        started = time.perf_counter()
+        result = asyncio.run(aweather_node(state))
+        assert time.perf_counter() - started < 0.35
+        assert result["context"] == "Current weather for 2 cities:\n- Paris: Sunny in Paris\n- Rome: Sunny in Rome"
+
+def test_async_graph_streams_end_to_end():
+    with components.override(semantic_router=None), patch("src.nodes.get_async_llm") as mock_get_llm, \
+            patch.object(components.get("weather_api"), "aget_weather", AsyncMock(return_value="Sunny in Paris")):
+        llm = mock_get_llm.return_value
+        llm.with_structured_output.return_value.ainvoke = AsyncMock(
+            side_effect=[RouterOutput(source="weather"), CityExtraction(cities=["Paris"])]
+        )
+        llm.ainvoke = AsyncMock(return_value=AIMessage(content="It is sunny in Paris."))
+
+        graph = build_graph(async_nodes=True)
+        config = {"configurable": {"thread_id": "async-test"}}
+        outputs = list(stream_graph(graph, {"question": "Weather in Paris?"}, config))
+
+    assert [list(output) for output in outputs] == [["router"], ["weather"], ["generate"]]
+    assert outputs[-1]["generate"]["answer"] == "It is sunny in Paris."
+
+def test_generate_streams_tokens_and_checkpoints_answer():
+    llm = GenericFakeChatModel(messages=iter([AIMessage(content="Please upload a document first.")]))
+    router = SemanticRouter(KeywordEmbeddings(), margin_threshold=0.1)
+    with components.override(semantic_router=router), patch("src.nodes.get_llm", return_value=llm), \
+            components.override(rag_system=_empty_rag()):
+        graph = build_graph()
+        config = {"configurable": {"thread_id": "stream-test"}}
+        tokens = [
+            chunk[0].content
+            for mode, chunk in graph.stream({"question": "Summarize it"}, config, stream_mode=["updates", "messages"])
+            if mode == "messages" and chunk[1]["langgraph_node"] == "generate" and isinstance(chunk[0], AIMessageChunk)
+        ]
+
+    assert len(tokens) > 1
+    assert "".join(tokens) == "Please upload a document first."
+    assert graph.get_state(config).values["messages"][-1].content == "Please upload a document first."
+
+def test_fused_router_returns_route_and_cities():
+    with components.override(semantic_router=None), patch("src.nodes.get_llm") as mock_get_llm:
+        mock_get_llm.return_value.with_structured_output.return_value.invoke.return_value = FusedRouterOutput(
+            source="weather", cities=["Paris", " "]
+        )
+        state = {"question": "Weather in Paris?", "context": "", "answer": "", "source": ""}
+        assert fused_router_node(state) == {"source": "weather", "cities": ["Paris"]}
+        mock_get_llm.return_value.with_structured_output.assert_called_once_with(FusedRouterOutput)
+
+def test_weather_node_extracts_and_merges_several_cities():
+    def slow_weather(city):
+        time.sleep(0.2)
+        return f"Weather in {city}: haze. Temperature: 31°C."
+
+    with patch("src.nodes.get_llm") as mock_get_llm, \
+            patch.object(components.get("weather_api"), "get_weather", side_effect=slow_weather) as mock_weather:
+        mock_get_llm.return_value.with_structured_output.return_value.invoke.return_value = CityExtraction(
+            cities=["Delhi", "Mumbai", "delhi ", "Pune"]
+        )
+        state = {"question": "Compare weather in Delhi, Mumbai and Pune", "source": "weather"}
+        started = time.perf_counter()
+        result = weather_node(state)
+
+    assert time.perf_counter() - started < 0.35  # Close to one fetch, not three
+    assert mock_weather.call_count == 3  # "delhi " is the same city
+    assert result["context"] == ("Current weather for 3 cities:\n- Delhi: haze. Temperature: 31°C.\n"
+                                 "- Mumbai: haze. Temperature: 31°C.\n- Pune: haze. Temperature: 31°C.")
+
+def test_weather_many_caps_cities_and_reports_errors_per_city():
+    weather = WeatherAPI(cache=WeatherCache(ttl=60), max_cities=2)
+    with patch.object(weather, "get_weather", side_effect=lambda city: "Error fetching weather data: 404"):
+        context = weather.get_weather_many(["Atlantis", "Lemuria", "Mu"])
+    assert context == ("Current weather for 2 cities:\n- Atlantis: Error fetching weather data: 404\n"
+                       "- Lemuria: Error fetching weather data: 404")
+
+def test_weather_node_uses_fused_cities_without_llm():
+    with patch("src.nodes.get_llm") as mock_get_llm, patch.object(components.get("weather_api"), "get_weather") as mock_weather:
+        mock_weather.return_value = "Sunny in Paris"
+        state = {"question": "Weather in Paris?", "context": "", "answer": "", "source": "weather", "cities": ["Paris"]}
+        assert weather_node(state)["context"] == "Sunny in Paris"
+        mock_get_llm.assert_not_called()
+
+
+class KeywordEmbeddings:
+    """Fake embeddings: one axis for weather words, one for everything else."""
+    def embed_query(self, text):
+        words = text.lower()
+        weather = sum(w in words for w in ("weather", "rain", "temperature", "hot", "windy"))
+        return [float(weather), 1.0 if weather == 0 else 0.2]
+
+    def embed_documents(self, texts):
+        return [self.embed_query(t) for t in texts]
+
+def test_semantic_router_fast_path():
+    router = SemanticRouter(KeywordEmbeddings(), margin_threshold=0.1)
+    assert router.route("Is it raining in Oslo?") == "weather"
+    assert router.route("Summarize chapter two") == "rag"
+
+def test_semantic_router_low_margin_falls_back():
+    router = SemanticRouter(KeywordEmbeddings(), margin_threshold=2.0)
+    assert router.route("Is it raining in Oslo?") is None
+    with components.override(semantic_router=router), patch("src.nodes.get_llm") as mock_get_llm:
+        mock_get_llm.return_value.with_structured_output.return_value.invoke.return_value = RouterOutput(source="weather")
+        router_node({"question": "Is it raining in Oslo?", "context": "", "answer": "", "source": ""})
+    assert router.stats() == {"fast_path": 0, "fallback": 1, "fast_path_rate": 0.0}
+
+def test_router_node_fast_path_skips_llm():
+    router = SemanticRouter(KeywordEmbeddings(), margin_threshold=0.1)
+    with components.override(semantic_router=router), patch("src.nodes.get_llm") as mock_get_llm:
+        state = {"question": "What's the weather in Paris?", "context": "", "answer": "", "source": ""}
+        assert router_node(state) == {"source": "weather", "cities": []}
+        mock_get_llm.assert_not_called()
+    assert router.stats()["fast_path"] == 1
+
+def test_fused_router_counts_only_routes_that_skip_the_llm():
+    router = SemanticRouter(KeywordEmbeddings(), margin_threshold=0.1)
+    with components.override(semantic_router=router), patch("src.nodes.get_llm") as mock_get_llm:
+        mock_get_llm.return_value.with_structured_output.return_value.invoke.return_value = \
+            FusedRouterOutput(source="weather", cities=["Paris"])
+        fused_router_node({"question": "What's the weather in Paris?", "context": "", "answer": "", "source": ""})
+        fused_router_node({"question": "Summarize chapter two", "context": "", "answer": "", "source": ""})
+    # A confident "weather" still needs the LLM for its cities
+    assert router.stats() == {"fast_path": 1, "fallback": 1, "fast_path_rate": 0.5}
+
+
+def test_llm_registry_reuses_clients():
+    registry = LLMClientRegistry()
+    first = registry.get("gsk_one")
+    assert registry.get("gsk_one") is first
+    assert registry.get("gsk_two") is not first
+    assert registry.get("gsk_one", model="other-model") is not first
+    assert registry.stats()["clients"] == 3
+
+def test_llm_registry_pool_reuses_connections():
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import threading
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"ok")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        registry = LLMClientRegistry()
+        for _ in range(3):
+            registry.http_client.get(f"http://127.0.0.1:{server.server_port}/")
+        stats = registry.stats()
+        assert stats["requests"] == 3
+        assert stats["connections_opened"] == 1
+        assert stats["connections_reused"] == 2
+    finally:
+        server.shutdown()
+
+
+def _make_pdf(path, pages):
+    """Writes a minimal PDF with one line of Helvetica text per page."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+    out, offsets = b"%PDF-1.4\n", []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("latin-1")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    path.write_bytes(out)
+    return str(path)
+
+@pytest.mark.parametrize("min_parallel_pages", [100, 1])
+def test_ingest_pipeline_batches_and_upserts(tmp_path, min_parallel_pages):
+    pdf = _make_pdf(tmp_path / "manual.pdf", [f"Page {i} about rain and weather" for i in range(6)])
+    client = QdrantClient(":memory:")
+    client.create_collection("docs", vectors_config=VectorParams(size=2, distance=Distance.COSINE))
+    pipeline = IngestPipeline(client, "docs", KeywordEmbeddings(), embed_batch_size=4,
+                              parse_workers=2, min_parallel_pages=min_parallel_pages)
+
+    stats = pipeline.ingest(pdf, extra_metadata={"source_file": "manual.pdf"})
+
+    assert stats["pages"] == 6 and stats["chunks"] == 6 and stats["batches"] == 2
+    assert stats["pages_per_sec"] > 0 and stats["chunks_per_sec"] > 0
+    points, _ = client.scroll("docs", limit=10, with_payload=True)
+    assert len(points) == 6
+    pages = sorted(point.payload["metadata"]["page"] for point in points)
+    assert pages == list(range(6))
+    assert all(point.payload["metadata"]["source_file"] == "manual.pdf" for point in points)
+    assert any("Page 3 about rain" in point.payload["page_content"] for point in points)
+
+
+@pytest.mark.parametrize("min_parallel_pages", [100, 1])
+def test_ingest_pipeline_streams_page_windows_and_resumes(tmp_path, min_parallel_pages):
+    pdf = _make_pdf(tmp_path / "manual.pdf", [f"Page {i} about rain" for i in range(7)])
+    client = QdrantClient(":memory:")
+    client.create_collection("docs", vectors_config=VectorParams(size=2, distance=Distance.COSINE))
+    pipeline = IngestPipeline(client, "docs", KeywordEmbeddings(), embed_batch_size=2, parse_workers=2,
+                              min_parallel_pages=min_parallel_pages, window_pages=3)
+    windows = []
+
+    stats = pipeline.ingest(pdf, on_window=lambda done, total, ids: windows.append((done, total, len(ids))),
+                            point_id=stable_point_ids("manual"))
+    assert windows == [(3, 7, 3), (6, 7, 3), (7, 7, 1)]
+    assert stats["windows"] == 3 and stats["max_window_chunks"] == 3 and stats["chunks"] == 7
+
+    # Resuming re-upserts the same points from the start page on
+    resumed = pipeline.ingest(pdf, start_page=6, point_id=stable_point_ids("manual"))
+    assert resumed["pages"] == 1 and resumed["point_ids"] == stats["point_ids"][6:]
+    assert client.count("docs").count == 7
+
+
+def test_embedding_cache_embeds_only_new_chunks(tmp_path):
+    model = MagicMock(wraps=KeywordEmbeddings())
+    cache = EmbeddingCache(path=str(tmp_path / "cache"), dim=2, max_entries=8)
+    embeddings = CachedEmbeddings(model, cache, model_name="fake")
+
+    first = embeddings.embed_documents(["rain today", "chapter one", "rain today"])
+    model.embed_documents.assert_called_once_with(["rain today", "chapter one"])
+    assert first[0] == first[2]
+
+    second = embeddings.embed_documents(["chapter one", "chapter two"])
+    assert model.embed_documents.call_args.args[0] == ["chapter two"]
+    assert second[0] == pytest.approx(first[1], abs=1e-3)  # float16 storage
+    assert cache.stats()["hits"] == 1
+
+    # Survives a restart; a different model name doesn't share entries
+    reopened = EmbeddingCache(path=str(tmp_path / "cache"), dim=2, max_entries=8)
+    hit, miss = reopened.get_many([EmbeddingCache.key("fake", "rain today"), EmbeddingCache.key("other", "rain today")])
+    assert hit == pytest.approx(first[0], abs=1e-3) and miss is None
+
+def test_embedding_cache_evicts_least_recently_used():
+    cache = EmbeddingCache(dim=2, max_entries=2)
+    cache.put_many([("a", [1.0, 0.0]), ("b", [0.0, 1.0])])
+    cache.get_many(["a"])
+    cache.put_many([("c", [1.0, 1.0])])
+    assert cache.get_many(["a", "b", "c"]) == [[1.0, 0.0], None, [1.0, 1.0]]
+    assert cache.stats()["evictions"] == 1
+
+
+def test_embedding_cache_journal_never_maps_a_key_to_another_keys_vector(tmp_path):
+    path = str(tmp_path / "cache")
+    cache = EmbeddingCache(path=path, dim=2, max_entries=2)
+    cache.put_many([("a", [1.0, 0.0]), ("b", [0.0, 1.0])])
+
+    # Crash after "a"'s slot was dropped from the journal, before "c" was recorded
+    with patch.object(cache, "_vectors", wraps=cache._vectors) as vectors:
+        vectors.flush.side_effect = OSError("disk gone")
+        with pytest.raises(OSError):
+            cache.put_many([("c", [1.0, 1.0])])
+    reopened = EmbeddingCache(path=path, dim=2, max_entries=2)
+    assert reopened.get_many(["a", "b", "c"]) == [None, [0.0, 1.0], None]
+
+    # The journal folds into a snapshot that survives a restart
+    reopened.put_many([("d", [1.0, 1.0])])
+    reopened._compact()
+    again = EmbeddingCache(path=path, dim=2, max_entries=2)
+    assert again.get_many(["b", "d"]) == [[0.0, 1.0], [1.0, 1.0]]
+    assert not os.path.exists(os.path.join(path, "index.0.log"))
+
+
+class PaddedEmbeddings(KeywordEmbeddings, Embeddings):
+    """KeywordEmbeddings padded to the 384 dimensions RAGSystem's collection expects."""
+    def __init__(self):
+        self.document_calls = 0
+        self.query_calls = 0
+
+    def embed_query(self, text):
+        self.query_calls += 1
+        return super().embed_query(text) + [0.0] * 382
+
+    def embed_documents(self, texts):
+        self.document_calls += 1
+        return [KeywordEmbeddings.embed_query(self, text) + [0.0] * 382 for text in texts]
+
+def _rag_system(tmp_path, client=None):
+    return RAGSystem(
+        client=client or QdrantClient(":memory:"),
+        embeddings=PaddedEmbeddings(),
+        manifest=DocumentManifest(str(tmp_path / "manifest.json")),
+        lexical_index=BM25Index(str(tmp_path / "lexical.json")),
+    )
+
+def test_rag_dedupes_identical_pdfs_by_content(tmp_path):
+    pdf = _make_pdf(tmp_path / "a.pdf", ["Rain report", "Wind report"])
+    rag = _rag_system(tmp_path)
+    assert "Successfully ingested 2 chunks" in rag.ingest_pdf(pdf, "a.pdf")
+    calls = rag.embeddings.embeddings.document_calls
+    assert "reused its 2 chunks" in rag.ingest_pdf(pdf, "copy-of-a.pdf")
+    assert rag.embeddings.embeddings.document_calls == calls
+    assert sorted(rag.get_uploaded_pdfs()) == ["a.pdf", "copy-of-a.pdf"]
+
+    # Deleting one name keeps the shared chunks, deleting the last removes them
+    rag.delete_pdf("a.pdf")
+    assert rag.client.count(rag.collection_name).count == 2
+    rag.delete_pdf("copy-of-a.pdf")
+    assert rag.client.count(rag.collection_name).count == 0
+    assert rag.get_uploaded_pdfs() == []
+
+def test_rag_manifest_rebuilt_from_qdrant_on_startup(tmp_path):
+    pdf = _make_pdf(tmp_path / "a.pdf", ["Rain report", "Wind report"])
+    client = QdrantClient(":memory:")
+    rag = _rag_system(tmp_path, client)
+    rag.ingest_pdf(pdf, "a.pdf")
+    (tmp_path / "manifest.json").unlink()
+
+    restarted = _rag_system(tmp_path, client)
+    assert restarted.get_uploaded_pdfs() == ["a.pdf"]
+    assert "reused its 2 chunks" in restarted.ingest_pdf(pdf, "renamed.pdf")
+    assert "Successfully deleted 'a.pdf'" in restarted.delete_pdf("a.pdf")
+
+
+def test_rag_resumes_interrupted_ingest_from_last_stored_window(tmp_path, monkeypatch):
+    monkeypatch.setenv("INGEST_WINDOW_PAGES", "2")
+    pdf = _make_pdf(tmp_path / "a.pdf", [f"Report {i} rain" for i in range(5)])
+    client = QdrantClient(":memory:")
+    checkpoints_path = str(tmp_path / "checkpoints.json")
+    rag = _rag_system(tmp_path, client)
+    rag.ingest_checkpoints = IngestCheckpoints(checkpoints_path)
+    embed = rag.embeddings.embeddings.embed_documents
+
+    def flaky(texts):
+        if any("Report 3" in text for text in texts):
+            raise RuntimeError("embedding server went away")
+        return embed(texts)
+
+    rag.embeddings.embeddings.embed_documents = flaky
+    assert "after page 2" in rag.ingest_pdf(pdf, "a.pdf")
+    assert rag.get_uploaded_pdfs() == []
+
+    # After a restart the stored pages aren't mistaken for a finished document
+    restarted = RAGSystem(client=client, embeddings=PaddedEmbeddings(), manifest=DocumentManifest(),
+                          lexical_index=BM25Index(), ingest_checkpoints=IngestCheckpoints(checkpoints_path))
+    assert restarted.get_uploaded_pdfs() == []
+    checkpoint = restarted.ingest_checkpoints.get(file_sha256(pdf))
+    assert checkpoint["pages_done"] == 2 and checkpoint["windows"] == [[0, 2, 2]] and "point_ids" not in checkpoint
+    # The stored half of the document isn't served, by dense or lexical search
+    assert client.count(restarted.collection_name).count == 2
+    assert restarted.retrieve("Report 1 rain") == []
+    restarted.retrieval_mode = "dense"
+    assert restarted.retrieve("Report 1 rain") == []
+    restarted.retrieval_mode = "hybrid"
+
+    calls = restarted.embeddings.embeddings.document_calls
+    progress = []
+    result = restarted.ingest_pdf(pdf, "a.pdf", on_progress=lambda *args: progress.append(args))
+    assert "Successfully ingested 5 chunks" in result and "resumed at page 3" in result
+    assert progress == [(4, 5, 4), (5, 5, 5)]
+    assert restarted.embeddings.embeddings.document_calls == calls + 2  # Pages 1-2 weren't embedded again
+    assert client.count(restarted.collection_name).count == 5
+    assert restarted.manifest.get(file_sha256(pdf))["chunks"] == 5
+    assert restarted.ingest_checkpoints.pending() == {}
+    assert "Report 1 rain" in [doc.page_content for doc in restarted.retrieve("Report 1 rain")]
+
+
+def test_rag_restart_after_crash_mid_window_skips_rebuilds_and_discards_stale_ingests(tmp_path, monkeypatch):
+    monkeypatch.setenv("INGEST_WINDOW_PAGES", "2")
+    monkeypatch.setenv("INGEST_EMBED_BATCH_SIZE", "1")
+    client = QdrantClient(":memory:")
+    checkpoints_path = str(tmp_path / "checkpoints.json")
+
+    def start():
+        return RAGSystem(client=client, embeddings=PaddedEmbeddings(),
+                         manifest=DocumentManifest(str(tmp_path / "manifest.json")),
+                         lexical_index=BM25Index(str(tmp_path / "lexical.json")),
+                         ingest_checkpoints=IngestCheckpoints(checkpoints_path))
+
+    rag = start()
+    rag.ingest_pdf(_make_pdf(tmp_path / "b.pdf", ["Wind report"]), "b.pdf")
+    embed = rag.embeddings.embeddings.embed_documents
+
+    def flaky(texts):
+        if any("Report 3" in text for text in texts):
+            raise RuntimeError("embedding server went away")
+        return embed(texts)
+
+    rag.embeddings.embeddings.embed_documents = flaky
+    pdf = _make_pdf(tmp_path / "a.pdf", [f"Report {i} rain" for i in range(5)])
+    assert "after page 2" in rag.ingest_pdf(pdf, "a.pdf")
+    # Page 3 was stored before the crash, but no window recorded it
+    assert client.count(rag.collection_name).count == 4
+    assert rag.ingest_checkpoints.get(file_sha256(pdf))["chunks"] == 2
+
+    with patch.object(DocumentManifest, "rebuild") as manifest_rebuild, patch.object(BM25Index, "rebuild") as lexical_rebuild:
+        restarted = start()
+    manifest_rebuild.assert_not_called()
+    lexical_rebuild.assert_not_called()
+    assert restarted.get_uploaded_pdfs() == ["b.pdf"]
+    assert restarted.ingest_checkpoints.get(file_sha256(pdf)) is not None  # Still resumable
+
+    # Past INGEST_CHECKPOINT_TTL, the next start frees the chunks, lexical entries and checkpoint
+    monkeypatch.setenv("INGEST_CHECKPOINT_TTL", "0")
+    restarted = start()
+    assert client.count(restarted.collection_name).count == 1
+    assert restarted.ingest_checkpoints.pending() == {}
+    assert restarted.lexical_index.search("rain") == [] and len(restarted.lexical_index) == 1
+    assert restarted.get_uploaded_pdfs() == ["b.pdf"]
+
+
+def test_ingest_checkpoints_record_window_ranges(tmp_path):
+    path = tmp_path / "checkpoints.json"
+    path.write_text('{"old": {"filename": "a.pdf", "pages_done": 4, "total_pages": 9, "chunks": 7, "point_ids": ["x"]}}')
+    checkpoints = IngestCheckpoints(str(path))
+    assert checkpoints.get("old")["windows"] == [[0, 4, 7]] and "point_ids" not in checkpoints.get("old")
+
+    checkpoints.start("new", "b.pdf")
+    assert checkpoints.commit("new", 2, 5, 3) == 3 and checkpoints.commit("new", 4, 5, 1) == 4
+    assert IngestCheckpoints(str(path)).get("new")["windows"] == [[0, 2, 3], [2, 4, 1]]
+
+def test_rag_bulk_delete_uses_one_filtered_delete(tmp_path):
+    rag = _rag_system(tmp_path)
+    for name in ("a.pdf", "b.pdf", "c.pdf"):
+        rag.ingest_pdf(_make_pdf(tmp_path / name, [f"{name} rain report"]), name)
+    point = rag.client.scroll(rag.collection_name, limit=10)[0][0]
+    assert point.payload["metadata"]["tenant"] == "default"
+
+    with patch.object(rag.client, "delete", wraps=rag.client.delete) as mock_delete:
+        assert rag.delete_pdfs(["a.pdf", "b.pdf"]) == "Successfully deleted 2 PDFs and 2 chunks."
+        mock_delete.assert_called_once()
+    points, _ = rag.client.scroll(rag.collection_name, limit=10, with_payload=True)
+    assert [point.payload["metadata"]["source_file"] for point in points] == ["c.pdf"]
+    assert rag.get_uploaded_pdfs() == ["c.pdf"]
+
+def test_rag_filtered_delete_scoped_to_tenant(tmp_path):
+    client = QdrantClient(":memory:")
+    pdf = _make_pdf(tmp_path / "a.pdf", ["Rain report"])
+    lexical = BM25Index()  # Shared, so both tenants index the same content hash
+    acme = RAGSystem(client=client, embeddings=PaddedEmbeddings(), manifest=DocumentManifest(),
+                     lexical_index=lexical, tenant="acme")
+    other = RAGSystem(client=client, embeddings=PaddedEmbeddings(), manifest=DocumentManifest(),
+                      lexical_index=lexical, tenant="other")
+    acme.ingest_pdf(pdf, "a.pdf")
+    other.ingest_pdf(pdf, "a.pdf")
+
+    assert "and its 1 chunks" in acme.delete_pdf("a.pdf")
+    points, _ = client.scroll(acme.collection_name, limit=10, with_payload=True)
+    assert [point.payload["metadata"]["tenant"] for point in points] == ["other"]
+    assert [point_id for point_id, _ in lexical.search("rain report")] == [points[0].id]
+
+
+def test_rag_retrieval_and_legacy_deletes_stay_within_tenant(tmp_path):
+    client = QdrantClient(":memory:")
+    lexical = BM25Index()  # Shared, as when tenants share one index file
+    acme = RAGSystem(client=client, embeddings=PaddedEmbeddings(), manifest=DocumentManifest(),
+                     lexical_index=lexical, tenant="acme")
+    other = RAGSystem(client=client, embeddings=PaddedEmbeddings(), manifest=DocumentManifest(),
+                      lexical_index=lexical, tenant="other")
+    acme.ingest_pdf(_make_pdf(tmp_path / "a.pdf", ["Rain report XK-12"]), "a.pdf")
+
+    for mode in ("dense", "hybrid"):
+        other.retrieval_mode = mode
+        assert other.retrieve("rain report XK-12") == []
+    assert len(acme.retrieve("rain report XK-12")) == 1
+
+    # A document rebuilt without a content hash only matches unhashed chunks of this tenant (or none)
+    other.manifest.add("name:a.pdf", "a.pdf", 1, [])
+    other.delete_pdf("a.pdf")
+    assert client.count(acme.collection_name).count == 1
+
+
+def test_rag_retrieve_caches_embeddings_and_results_until_collection_changes(tmp_path):
+    rag = _rag_system(tmp_path)
+    fake = rag.embeddings.embeddings
+    rag.ingest_pdf(_make_pdf(tmp_path / "a.pdf", ["Rain report"]), "a.pdf")
+
+    with patch.object(rag.vector_store, "similarity_search", wraps=rag.vector_store.similarity_search) as mock_search:
+        first = rag.retrieve("Will it RAIN?")
+        queries = fake.query_calls
+        assert rag.retrieve("  will it rain? ") == first
+        assert mock_search.call_count == 1
+        assert rag.result_cache.stats()["hits"] == 1
+
+        # New chunks invalidate cached results, but the query embedding is still reused
+        rag.ingest_pdf(_make_pdf(tmp_path / "b.pdf", ["More rain"]), "b.pdf")
+        assert len(rag.retrieve("will it rain?")) == 2
+        assert mock_search.call_count == 2
+        assert fake.query_calls == queries
+
+        rag.delete_pdf("b.pdf")
+        assert len(rag.retrieve("will it rain?")) == 1
+        assert mock_search.call_count == 3
+
+
+def test_bm25_matches_exact_part_numbers_and_drops_groups():
+    index = BM25Index()
+    index.add("p1", "Replace filter FX-2041 every six months.", ("acme", "doc-a"))
+    index.add("p2", "The filter housing is described in section 4.", ("acme", "doc-a"))
+    index.add("p3", "Part FX-2014 is the older gasket.", ("acme", "doc-b"))
+    assert [point_id for point_id, _ in index.search("What is FX-2041?", k=2)][0] == "p1"
+    index.remove_groups([("acme", "doc-a")])
+    assert [point_id for point_id, _ in index.search("filter FX-2041")] == []
+    assert len(index) == 1
+
+
+def test_bm25_index_appends_changes_to_a_log_and_compacts(tmp_path):
+    path = str(tmp_path / "lexical.json")
+    index = BM25Index(path)
+    index.add("p1", "pump GK-100 gasket", ("acme", "doc-a"))
+    index.add("p2", "valve VX-7", ("acme", "doc-b"))
+    index.save()
+    index.remove_groups([("acme", "doc-a")])
+    index.add("p3", "filter FT-9", ("acme", "doc-c"))
+    index.save()
+    assert not os.path.exists(path)  # Only the log was written
+
+    reopened = BM25Index(path)
+    assert len(reopened) == 2 and reopened.search("VX-7", 1)[0][0] == "p2"
+    assert reopened.search("GK-100") == []
+
+    reopened._compact()
+    assert os.path.getsize(f"{path}.log") == 0
+    assert [point_id for point_id, _ in BM25Index(path).search("FT-9 VX-7", 2)] in (["p3", "p2"], ["p2", "p3"])
+
+
+def test_bm25_skips_common_terms_and_prunes_without_changing_the_top_k():
+    index = BM25Index()
+    rng = random.Random(0)
+    for n in range(2000):
+        words = rng.sample(["pump", "gasket", "valve", "seal", "annual", "monthly", "aquamax", "novajet"], 4)
+        index.add(n, f"Part {n} is the {' '.join(words)} for the catalogue series", ("acme", "doc"))
+    count, avg_length = len(index), index._total_length / len(index)
+
+    def exhaustive(query, k):
+        scores = {}
+        for term in set(tokenize(query)) - STOPWORDS:
+            postings = index._postings.get(term, {})
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            if idf < index.min_idf:
+                continue
+            for point_id, tf in postings.items():
+                norm = tf + index.k1 * (1 - index.b + index.b * index._docs[point_id][1] / avg_length)
+                scores[point_id] = scores.get(point_id, 0.0) + idf * tf * (index.k1 + 1) / norm
+        return sorted(scores.values(), reverse=True)[:k]
+
+    query = "What is the part number of the gasket seal for the AquaMax pump, replaced monthly?"
+    assert [round(score, 9) for _, score in index.search(query, 10)] == [round(s, 9) for s in exhaustive(query, 10)]
+    assert index.search("what is the part for the catalogue series") == []  # Stopwords and terms in every chunk
+    assert index.search("part 17")[0][0] == 17
+
+
+def test_bm25_groups_are_scoped_by_tenant_and_old_files_are_discarded(tmp_path):
+    path = str(tmp_path / "lexical.json")
+    index = BM25Index(path)
+    index.add("p1", "pump GK-100", ("acme", "hash"))
+    index.add("p2", "pump GK-100", ("other", "hash"))
+    index.remove_groups([("acme", "hash")])
+    index.save()
+    assert [point_id for point_id, _ in BM25Index(path).search("GK-100")] == ["p2"]
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump([["p1", "hash", {"pump": 1}]], f)  # Written before groups carried the tenant
+    assert len(BM25Index(path)) == 0
+    assert os.path.getsize(f"{path}.log") == 0
+
+
+def test_reciprocal_rank_fusion_rewards_agreement():
+    assert reciprocal_rank_fusion([["a", "b"], ["b", "c"]]) == ["b", "a", "c"]
+
+def test_rag_hybrid_retrieve_finds_exact_terms_dense_misses(tmp_path):
+    rag = _rag_system(tmp_path)
+    # KeywordEmbeddings puts every non-weather chunk on the same axis, so dense search can't rank these
+    pages = [f"Gasket part GK-{n} fits pump model {n}" for n in range(100, 130)]
+    rag.ingest_pdf(_make_pdf(tmp_path / "parts.pdf", pages), "parts.pdf")
+    assert len(rag.lexical_index) == 30
+
+    results = rag.retrieve("Which pump does GK-117 fit?", k=3)
+    assert "GK-117" in results[0].page_content
+
+    # The index survives a restart and follows deletes
+    restarted = _rag_system(tmp_path, rag.client)
+    assert len(restarted.lexical_index) == 30
+    restarted.delete_pdf("parts.pdf")
+    assert len(restarted.lexical_index) == 0
+
+
+def test_token_budget_batches_sort_by_length_and_respect_budget():
+    lengths = [50, 3, 40, 4, 5]
+    batches = token_budget_batches(lengths, max_tokens=100)
+    assert sorted(i for batch in batches for i in batch) == list(range(5))
+    assert batches[0] == [1, 3, 4]
+    for batch in batches:
+        assert max(lengths[i] for i in batch) * len(batch) <= 100 or len(batch) == 1
+
+def test_mean_pool_ignores_padding_and_normalizes():
+    hidden = np.array([[[3.0, 0.0], [1.0, 0.0], [100.0, 100.0]]])
+    pooled = mean_pool(hidden, np.array([[1, 1, 0]]))
+    assert pooled.tolist() == [[1.0, 0.0]]
+
+def _tiny_onnx_model(tmp_path):
+    """An embedding-lookup "transformer" plus a word-level tokenizer, in the layout export_onnx writes."""
+    onnx = pytest.importorskip("onnx")
+    from onnx import helper, TensorProto
+    from tokenizers import Tokenizer, models, pre_tokenizers
+
+    vocab = {"[UNK]": 0, "rain": 1, "sun": 2, "wind": 3}
+    table = np.eye(4, 3, dtype=np.float32) + 0.1
+    graph = helper.make_graph(
+        [helper.make_node("Gather", ["table", "input_ids"], ["last_hidden_state"])],
+        "tiny",
+        [helper.make_tensor_value_info("input_ids", TensorProto.INT64, ["batch", "sequence"]),
+         helper.make_tensor_value_info("attention_mask", TensorProto.INT64, ["batch", "sequence"])],
+        [helper.make_tensor_value_info("last_hidden_state", TensorProto.FLOAT, ["batch", "sequence", 3])],
+        [helper.make_tensor("table", TensorProto.FLOAT, table.shape, table.flatten().tolist())],
+    )
+    model_dir = tmp_path / "onnx_models" / "tiny"
+    model_dir.mkdir(parents=True)
+    onnx.save(helper.make_model(graph, opset_imports=[helper.make_opsetid("", 17)], ir_version=8), str(model_dir / "model.onnx"))
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.save(str(model_dir / "tokenizer.json"))
+    return model_dir, table
+
+def test_onnx_embeddings_match_reference_pooling(tmp_path):
+    model_dir, table = _tiny_onnx_model(tmp_path)
+    embeddings = OnnxEmbeddings(str(model_dir / "model.onnx"), str(model_dir / "tokenizer.json"), threads=1, max_batch_tokens=4)
+    texts = ["rain", "sun wind wind", "rain sun"]
+    expected = mean_pool(table[[[1, 0, 0], [2, 3, 3], [1, 2, 0]]], np.array([[1, 0, 0], [1, 1, 1], [1, 1, 0]]))
+    assert np.allclose(embeddings.embed_documents(texts), expected, atol=1e-6)
+    assert np.allclose(embeddings.embed_query("sun wind wind"), expected[1], atol=1e-6)
+
+def test_build_embeddings_falls_back_to_torch_outside_tolerance(tmp_path, monkeypatch):
+    model_dir, _ = _tiny_onnx_model(tmp_path)
+    monkeypatch.setenv("ONNX_MODEL_DIR", str(tmp_path / "onnx_models"))
+    with patch("langchain_huggingface.HuggingFaceEmbeddings") as mock_hf:
+        # An export whose agreement was never measured isn't trusted
+        assert build_embeddings("onnx", model_name="tiny") is mock_hf.return_value
+    (model_dir / "tolerance.json").write_text('{"onnx": {"min_cosine": 0.999}, "onnx-int8": {"min_cosine": 0.9}}')
+
+    assert isinstance(build_embeddings("onnx", model_name="tiny"), OnnxEmbeddings)
+    with patch("langchain_huggingface.HuggingFaceEmbeddings") as mock_hf:
+        # The int8 file is missing and its recorded agreement is too low either way
+        assert build_embeddings("onnx-int8", model_name="tiny") is mock_hf.return_value
+        # So its vectors are cached under PyTorch, apart from the ONNX ones
+        mock_hf.return_value = MagicMock(spec=Embeddings)
+        assert cache_model_name(build_embeddings("onnx-int8", model_name="tiny"), "tiny") == "tiny:torch"
+    assert cache_model_name(build_embeddings("onnx", model_name="tiny"), "tiny") == "tiny:onnx"
+
+def test_collection_profiles_shrink_ram_and_configure_rescoring(monkeypatch):
+    sizes = [estimate_ram_bytes(get_profile(name), 1_000_000, 384) for name in ("default", "lean", "minimal")]
+    assert sizes == sorted(sizes, reverse=True) and sizes[1] < sizes[0] / 3
+
+    monkeypatch.setenv("QDRANT_HNSW_M", "32")
+    lean = get_profile("lean")
+    config = collection_config(lean, 384)
+    assert config["vectors_config"].on_disk and config["hnsw_config"].m == 32
+    assert config["quantization_config"].scalar.always_ram
+    with pytest.raises(ValueError):
+        get_profile("huge")
+
+def test_migrate_collection_updates_only_drifted_settings():
+    client = MagicMock(wraps=QdrantClient(":memory:"))
+    client.create_collection("docs", **collection_config(get_profile("default"), 384))
+
+    assert migrate_collection(client, "docs", get_profile("default")) == []
+    client.update_collection.assert_not_called()
+
+    assert migrate_collection(client, "docs", get_profile("lean")) == ["on_disk", "quantization"]
+    kwargs = client.update_collection.call_args.kwargs
+    assert kwargs["vectors_config"][""].on_disk is True
+    assert kwargs["quantization_config"].scalar is not None
+    assert kwargs["hnsw_config"] is None
+
+def test_profile_drift_detects_quantization_setting_changes():
+    from types import SimpleNamespace
+    lean = get_profile("lean")
+    created = collection_config(lean, 384)
+    client = MagicMock()
+    client.get_collection.return_value.config = SimpleNamespace(
+        params=SimpleNamespace(vectors=created["vectors_config"]), hnsw_config=created["hnsw_config"],
+        quantization_config=created["quantization_config"],
+    )
+    assert profile_drift(client, "docs", lean) == []
+    assert profile_drift(client, "docs", dict(lean, quantile=0.95)) == ["quantization"]
+    assert profile_drift(client, "docs", get_profile("default")) == ["on_disk", "quantization"]
+
+def test_rag_local_mode_skips_search_params(tmp_path, monkeypatch):
+    monkeypatch.setenv("QDRANT_COLLECTION_PROFILE", "lean")
+    rag = _rag_system(tmp_path)
+    assert rag.initialized
+    assert "search_params" not in rag.retriever.search_kwargs
+
+def _chunk(text, source="manual.pdf"):
+    from langchain_core.documents import Document
+    return Document(page_content=text, metadata={"source_file": source})
+
+def test_overlap_length_finds_shared_boundary():
+    assert overlap_length("alpha beta gamma delta", "gamma delta epsilon", min_overlap=5) == len("gamma delta")
+    assert overlap_length("alpha beta", "gamma delta", min_overlap=5) == 0
+
+def test_context_packer_merges_overlaps_and_respects_budget():
+    text = " ".join(f"word{n}" for n in range(120))
+    first, second = text[:400], text[300:]  # Adjacent chunks sharing 100 characters
+    docs = [_chunk(first), _chunk("Pump GK-117 needs a new gasket.", "other.pdf"), _chunk(second)]
+    packer = ContextPacker(max_tokens=1000, min_overlap=20)
+
+    context, stats = packer.pack(docs)
+    assert text in context and context.count("word35 ") == 1
+    assert stats["chunks_in"] == 3 and stats["passages"] == 2
+    assert stats["tokens_saved"] == stats["raw_tokens"] - stats["packed_tokens"] > 0
+
+    small = ContextPacker(max_tokens=20)
+    context, stats = small.pack(docs)
+    assert stats["packed_tokens"] <= 20 and context
+    assert small.stats()["turns"] == 1
+
+    # Savings are measured against the top baseline_chunks sent verbatim, not every candidate
+    extra = [_chunk(f"filler passage {n} " * 20, f"f{n}.pdf") for n in range(5)]
+    _, stats = ContextPacker(max_tokens=10_000, baseline_chunks=2).pack(docs[:2] + extra)
+    assert stats["raw_tokens"] == packer.count_tokens(first + "\n\n" + docs[1].page_content)
+    assert stats["tokens_saved"] == 0
+
+def test_context_packer_truncates_with_its_own_token_counter():
+    words = lambda text: len(text.split())
+    context, stats = ContextPacker(max_tokens=5, count_tokens=words).pack([_chunk("one two three four five six seven")])
+    assert context.split() == ["one", "two", "three", "four", "five"] and stats["packed_tokens"] == 5
+
+def test_context_packer_mmr_prefers_novel_passages():
+    docs = [_chunk("rain forecast for monday"), _chunk("rain forecast for monday morning", "b.pdf"),
+            _chunk("pump maintenance schedule", "c.pdf")]
+    ordered = ContextPacker(lambda_mult=0.5).mmr(ContextPacker().merge_overlapping(docs))
+    assert [p["text"] for p in ordered][:2] == ["rain forecast for monday", "pump maintenance schedule"]
+
+def test_conversation_history_keeps_recent_turns_within_budget():
+    from langchain_core.messages import HumanMessage
+    messages = []
+    for n in range(4):
+        messages += [HumanMessage(content=f"question {n}"), AIMessage(content=f"answer {n} " + "x" * 40)]
+    history = ConversationHistory(keep_turns=3, max_tokens=30)
+
+    assert [m.content for m in history.window(messages)] == ["question 3", messages[-1].content]
+    assert history.overflow(messages) == messages[:6]
+    assert ConversationHistory(keep_turns=3, max_tokens=1000).window(messages) == messages[2:]
+
+def test_graph_folds_old_turns_into_incremental_summary():
+    prompts = []
+
+    class RecordingLLM:
+        def invoke(self, messages):
+            prompts.append(messages)
+            return AIMessage(content=f"summary {len(prompts)}")
+
+    answers = GenericFakeChatModel(messages=iter([AIMessage(content=f"answer {n}") for n in range(3)]))
+    router = SemanticRouter(KeywordEmbeddings(), margin_threshold=0.1)
+    get_llm = lambda model="default": answers if model == "default" else RecordingLLM()
+    with components.override(semantic_router=router), patch("src.nodes.get_llm", side_effect=get_llm), \
+            patch("src.nodes.conversation_history", ConversationHistory(keep_turns=1, max_tokens=1000)), \
+            components.override(rag_system=_empty_rag()):
+        graph = build_graph()
+        config = {"configurable": {"thread_id": "summary-test"}}
+        for n in range(3):
+            graph.invoke({"question": f"Summarize part {n}"}, config)
+        state = graph.get_state(config).values
+
+    assert state["summary"] == "summary 2"
+    assert [m.content for m in state["messages"]] == ["Summarize part 2", "answer 2"]
+    # The second fold only sends the previous summary and the one newly evicted turn
+    assert "summary 1" in prompts[1][1].content
+    assert "part 1" in prompts[1][1].content and "part 0" not in prompts[1][1].content
+
+def _answer_graph(checkpointer, answers):
+    llm = GenericFakeChatModel(messages=iter([AIMessage(content=answer) for answer in answers]))
+    router = SemanticRouter(KeywordEmbeddings(), margin_threshold=0.1)
+    # patch.dict, unlike components.override(), can be entered once per turn
+    patches = [patch.dict(components._instances, semantic_router=router, rag_system=_empty_rag()),
+               patch("src.nodes.get_llm", return_value=llm)]
+    return build_graph(checkpointer=checkpointer), patches
+
+def test_sqlite_checkpointer_keeps_latest_checkpoint_across_restarts(tmp_path):
+    path = str(tmp_path / "checkpoints.sqlite")
+    graph, patches = _answer_graph(SQLiteCheckpointer(path), ["first answer", "second answer"])
+    config = {"configurable": {"thread_id": "persist"}}
+    with patches[0], patches[1]:
+        graph.invoke({"question": "Summarize it"}, config)
+        graph.invoke({"question": "And the rest?"}, config)
+    assert len(list(graph.checkpointer.list(config))) == 1
+
+    reopened = build_graph(checkpointer=SQLiteCheckpointer(path))
+    messages = reopened.get_state(config).values["messages"]
+    assert [m.content for m in messages] == ["Summarize it", "first answer", "And the rest?", "second answer"]
+
+def test_sqlite_checkpointer_evicts_by_ttl_lru_and_size(tmp_path):
+    checkpointer = SQLiteCheckpointer(max_threads=2)
+    graph, patches = _answer_graph(checkpointer, ["a", "b", "c", "d"])
+    with patches[0], patches[1]:
+        for thread_id in ("one", "two"):
+            graph.invoke({"question": "Summarize it"}, {"configurable": {"thread_id": thread_id}})
+        graph.get_state({"configurable": {"thread_id": "one"}})  # "one" is now the most recently used
+        graph.invoke({"question": "Summarize it"}, {"configurable": {"thread_id": "three"}})
+    threads = {row[0] for row in checkpointer._conn.execute("SELECT thread_id FROM threads")}
+    assert threads == {"one", "three"} and checkpointer.stats()["evictions"] == 1
+
+    checkpointer.ttl = 0
+    checkpointer.max_bytes = 0
+    with patches[0], patches[1]:
+        graph.invoke({"question": "Summarize it"}, {"configurable": {"thread_id": "four"}})
+    # Everything idle goes; the thread being written is kept
+    assert {row[0] for row in checkpointer._conn.execute("SELECT thread_id FROM threads")} == {"four"}
+
+    checkpointer.delete_thread("four")
+    assert graph.get_state({"configurable": {"thread_id": "four"}}).values == {}
+
+def test_sqlite_checkpointer_async_methods_run_off_the_event_loop():
+    checkpointer = SQLiteCheckpointer()
+    loop_thread = []
+
+    async def run():
+        loop_thread.append(threading.get_ident())
+        return await checkpointer.aget_tuple({"configurable": {"thread_id": "t"}})
+
+    with patch.object(checkpointer, "get_tuple", side_effect=lambda config: threading.get_ident()) as get_tuple:
+        assert asyncio.run(run()) != loop_thread[0]
+    get_tuple.assert_called_once()
+
+def test_importing_graph_opens_no_checkpoint_database(tmp_path):
+    env = {key: value for key, value in os.environ.items() if key != "CHECKPOINT_DB_PATH"}
+    env["PYTHONPATH"] = os.getcwd()
+    subprocess.run([sys.executable, "-c", "import src.graph"], cwd=tmp_path, env=env, check=True, timeout=120)
+    assert not (tmp_path / "checkpoints.sqlite").exists()
+
+def test_semantic_answer_cache_scopes_by_route_city_and_freshness():
+    version = [1]
+    cache = SemanticAnswerCache(KeywordEmbeddings(), threshold=0.9, weather_ttl=60, version=lambda: version[0])
+    cache.store("Weather in Tokyo", "weather", "Sunny in Tokyo.", ["Tokyo"])
+    cache.store("Weather in New York", "weather", "Rain in New York.", ["New  York"])
+    cache.store("Summarize the manual", "rag", "It covers pumps.")
+
+    assert cache.lookup("tokyo weather now", "weather", ["tokyo "]) == ("Sunny in Tokyo.", pytest.approx(1.0))
+    assert cache.lookup("Weather in Paris", "weather", ["Paris"]) is None  # Similar wording, different city
+    assert cache.lookup("Weather in York", "weather", ["York"]) is None  # Not "New York"
+    assert cache.lookup("Weather in Tokyo and Osaka", "weather", ["Tokyo", "Osaka"]) is None  # Not every city
+    # Without known cities, the cached city names are matched in the question as whole words
+    assert cache.lookup("tokyo weather now", "weather")[0] == "Sunny in Tokyo."
+    assert cache.lookup("Weather in  NEW YORK?", "weather")[0] == "Rain in New York."
+    assert cache.lookup("Weather in Tokyoville", "weather") is None
+    assert cache.lookup("Weather in Tokyo and Osaka", "weather") is None  # Osaka may be a city never cached
+    assert cache.lookup("tokyo weather now", "rag") is None  # Other route
+    assert cache.lookup("summarize the manual please", "rag")[0] == "It covers pumps."
+
+    version[0] = 2  # Documents changed
+    assert cache.lookup("summarize the manual please", "rag") is None
+    with patch("src.answer_cache.time.time", return_value=time.time() + 61):
+        assert cache.lookup("tokyo weather now", "weather", ["Tokyo"]) is None
+
+    stats = cache.stats()
+    assert stats["routes"]["weather"] == {"hits": 3, "misses": 6, "expired": 2, "hit_rate": pytest.approx(3 / 9)}
+    assert stats["routes"]["rag"]["expired"] == 1 and stats["size"] == 0
+
+def test_cached_answer_requires_confident_local_route_and_same_cities():
+    router = SemanticRouter(KeywordEmbeddings(), margin_threshold=0.1)
+    cache = SemanticAnswerCache(KeywordEmbeddings(), threshold=0.9)
+    cache.store("Weather in Tokyo", "weather", "Sunny in Tokyo.", ["Tokyo"])
+    with components.override(semantic_router=router), components.override(answer_cache=cache), \
+            patch("src.nodes.get_llm") as mock_get_llm:
+        from src.nodes import cached_answer
+        assert cached_answer("Tokyo weather now")[:2] == ("weather", "Sunny in Tokyo.")
+        assert cached_answer("Tokyo and Osaka weather now") is None
+        assert cached_answer("Weather in Paris") is None
+        router.margin_threshold = 2.0  # Too unsure to route locally, so no lookup
+        assert cached_answer("Tokyo weather now") is None
+        mock_get_llm.assert_not_called()  # Cities are matched locally, so a weather hit makes no LLM call
+
+def test_cached_turn_recorded_in_history():
+    graph = build_graph(checkpointer=SQLiteCheckpointer())
+    config = {"configurable": {"thread_id": "cached-turn"}}
+    graph.update_state(config, {"question": "Weather in Tokyo", "answer": "Sunny.",
+                                "messages": [HumanMessage(content="Weather in Tokyo"), AIMessage(content="Sunny.")]},
+                       as_node="summarize")
+    state = graph.get_state(config)
+    assert [m.content for m in state.values["messages"]] == ["Weather in Tokyo", "Sunny."]
+    assert state.next == ()
+
+def test_components_build_lazily_and_warm_up_in_background():
+    built = []
+
+    def slow(name):
+        def build(components):
+            time.sleep(0.1)
+            built.append(name)
+            return name.upper()
+        return build
+
+    lazy = Components(builders={"a": slow("a"), "b": slow("b")}, budget=5)
+    assert built == [] and not lazy.ready
+    assert lazy.get("b") == "B" and built == ["b"]  # Built on first use
+
+    lazy.warm_up()
+    assert lazy.status()["warming"]
+    assert lazy.wait(timeout=5)
+    assert built == ["b", "a"]  # Each component is built once per process
+    status = lazy.status()
+    assert status["ready"] and status["within_budget"] and set(status["timings"]) == {"a", "b"}
+
+    with lazy.override(a="fake"):
+        assert lazy.get("a") == "fake"
+    assert lazy.get("a") == "A"
+    with pytest.raises(KeyError):
+        lazy.get("missing")
+
+def test_importing_nodes_builds_no_components():
+    code = "import src.graph; from src.components import components; print(sorted(components._instances))"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, timeout=120,
+                            env={**os.environ, "CHECKPOINT_DB_PATH": ""})
+    assert result.stdout.strip().splitlines()[-1] == "[]"
+
+
+def test_graph_metrics_time_nodes_and_count_tokens():
+    metrics = GraphMetrics()
+    usage = {"input_tokens": 120, "output_tokens": 7, "total_tokens": 127}
+    llm = GenericFakeChatModel(messages=iter([AIMessage(content="It covers pumps.", usage_metadata=usage)]))
+    router = SemanticRouter(KeywordEmbeddings(), margin_threshold=0.1)
+    graph = build_graph(checkpointer=SQLiteCheckpointer(), metrics=metrics)
+    with components.override(semantic_router=router, rag_system=_empty_rag()), \
+            patch("src.nodes.get_llm", return_value=llm):
+        graph.invoke({"question": "Summarize the document"}, {"configurable": {"thread_id": "t"}})
+
+    turn = metrics.last_turn("t")
+    assert list(turn) == ["router", "rag", "generate"]
+    assert turn["router"]["local_routes"] == 1 and "llm_calls" not in turn["router"]
+    assert (turn["generate"]["prompt_tokens"], turn["generate"]["completion_tokens"]) == (120, 7)
+    assert all(record["seconds"] >= 0 for record in turn.values())
+    text = metrics.prometheus()
+    assert 'graph_node_duration_seconds_count{node="generate"} 1' in text
+    assert 'graph_llm_tokens_total{node="generate",kind="completion"} 7' in text
+    assert 'graph_node_events_total{node="router",event="local_routes"} 1' in text
+    assert metrics.to_json()["nodes"]["rag"]["calls"] == 1
+
+def test_graph_metrics_attribute_component_events_to_the_running_node():
+    metrics = GraphMetrics()
+    api = WeatherAPI(cache=WeatherCache())
+    node = metrics.instrument("weather", lambda state: {"context": api.get_weather(state["question"])})
+    config = {"configurable": {"thread_id": "t"}}
+    with patch("src.weather.requests.Session.get") as mock_get:
+        mock_get.return_value.json.return_value = {
+            "weather": [{"description": "mist"}], "main": {"temp": 4, "feels_like": 2, "humidity": 90},
+            "wind": {"speed": 3},
+        }
+        node({"question": "Oslo"}, config)
+        node({"question": "Oslo"}, config)
+    api.get_weather("Oslo")  # Outside any node: not counted
+
+    assert metrics.last_turn("t")["weather"]["weather_cache_hits"] == 1
+    assert metrics.to_json()["nodes"]["weather"]["weather_requests"] == 1
+    assert metrics.to_json()["nodes"]["weather"]["weather_cache_hits"] == 1
+
+class _EchoGraph:
+    """Stands in for the compiled graph: answers with the city it was asked about."""
+    def __init__(self):
+        self.checkpointer = SQLiteCheckpointer()
+        self.threads = set()
+
+    async def ainvoke(self, inputs, config):
+        self.threads.add(config["configurable"]["thread_id"])
+        return {"answer": f"Weather in {inputs['question']}: mist"}
+
+def test_evaluation_runner_batches_and_caches_judge_verdicts(tmp_path):
+    from benchmarks.fakes import FakeJudgeModel
+    dataset = tmp_path / "dataset.jsonl"
+    dataset.write_text('{"question": "Oslo", "answer": "Weather in Oslo"}\n'
+                       '{"inputs": {"question": "Lima"}, "outputs": {"answer": "Weather in Lima: sunny"}}\n'
+                       '{"question": "Pune", "answer": "Weather in Pune"}\n')
+    examples = load_dataset(str(dataset))
+    assert examples[1] == {"question": "Lima", "reference": "Weather in Lima: sunny"}
+    cache_path = str(tmp_path / "verdicts.jsonl")
+
+    graph = _EchoGraph()
+    runner = EvaluationRunner(graph, FakeJudgeModel(latency=0), JudgeCache(cache_path), concurrency=2, judge_batch_size=2)
+    report = runner.run(examples)
+    assert len(graph.threads) == 3  # A fresh thread per example
+    assert runner.judge_calls == 2  # Three predictions graded two per call
+    assert [r["score"] for r in report["results"]] == [1.0, 0.75, 1.0]
+
+    # A new run reuses the verdicts on disk and only grades what changed
+    rerun = EvaluationRunner(_EchoGraph(), FakeJudgeModel(latency=0), JudgeCache(cache_path), judge_batch_size=2)
+    report = rerun.run(examples + [{"question": "Rome", "reference": "Weather in Rome"}])
+    assert rerun.judge_calls == 1
+    assert [r["cached"] for r in report["results"]] == [True, True, True, False]
+    assert report["summary"]["judge_cache"]["hits"] == 3
+
+def test_evaluation_runner_regrades_items_a_batched_reply_skipped():
+    from benchmarks.fakes import FakeJudgeModel
+
+    class ForgetfulJudge(FakeJudgeModel):
+        def _answer(self, messages):
+            lines = super()._answer(messages).splitlines()
+            return "\n".join(lines if len(lines) == 1 else [line for line in lines if not line.startswith("2.")])
+
+    runner = EvaluationRunner(_EchoGraph(), ForgetfulJudge(latency=0), judge_batch_size=3)
+    report = runner.run([{"question": city, "reference": f"Weather in {city}"} for city in ("Oslo", "Lima", "Pune")])
+    assert runner.judge_calls == 2
+    assert [r["score"] for r in report["results"]] == [1.0, 1.0, 1.0]
+    assert report["summary"]["ungraded"] == 0
+
+def test_evaluation_runner_leaves_unparsable_verdicts_ungraded():
+    from benchmarks.fakes import FakeJudgeModel
+
+    class MuteJudge(FakeJudgeModel):
+        def _answer(self, messages):
+            lines = super()._answer(messages).splitlines()
+            return "\n".join(line for line in lines if "Lima" not in messages[-1].content)
+
+    runner = EvaluationRunner(_EchoGraph(), MuteJudge(latency=0), judge_batch_size=1)
+    report = runner.run([{"question": city, "reference": f"Weather in {city}"} for city in ("Oslo", "Lima")])
+    assert [r["score"] for r in report["results"]] == [1.0, None]
+    assert report["summary"]["mean_score"] == 1.0 and report["summary"]["ungraded"] == 1
+    assert runner.cache.stats()["size"] == 1
+
+def test_token_bucket_queues_beyond_burst_and_outbound_rejects_long_waits():
+    bucket = TokenBucket(rate=10.0, burst=2)
+    waits = [bucket.reserve() for _ in range(4)]
+    assert waits[:2] == [0.0, 0.0]
+    assert waits[2] == pytest.approx(0.1, abs=0.02) and waits[3] == pytest.approx(0.2, abs=0.02)
+
+    provider = OutboundProvider("test", rate=10.0, burst=1, max_wait=0.15)
+    provider.throttle()
+    provider.throttle()  # Waits ~0.1s for the next token
+    provider.bucket.reserve()  # Another caller queued ahead, ~0.1s
+    with pytest.raises(RateLimitQueueFull):
+        provider.throttle()  # Would wait ~0.2s
+    stats = provider.stats()
+    assert stats["throttled"] >= 1 and stats["rejected"] == 1
+    assert stats["max_queue_depth"] == 1 and stats["queue_depth"] == 0 and stats["wait_seconds"] > 0
+
+
+def test_outbound_coalesces_identical_calls_in_flight():
+    from concurrent.futures import ThreadPoolExecutor
+    provider = OutboundProvider("test")
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.2)
+        return {"temp": 21}
+
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda _: provider.call(fetch, key="paris"), range(4)))
+    assert len(calls) == 1 and results == [{"temp": 21}] * 4
+    assert results[0] is not results[1]  # Followers get copies
+
+    async def afetch():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return "sunny"
+
+    async def main():
+        return await asyncio.gather(*(provider.acall(afetch, key="oslo") for _ in range(3)))
+
+    assert asyncio.run(main()) == ["sunny"] * 3
+    assert len(calls) == 2
+    assert provider.stats()["coalesced"] == 5
+
+
+def test_outbound_retries_429_with_backoff_then_gives_up():
+    class TooManyRequests(Exception):
+        def __init__(self):
+            super().__init__("429")
+            self.response = MagicMock(status_code=429, headers={"retry-after": "0"})
+
+    provider = OutboundProvider("test", max_retries=2, base_delay=0.01)
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise TooManyRequests()
+        return "ok"
+
+    assert provider.call(flaky) == "ok"
+    assert provider.stats()["retries"] == 2
+
+    def always_limited():
+        attempts.append(1)
+        raise TooManyRequests()
+
+    attempts.clear()
+    with pytest.raises(TooManyRequests):
+        provider.call(always_limited)
+    assert len(attempts) == 3  # The first try and max_retries retries
+    with pytest.raises(ValueError):
+        provider.call(lambda: int("not a number"))  # Other errors aren't retried
+
+
+def test_full_groq_queue_answers_with_an_error_instead_of_rerouting():
+    with components.override(semantic_router=None), patch("src.nodes.get_llm") as mock_get_llm:
+        llm = mock_get_llm.return_value
+        llm.with_structured_output.return_value.invoke.side_effect = RateLimitQueueFull("groq: queue is 40s deep")
+        graph = build_graph(checkpointer=SQLiteCheckpointer())
+        result = graph.invoke({"question": "Summarize it"}, {"configurable": {"thread_id": "busy"}})
+        assert result["source"] == "busy" and "busy right now" in result["answer"]
+        llm.invoke.assert_not_called()  # Neither retrieval nor generation ran
+
+        llm.invoke.side_effect = RateLimitQueueFull("groq: queue is 40s deep")
+        state = {"question": "Summarize it", "context": "", "source": "rag", "messages": []}
+        from src.nodes import generate_node
+        assert "busy right now" in generate_node(state)["answer"]
+
+def test_groq_calls_are_limited_and_coalesced_per_api_key_and_model(monkeypatch):
+    from src.outbound import api_key_id, outbound
+    from src.nodes import _flight_key
+    assert outbound("groq", api_key_id("key-a")) is not outbound("groq", api_key_id("key-b"))
+    monkeypatch.delenv("GROQ_RATE_LIMIT")
+    assert OutboundProvider.from_env("groq").bucket.rate == 0  # Off unless configured
+    registry = LLMClientRegistry()
+    assert registry.get("key-a").rate_limiter.provider is outbound("groq", api_key_id("key-a"))
+
+    messages = [HumanMessage(content="Weather in Oslo?")]
+    keys = {_flight_key("router", model, key_id, messages)
+            for model in ("llama-3.3-70b-versatile", "llama-3.1-8b-instant")
+            for key_id in (api_key_id("key-a"), api_key_id("key-b"))}
+    assert len(keys) == 4
+
+    # One provider per key, but only the most recently used are kept
+    import src.outbound
+    monkeypatch.setattr(src.outbound, "MAX_PROVIDERS", 2)
+    first = outbound("groq", "scope-1")
+    outbound("groq", "scope-2")
+    outbound("groq", "scope-1")
+    outbound("groq", "scope-3")
+    assert list(src.outbound._providers) == ["groq:scope-1", "groq:scope-3"]
+    assert outbound("groq", "scope-1") is first
+
+def test_weather_api_shares_one_request_for_concurrent_lookups_of_a_city():
+    provider = OutboundProvider("openweathermap")
+    api = WeatherAPI(cache=WeatherCache(ttl=0, stale_ttl=0), provider=provider)
+    response = {"name": "Paris", "weather": [{"description": "clear sky"}],
+                "main": {"temp": 20, "feels_like": 19, "humidity": 40}, "wind": {"speed": 3}}
+
+    def slow_json(*args, **kwargs):
+        time.sleep(0.2)
+        return MagicMock(status_code=200, json=lambda: response, raise_for_status=lambda: None)
+
+    from concurrent.futures import ThreadPoolExecutor
+    with patch("src.weather.requests.Session.get", side_effect=slow_json) as get:
+        with ThreadPoolExecutor(3) as pool:
+            results = list(pool.map(api.get_weather, ["Paris", "paris", " Paris "]))
+    assert get.call_count == 1
+    assert all("20°C" in result for result in results)
+    assert provider.stats()["coalesced"] == 2
+
+
+def test_e2e_benchmark_runs_offline():
+    from benchmarks.e2e import build_parser, run
+    args = build_parser().parse_args(["--conversations", "2", "--turns", "3", "--pages", "3", "--llm-latency", "0",
+                                      "--token-latency", "0", "--weather-latency", "0", "--weather-share", "0.5"])
+
+    results = run(args)
 
+    assert results["throughput"]["turns"] == 6
+    assert results["latency"]["turn"]["count"] == 6
+    assert results["latency"]["nodes"]["weather"]["count"] == 3
+    assert results["latency"]["nodes"]["rag"]["count"] == 3
+    assert results["ingest"]["pages"] == 3
+    # Weather turns were fetched from the stub through WeatherAPI, not the real endpoint (one asks about two cities)
+    assert results["weather"]["stub_requests"] == 4
+    assert results["checkpointer"]["threads"] == 2